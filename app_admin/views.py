@@ -1,11 +1,12 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from app_admin.models import KYCDetails, KYCStatusLookup
+from app_admin.models import KYCDetails
 from app_admin.serializers import KYCDetailsSerializer, KYCUpdateSerializer
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
 from django.utils import timezone
+from ride_sharing.lookups import kyc_statuses
 
 # View all KYC
 class ViewAllKYC(APIView):
@@ -18,7 +19,7 @@ class ViewAllKYC(APIView):
 # View pending KYC
 class ViewPendingKYC(APIView):
     def get(self, request):
-        pending_status = KYCStatusLookup.objects.get(kyc_status="PENDING_APPROVAL")
+        pending_status = kyc_statuses.get("PENDING_APPROVAL")
         kycs = KYCDetails.objects.filter(kyc_status=pending_status)
         serializer = KYCDetailsSerializer(kycs, many=True)
         return Response(serializer.data)
@@ -57,7 +58,7 @@ class AcceptKYCView(APIView):
         data = request.data
         kyc_id = data.get('kyc_id')
         kyc = get_object_or_404(KYCDetails, kyc_id=kyc_id)
-        approved_status = KYCStatusLookup.objects.get(kyc_status="APPROVED")
+        approved_status = kyc_statuses.get("APPROVED")
         kyc.kyc_status = approved_status
         kyc.verified_at = timezone.now()
         kyc.rejected_reason = None
@@ -72,7 +73,7 @@ class RejectKYCView(APIView):
         data = request.data
         kyc_id = data.get('kyc_id')
         kyc = get_object_or_404(KYCDetails, kyc_id=kyc_id)
-        rejected_status = KYCStatusLookup.objects.get(kyc_status="REJECTED")
+        rejected_status = kyc_statuses.get("REJECTED")
         kyc.kyc_status = rejected_status
         kyc.rejected_reason = request.data.get("rejected_reason", "No reason provided")
         kyc.save()
@@ -0,0 +1,245 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from drivers.models import Driver
+from ride_sharing import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DriverLocation(NamedTuple):
+    h3_index: str
+    latitude: Optional[float]
+    longitude: Optional[float]
+    updated_at: object
+
+    @property
+    def last_location(self):
+        if self.latitude is None or self.longitude is None:
+            return None
+        return f"{self.latitude},{self.longitude}"
+
+
+def _quote(model, field=None):
+    if field is None:
+        return connection.ops.quote_name(model._meta.db_table)
+    return connection.ops.quote_name(model._meta.get_field(field).column)
+
+
+def _values_update_sql(count):
+    """
+    UPDATE drivers ... FROM (VALUES ...) for `count` drivers, one statement
+    whatever the batch size
+    """
+    rows = ", ".join(["(%s::uuid, %s, %s, %s::timestamptz)"] * count)
+    return f"""
+        UPDATE {_quote(Driver)} AS d
+        SET {_quote(Driver, "current_h3_index")} = v.h3_index,
+            {_quote(Driver, "last_location")} = COALESCE(v.last_location, d.{_quote(Driver, "last_location")}),
+            {_quote(Driver, "location_updated_at")} = v.updated_at
+        FROM (VALUES {rows}) AS v(driver_id, h3_index, last_location, updated_at)
+        WHERE d.{_quote(Driver, "driver_id")} = v.driver_id
+    """
+
+
+class DriverLocationState:
+    """
+    The latest position of every driver that has pinged recently.
+
+    Pings only replace the driver's entry in memory; every
+    `flush_interval` seconds the drivers that moved since the last flush
+    are written to the drivers table in one UPDATE ... FROM (VALUES ...)
+    per `batch_size` drivers, so a driver pinging every second costs one
+    row write per interval instead of one per ping. Readers ask this
+    state first and fall back to the drivers row; positions older than
+    `max_age` seconds are already written and are dropped from memory.
+    """
+
+    def __init__(self, flush_interval=2.0, batch_size=1000, max_age=300):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self._latest = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            "pings": 0, "rows_written": 0, "statements": 0,
+            "flushes": 0, "failed_flushes": 0, "last_flush_ms": 0.0,
+        }
+
+    def update(self, driver_id, h3_index, latitude=None, longitude=None, at=None):
+        location = DriverLocation(h3_index, latitude, longitude, at or timezone.now())
+        driver_id = str(driver_id)
+
+        with self._lock:
+            self._latest[driver_id] = location
+            self._dirty[driver_id] = location
+            self._counters["pings"] += 1
+
+        self._ensure_started()
+
+    def update_many(self, points):
+        """
+        Records LocationPoints, the last point per driver winning
+        """
+        now = timezone.now()
+        with self._lock:
+            for point in points:
+                location = DriverLocation(point.h3_index, point.latitude, point.longitude, now)
+                driver_id = str(point.driver_id)
+                self._latest[driver_id] = location
+                self._dirty[driver_id] = location
+            self._counters["pings"] += len(points)
+
+        if points:
+            self._ensure_started()
+
+    def get(self, driver_id):
+        """
+        The driver's latest DriverLocation from this worker, or None
+        """
+        return self._latest.get(str(driver_id))
+
+    def cell_of(self, driver):
+        """
+        A Driver's current H3 cell, preferring the in-memory position over
+        the (possibly not yet flushed) drivers row
+        """
+        location = self.get(driver.driver_id)
+        return location.h3_index if location is not None else driver.current_h3_index
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="driver-location-state", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("driver location flush failed")
+
+    def _prune(self):
+        cutoff = timezone.now() - timedelta(seconds=self.max_age)
+        with self._lock:
+            stale = [
+                driver_id for driver_id, location in self._latest.items()
+                if location.updated_at < cutoff and driver_id not in self._dirty
+            ]
+            for driver_id in stale:
+                del self._latest[driver_id]
+
+    def _take(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        return dirty
+
+    def _restore(self, dirty):
+        """
+        Puts a failed flush back, unless a newer ping has replaced it
+        """
+        with self._lock:
+            for driver_id, location in dirty.items():
+                self._dirty.setdefault(driver_id, location)
+
+    def flush(self):
+        """
+        Writes every driver that moved since the last flush. Returns the
+        number of drivers written.
+        """
+        with self._flush_lock:
+            self._prune()
+            dirty = self._take()
+            if not dirty:
+                return 0
+
+            close_old_connections()
+            started = time.perf_counter()
+            try:
+                written = self._write(list(dirty.items()))
+            except Exception:
+                self._counters["failed_flushes"] += 1
+                self._restore(dirty)
+                raise
+            finally:
+                self._counters["flushes"] += 1
+                self._counters["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        return written
+
+    def _write(self, items):
+        if connection.vendor != "postgresql":
+            drivers = [
+                Driver(
+                    driver_id=driver_id,
+                    current_h3_index=location.h3_index,
+                    last_location=location.last_location,
+                    location_updated_at=location.updated_at,
+                )
+                for driver_id, location in items
+            ]
+            self._counters["statements"] += 1
+            self._counters["rows_written"] += len(drivers)
+            return Driver.objects.bulk_update(
+                drivers, ["current_h3_index", "last_location", "location_updated_at"],
+                batch_size=self.batch_size
+            )
+
+        written = 0
+        with connection.cursor() as cursor:
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                params = []
+                for driver_id, location in batch:
+                    params.extend((driver_id, location.h3_index, location.last_location, location.updated_at))
+
+                cursor.execute(_values_update_sql(len(batch)), params)
+                written += cursor.rowcount
+                self._counters["statements"] += 1
+
+        self._counters["rows_written"] += written
+        return written
+
+    def stop(self, flush=True):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if flush:
+            self.flush()
+
+    def stats(self):
+        report = {"tracked": len(self._latest), "pending": len(self._dirty)}
+        report.update(self._counters)
+        pings = self._counters["pings"]
+        report["rows_per_ping"] = round(self._counters["rows_written"] / pings, 4) if pings else 0.0
+        return report
+
+
+driver_locations = DriverLocationState(
+    flush_interval=getattr(settings, "DRIVER_LOCATION_FLUSH_INTERVAL", 2.0),
+    batch_size=getattr(settings, "DRIVER_LOCATION_BATCH_SIZE", 1000),
+    max_age=getattr(settings, "DRIVER_LOCATION_MAX_AGE_SECONDS", 300),
+)
+
+metrics.register("driver_locations", driver_locations.stats)
+
+atexit.register(driver_locations.stop)
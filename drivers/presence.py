@@ -0,0 +1,232 @@
+import threading
+import time
+
+import h3
+from django.conf import settings
+
+from ride_sharing import metrics
+from ride_sharing.local_redis import get_redis_client
+
+
+DRIVERS_KEY = "presence:drivers"      # hash  driver_id -> cell
+EXPIRY_KEY = "presence:expiry"        # zset  driver_id -> expires_at
+CELL_KEY = "presence:cell:{}"         # set   driver ids in a cell
+BUSY_KEY = "presence:busy"            # zset  driver_id -> busy until
+
+
+class DriverPresenceRegistry:
+    """
+    Online drivers bucketed by H3 cell.
+
+    Drivers heartbeat their current cell; a driver that misses heartbeats
+    for `ttl_seconds` expires out of its bucket. State lives in a
+    redis-compatible client so workers can share it.
+
+    A driver on a ride is marked busy: heartbeats keep them online but out
+    of the cell buckets until the ride ends (or `busy_ttl_seconds` passes,
+    should the end never be recorded), so matching cannot offer them a
+    second ride.
+    """
+
+    def __init__(self, client, ttl_seconds=30, resolution=9, sweep_interval=1.0, busy_ttl_seconds=4 * 3600):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.busy_ttl_seconds = busy_ttl_seconds
+        self.resolution = resolution
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._started_at = time.monotonic()
+        self._counters = {"heartbeats": 0, "inserts": 0, "moves": 0, "expires": 0, "removes": 0,
+                          "busy": 0, "freed": 0}
+
+    def heartbeat(self, driver_id, cell, now=None):
+        """
+        Registers `driver_id` as online in `cell` (coarsened to the registry
+        resolution) until now + ttl. Returns the bucket cell, or None when
+        the driver is busy and was left out of the buckets.
+        """
+        driver_id = str(driver_id)
+        now = time.time() if now is None else now
+
+        if h3.get_resolution(cell) > self.resolution:
+            cell = h3.cell_to_parent(cell, self.resolution)
+
+        with self._lock:
+            if self.is_busy(driver_id, now):
+                self._counters["heartbeats"] += 1
+                return None
+
+            previous = self.client.hget(DRIVERS_KEY, driver_id)
+
+            if previous != cell:
+                if previous:
+                    self.client.srem(CELL_KEY.format(previous), driver_id)
+                    self._counters["moves"] += 1
+                else:
+                    self._counters["inserts"] += 1
+
+                self.client.sadd(CELL_KEY.format(cell), driver_id)
+                self.client.hset(DRIVERS_KEY, driver_id, cell)
+
+            self.client.zadd(EXPIRY_KEY, {driver_id: now + self.ttl_seconds})
+            self._counters["heartbeats"] += 1
+
+        return cell
+
+    def remove(self, driver_id):
+        """
+        Takes a driver offline (or busy) ahead of its TTL
+        """
+        driver_id = str(driver_id)
+
+        with self._lock:
+            if self._drop(driver_id):
+                self._counters["removes"] += 1
+
+    def mark_busy(self, driver_id, now=None):
+        """
+        Takes a driver out of the buckets while they are on a ride;
+        heartbeats do not put them back until `mark_free`
+        """
+        driver_id = str(driver_id)
+        now = time.time() if now is None else now
+
+        with self._lock:
+            self.client.zadd(BUSY_KEY, {driver_id: now + self.busy_ttl_seconds})
+            self._drop(driver_id)
+            self._counters["busy"] += 1
+
+    def mark_free(self, driver_id):
+        """
+        Lets the driver's next heartbeat bucket them again
+        """
+        if self.client.zrem(BUSY_KEY, str(driver_id)):
+            self._counters["freed"] += 1
+
+    def is_busy(self, driver_id, now=None):
+        until = self.client.zscore(BUSY_KEY, str(driver_id))
+        return until is not None and float(until) > (time.time() if now is None else now)
+
+    def _drop(self, driver_id):
+        cell = self.client.hget(DRIVERS_KEY, driver_id)
+        if cell:
+            self.client.srem(CELL_KEY.format(cell), driver_id)
+            self.client.hdel(DRIVERS_KEY, driver_id)
+        self.client.zrem(EXPIRY_KEY, driver_id)
+        return bool(cell)
+
+    def expire(self, now=None):
+        """
+        Drops every driver whose heartbeat is older than the TTL
+        """
+        now = time.time() if now is None else now
+
+        with self._lock:
+            expired = self.client.zrangebyscore(EXPIRY_KEY, "-inf", now)
+            for driver_id in expired:
+                self._drop(driver_id)
+            self.client.zremrangebyscore(BUSY_KEY, "-inf", now)
+
+            self._counters["expires"] += len(expired)
+            self._last_sweep = time.monotonic()
+
+        return len(expired)
+
+    def _sweep_if_due(self):
+        if time.monotonic() - self._last_sweep >= self.sweep_interval:
+            self.expire()
+
+    def cell_of(self, driver_id):
+        self._sweep_if_due()
+        return self.client.hget(DRIVERS_KEY, str(driver_id))
+
+    def drivers_in_cells(self, cells):
+        """
+        Returns {cell: set(driver_ids)} for the non-empty cells in `cells`
+        """
+        self._sweep_if_due()
+
+        found = {}
+        for cell in cells:
+            members = self.client.smembers(CELL_KEY.format(cell))
+            if members:
+                found[cell] = members
+        return found
+
+    def count_in_cells(self, cells):
+        """
+        Online driver count per cell, used as surge supply
+        """
+        self._sweep_if_due()
+        return {cell: self.client.scard(CELL_KEY.format(cell)) for cell in cells}
+
+    def cell_counts(self):
+        """
+        {cell: online drivers} over every non-empty cell, read in one pass
+        over the driver hash
+        """
+        self._sweep_if_due()
+
+        counts = {}
+        for cell in self.client.hgetall(DRIVERS_KEY).values():
+            counts[cell] = counts.get(cell, 0) + 1
+        return counts
+
+    def nearest_drivers(self, cell, limit=10, max_k=3):
+        """
+        Returns [(driver_id, cell, ring)] ordered by grid distance from
+        `cell`, searching ring by ring until `limit` drivers are found
+        """
+        if h3.get_resolution(cell) > self.resolution:
+            cell = h3.cell_to_parent(cell, self.resolution)
+
+        self._sweep_if_due()
+
+        found = []
+        for k in range(max_k + 1):
+            for ring_cell in grid_ring(cell, k):
+                for driver_id in self.client.smembers(CELL_KEY.format(ring_cell)):
+                    found.append((driver_id, ring_cell, k))
+
+            if len(found) >= limit:
+                break
+
+        return found[:limit]
+
+    def __len__(self):
+        return self.client.hlen(DRIVERS_KEY)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        counters = dict(self._counters)
+
+        report = {"online": len(self), "busy_drivers": self.client.zcard(BUSY_KEY)}
+        report.update(counters)
+        report.update({
+            f"{name}_per_sec": round(count / elapsed, 2)
+            for name, count in counters.items()
+        })
+        return report
+
+
+def grid_ring(cell, k):
+    """
+    Cells exactly k steps from `cell`. grid_ring is undefined around
+    pentagons, so fall back to the difference of two disks there.
+    """
+    try:
+        return h3.grid_ring(cell, k)
+    except h3.H3BaseException:
+        inner = set(h3.grid_disk(cell, k - 1)) if k else set()
+        return [c for c in h3.grid_disk(cell, k) if c not in inner]
+
+
+driver_presence = DriverPresenceRegistry(
+    get_redis_client(getattr(settings, "DRIVER_PRESENCE_REDIS_URL", None)),
+    ttl_seconds=getattr(settings, "DRIVER_PRESENCE_TTL_SECONDS", 30),
+    resolution=getattr(settings, "DRIVER_PRESENCE_RESOLUTION", 9),
+    busy_ttl_seconds=getattr(settings, "DRIVER_PRESENCE_BUSY_TTL_SECONDS", 4 * 3600),
+)
+
+metrics.register("driver_presence", driver_presence.stats)
@@ -0,0 +1,39 @@
+import h3
+from rest_framework import serializers
+
+
+class DriverHeartbeatSerializer(serializers.Serializer):
+    driver_id = serializers.UUIDField()
+    h3_index = serializers.CharField(required=False)
+    latitude = serializers.FloatField(required=False)
+    longitude = serializers.FloatField(required=False)
+    available = serializers.BooleanField(default=True)
+
+    def validate(self, data):
+        h3_index = data.get("h3_index")
+
+        if h3_index:
+            if h3_index.isdigit():
+                h3_index = h3.int_to_str(int(h3_index))
+            if not h3.is_valid_cell(h3_index):
+                raise serializers.ValidationError({"h3_index": "Invalid H3 cell"})
+        elif "latitude" in data and "longitude" in data:
+            h3_index = h3.latlng_to_cell(data["latitude"], data["longitude"], 9)
+        else:
+            raise serializers.ValidationError("h3_index or latitude/longitude is required")
+
+        data["h3_index"] = h3_index
+        return data
+
+
+class NearbyDriversSerializer(serializers.Serializer):
+    h3_index = serializers.CharField()
+    limit = serializers.IntegerField(default=10, min_value=1, max_value=100)
+    max_k = serializers.IntegerField(default=3, min_value=0, max_value=10)
+
+    def validate_h3_index(self, value):
+        if value.isdigit():
+            value = h3.int_to_str(int(value))
+        if not h3.is_valid_cell(value):
+            raise serializers.ValidationError("Invalid H3 cell")
+        return value
@@ -1,3 +1,111 @@
-from django.test import TestCase
+import time
+from unittest import mock
 
-# Create your tests here.
+import h3
+from django.test import SimpleTestCase, TestCase
+
+from drivers.locations import DriverLocationState
+from drivers.models import Driver
+from drivers.presence import DriverPresenceRegistry
+from ride_sharing.local_redis import LocalRedis
+from ride_sharing.test_utils import CENTER, make_driver
+
+
+class DriverPresenceTests(SimpleTestCase):
+    def setUp(self):
+        self.presence = DriverPresenceRegistry(LocalRedis(), ttl_seconds=30, busy_ttl_seconds=600)
+
+    def test_heartbeat_buckets_driver(self):
+        self.assertEqual(self.presence.heartbeat("d1", CENTER), CENTER)
+        self.assertEqual(self.presence.drivers_in_cells([CENTER]), {CENTER: {"d1"}})
+
+    def test_heartbeat_moves_driver_between_cells(self):
+        neighbour = h3.grid_ring(CENTER, 1)[0]
+        self.presence.heartbeat("d1", CENTER)
+        self.presence.heartbeat("d1", neighbour)
+
+        self.assertEqual(self.presence.cell_of("d1"), neighbour)
+        self.assertEqual(self.presence.count_in_cells([CENTER, neighbour]), {CENTER: 0, neighbour: 1})
+
+    def test_missed_heartbeats_expire(self):
+        self.presence.heartbeat("d1", CENTER, now=time.time() - 60)
+        self.presence.heartbeat("d2", CENTER)
+
+        self.assertEqual(self.presence.expire(), 1)
+        self.assertEqual(self.presence.drivers_in_cells([CENTER]), {CENTER: {"d2"}})
+        self.assertIsNone(self.presence.cell_of("d1"))
+
+    def test_nearest_drivers_by_ring(self):
+        far = h3.grid_ring(CENTER, 2)[0]
+        self.presence.heartbeat("far", far)
+        self.presence.heartbeat("near", CENTER)
+
+        self.assertEqual(
+            self.presence.nearest_drivers(CENTER, limit=2),
+            [("near", CENTER, 0), ("far", far, 2)],
+        )
+        self.assertEqual(self.presence.nearest_drivers(CENTER, limit=1), [("near", CENTER, 0)])
+
+    def test_busy_driver_stays_out_of_buckets_until_freed(self):
+        self.presence.heartbeat("d1", CENTER)
+        self.presence.mark_busy("d1")
+
+        self.assertIsNone(self.presence.heartbeat("d1", CENTER))
+        self.assertEqual(self.presence.drivers_in_cells([CENTER]), {})
+
+        self.presence.mark_free("d1")
+        self.assertEqual(self.presence.heartbeat("d1", CENTER), CENTER)
+        self.assertEqual(self.presence.drivers_in_cells([CENTER]), {CENTER: {"d1"}})
+
+    def test_busy_mark_expires(self):
+        self.presence.mark_busy("d1", now=100)
+
+        self.assertTrue(self.presence.is_busy("d1", now=699))
+        self.assertEqual(self.presence.heartbeat("d1", CENTER, now=701), CENTER)
+
+
+@mock.patch("drivers.locations.close_old_connections")
+class DriverLocationStateTests(TestCase):
+    def setUp(self):
+        self.state = DriverLocationState(flush_interval=60)
+        self.driver = make_driver()
+
+    def tearDown(self):
+        self.state.stop(flush=False)
+
+    def test_pings_coalesce_into_one_row_write(self, _):
+        neighbour = h3.grid_ring(CENTER, 1)[0]
+        for cell in (CENTER, neighbour, neighbour):
+            self.state.update(self.driver.driver_id, cell, 12.97, 77.59)
+
+        self.assertEqual(self.state.cell_of(self.driver), neighbour)
+        self.assertEqual(self.state.flush(), 1)
+        self.assertEqual(self.state.flush(), 0)
+
+        row = Driver.objects.get(pk=self.driver.pk)
+        self.assertEqual(row.current_h3_index, neighbour)
+        self.assertEqual(row.last_location, "12.97,77.59")
+        self.assertEqual(self.state.stats()["rows_per_ping"], round(1 / 3, 4))
+
+    def test_failed_flush_keeps_only_newer_pings(self, _):
+        neighbour = h3.grid_ring(CENTER, 1)[0]
+        other = make_driver()
+        self.state.update(self.driver.driver_id, neighbour)
+        self.state.update(other.driver_id, neighbour)
+
+        def fail(items):
+            # a ping arriving while the write is in flight
+            self.state.update(other.driver_id, CENTER)
+            raise RuntimeError("database unavailable")
+
+        with mock.patch.object(self.state, "_write", side_effect=fail):
+            with self.assertRaises(RuntimeError):
+                self.state.flush()
+
+        self.assertEqual(self.state.flush(), 2)
+        self.assertEqual(Driver.objects.get(pk=self.driver.pk).current_h3_index, neighbour)
+        self.assertEqual(Driver.objects.get(pk=other.pk).current_h3_index, CENTER)
+
+    def test_unflushed_drivers_fall_back_to_their_row(self, _):
+        self.assertIsNone(self.state.get(self.driver.driver_id))
+        self.assertEqual(self.state.cell_of(self.driver), CENTER)
@@ -0,0 +1,7 @@
+from django.urls import path
+from drivers.views import DriverHeartbeatView, NearbyDriversView
+
+urlpatterns = [
+    path("heartbeat/", DriverHeartbeatView.as_view()),
+    path("nearby/", NearbyDriversView.as_view()),
+]
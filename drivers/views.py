@@ -1,3 +1,46 @@
-from django.shortcuts import render
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from drivers.locations import driver_locations
+from drivers.presence import driver_presence
+from drivers.serializers import DriverHeartbeatSerializer, NearbyDriversSerializer
 
-# Create your views here.
+
+class DriverHeartbeatView(APIView):
+    def post(self, request):
+        serializer = DriverHeartbeatSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        if not data["available"]:
+            driver_presence.remove(data["driver_id"])
+            return Response({"online": False})
+
+        cell = driver_presence.heartbeat(data["driver_id"], data["h3_index"])
+        driver_locations.update(
+            data["driver_id"], data["h3_index"], data.get("latitude"), data.get("longitude")
+        )
+
+        return Response({
+            "online": True,
+            "busy": cell is None,
+            "h3_index": cell,
+            "ttl_seconds": driver_presence.ttl_seconds,
+        })
+
+
+class NearbyDriversView(APIView):
+    def get(self, request):
+        serializer = NearbyDriversSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        drivers = driver_presence.nearest_drivers(
+            data["h3_index"],
+            limit=data["limit"],
+            max_k=data["max_k"]
+        )
+
+        return Response([
+            {"driver_id": driver_id, "h3_index": cell, "ring": ring}
+            for driver_id, cell, ring in drivers
+        ])
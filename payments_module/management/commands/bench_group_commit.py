@@ -0,0 +1,103 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from payments_module.models import RideFareSnapshot
+from ride_sharing.group_commit import GroupCommitWriter
+from rides.models import RideDetailsForRiders
+
+
+def snapshot(ride_id, rider_id):
+    return RideFareSnapshot(
+        ride_id=ride_id,
+        rider_id=rider_id,
+        base_fare=Decimal("30.00"),
+        distance_fare=Decimal("62.50"),
+        time_fare=Decimal("12.00"),
+        surge_multiplier=Decimal("1.0"),
+        tax_amount=Decimal("5.23"),
+        final_fare=Decimal("109.73"),
+        currency="INR",
+    )
+
+
+def insert(instance):
+    """
+    The previous path: one INSERT (and commit) per request
+    """
+    instance.save(force_insert=True)
+    return instance
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares RideFareSnapshot inserts from concurrent requests written one "
+        "per request with the same inserts through a group commit writer. "
+        "Deletes the rows it inserted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=32, help="concurrent requests")
+        parser.add_argument("--rows", type=int, default=200, help="inserts per thread")
+
+    def run(self, save, pairs, threads, rows):
+        saved = [[] for _ in range(threads)]
+        latencies = [[] for _ in range(threads)]
+        start = threading.Barrier(threads + 1)
+
+        def request_loop(worker):
+            start.wait()
+            try:
+                for n in range(rows):
+                    ride_id, rider_id = pairs[(worker * rows + n) % len(pairs)]
+                    began = time.perf_counter()
+                    saved[worker].append(save(snapshot(ride_id, rider_id)).pk)
+                    latencies[worker].append(time.perf_counter() - began)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=request_loop, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        start.wait()
+        began = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - began
+
+        ids = [pk for worker_ids in saved for pk in worker_ids]
+        latencies = sorted(latency for worker_latencies in latencies for latency in worker_latencies)
+        return ids, elapsed, latencies
+
+    def handle(self, *args, **options):
+        pairs = list(RideDetailsForRiders.objects.values_list("ride_id", "rider_id")[:1000])
+        if not pairs:
+            self.stdout.write("need booked rides in the database")
+            return
+
+        threads, rows = options["threads"], options["rows"]
+        writer = GroupCommitWriter(RideFareSnapshot)
+        modes = (("per request", insert), ("group commit", writer.save))
+
+        for name, save in modes:
+            ids, elapsed, latencies = self.run(save, pairs, threads, rows)
+            missing = sum(1 for pk in ids if pk is None)
+            RideFareSnapshot.objects.filter(pk__in=ids).delete()
+
+            self.stdout.write(
+                f"{name:>12}: {len(ids):,} rows from {threads} threads in {elapsed:.2f}s, "
+                f"{len(ids) / elapsed:,.0f} rows/s, "
+                f"p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms"
+                + (f", {missing} without ids" if missing else "")
+            )
+
+        writer.stop()
+        stats = writer.stats()
+        self.stdout.write(
+            f"  group commit: {stats['batches']:,} batches, {stats['rows_per_batch']} rows per batch, "
+            f"largest {stats['largest_batch']}"
+        )
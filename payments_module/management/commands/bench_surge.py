@@ -0,0 +1,65 @@
+import random
+import statistics
+import time
+
+import h3
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from payments_module.surge import SurgeEngine, SurgeGrid
+
+
+class Command(BaseCommand):
+    help = "Times surge recomputes over a synthetic city of H3 cells"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cells", type=int, default=100000)
+        parser.add_argument("--rides", type=int, default=5000, help="open rides in the city")
+        parser.add_argument("--drivers", type=int, default=10000, help="idle online drivers in the city")
+        parser.add_argument("--rounds", type=int, default=20)
+
+    def handle(self, *args, **options):
+        center = h3.latlng_to_cell(12.9716, 77.5946, 9)
+        k = 0
+        while 3 * k * (k + 1) + 1 < options["cells"]:
+            k += 1
+        cells = [h3.str_to_int(cell) for cell in h3.grid_disk(center, k)]
+
+        started = time.perf_counter()
+        grid = SurgeGrid(np.array(cells, dtype=np.uint64), np.zeros(len(cells), dtype=np.int32), ["city"])
+        build_seconds = time.perf_counter() - started
+
+        # demand clusters around a few hotspots; drivers spread out evenly
+        rng = random.Random(0)
+        hotspots = rng.sample(cells, 20)
+        demand_counts, supply_counts = {}, {}
+        for _ in range(options["rides"]):
+            cell = h3.int_to_str(rng.choice(hotspots))
+            cell = rng.choice(h3.grid_disk(cell, 3))
+            demand_counts[cell] = demand_counts.get(cell, 0) + 1
+        for _ in range(options["drivers"]):
+            cell = h3.int_to_str(rng.choice(cells))
+            supply_counts[cell] = supply_counts.get(cell, 0) + 1
+
+        engine = SurgeEngine()
+        table = None
+        timings = []
+        for _ in range(options["rounds"]):
+            started = time.perf_counter()
+            demand = grid.counts(demand_counts, engine.resolution)
+            supply = grid.counts(supply_counts, engine.resolution)
+            table = engine.compute(grid, demand, supply, previous=table)
+            timings.append(time.perf_counter() - started)
+
+        self.stdout.write(
+            f"{len(grid):,} cells (grid built once in {build_seconds:.2f}s), "
+            f"{options['rides']:,} open rides, {options['drivers']:,} idle drivers"
+        )
+        self.stdout.write(
+            f"  recompute p50 {statistics.median(timings) * 1000:.1f} ms, "
+            f"max {max(timings) * 1000:.1f} ms over {options['rounds']} rounds"
+        )
+        self.stdout.write(
+            f"  {int((table.multipliers > 1.0).sum()):,} surging cells, "
+            f"max multiplier {float(table.multipliers.max()):.1f}"
+        )
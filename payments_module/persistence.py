@@ -0,0 +1,26 @@
+import atexit
+
+from django.conf import settings
+
+from payments_module.models import Payment, RideFareSnapshot
+from ride_sharing import metrics
+from ride_sharing.group_commit import GroupCommitWriter
+
+
+def _writer(model):
+    return GroupCommitWriter(
+        model,
+        max_batch=getattr(settings, "GROUP_COMMIT_MAX_BATCH", 500),
+        max_wait=getattr(settings, "GROUP_COMMIT_MAX_WAIT_SECONDS", 0.002),
+        timeout=getattr(settings, "GROUP_COMMIT_TIMEOUT_SECONDS", 10.0),
+    )
+
+
+fare_snapshot_writer = _writer(RideFareSnapshot)
+payment_writer = _writer(Payment)
+
+metrics.register("fare_snapshot_writes", fare_snapshot_writer.stats)
+metrics.register("payment_writes", payment_writer.stats)
+
+atexit.register(fare_snapshot_writer.stop)
+atexit.register(payment_writer.stop)
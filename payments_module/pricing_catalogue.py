@@ -0,0 +1,146 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from payments_module.models import PricingConfig
+from ride_sharing import metrics
+from ride_sharing.local_redis import get_redis_client
+
+
+VERSION_KEY = "pricing_catalogue:version"
+
+
+class PricingCatalogue:
+    """
+    Every PricingConfig row, loaded per worker with one query and indexed
+    by (tenant, region, vehicle_type). A config with no vehicle type is
+    its tenant's default for the region; lookups without a tenant use the
+    most recently updated config across tenants.
+
+    Saves and deletes bump a version counter in a redis-compatible client,
+    the same way region profiles are kept fresh, and the next lookup in
+    any worker sharing the client reloads the catalogue. A catalogue
+    older than `max_age` seconds is reloaded as well, so workers that do
+    not share the counter pick up price changes within that time.
+    """
+
+    def __init__(self, client, max_age=300):
+        self.client = client
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._counters = {"hits": 0, "loads": 0, "not_found": 0, "invalidations": 0, "expirations": 0}
+
+        post_save.connect(self._on_change, sender=PricingConfig, weak=False)
+        post_delete.connect(self._on_change, sender=PricingConfig, weak=False)
+
+    def _on_change(self, sender, **kwargs):
+        self.bump()
+
+    def bump(self):
+        self.client.incr(VERSION_KEY)
+
+    def current_version(self):
+        return int(self.client.get(VERSION_KEY) or 0)
+
+    def _load(self):
+        index = {}
+        vehicle_types = {}     # (tenant, region) -> vehicle types with their own config
+        # oldest first, so the latest config for a key is the one left in the index
+        for config in PricingConfig.objects.order_by("updated_at", "pricing_config_id"):
+            region = str(config.region_id)
+            for tenant in (str(config.tenant_id), None):
+                index[(tenant, region, config.vehicle_type_id)] = config
+                if config.vehicle_type_id is not None:
+                    vehicle_types.setdefault((tenant, region), set()).add(config.vehicle_type_id)
+
+        self._counters["loads"] += 1
+        return index, {key: sorted(types) for key, types in vehicle_types.items()}
+
+    def index(self):
+        """
+        ({(tenant, region, vehicle_type): config}, {(tenant, region): vehicle
+        types}) as of the current version; tenant None is the any-tenant view
+        """
+        version = self.current_version()
+        index = self._index
+        expired = time.monotonic() - self._loaded_at > self.max_age
+        if index is not None and version == self._version and not expired:
+            self._counters["hits"] += 1
+            return index
+
+        index = self._load()
+        with self._lock:
+            if self._version is not None and version != self._version:
+                self._counters["invalidations"] += 1
+            elif self._index is not None:
+                self._counters["expirations"] += 1
+            self._index = index
+            self._version = version
+            self._loaded_at = time.monotonic()
+        return index
+
+    def get(self, region_code, vehicle_type, tenant_id=None):
+        """
+        The PricingConfig for a vehicle type in a region, falling back to
+        the region default; None when neither exists
+        """
+        configs, _ = self.index()
+        tenant = str(tenant_id) if tenant_id is not None else None
+        region = str(region_code)
+
+        config = configs.get((tenant, region, vehicle_type)) or configs.get((tenant, region, None))
+        if config is None:
+            self._counters["not_found"] += 1
+        return config
+
+    def for_region(self, region_code, vehicle_types=None, tenant_id=None):
+        """
+        {vehicle_type: PricingConfig} for the given vehicle types (those
+        with no config and no region default are left out), or for every
+        vehicle type with its own config in the region
+        """
+        if vehicle_types is None:
+            tenant = str(tenant_id) if tenant_id is not None else None
+            vehicle_types = self.index()[1].get((tenant, str(region_code)), [])
+
+        rates = {}
+        for vehicle_type in vehicle_types:
+            config = self.get(region_code, vehicle_type, tenant_id)
+            if config is not None:
+                rates[vehicle_type] = config
+        return rates
+
+    def region_configs(self, region_code):
+        """
+        Every config in a region, one per tenant and vehicle type
+        """
+        region = str(region_code)
+        configs = [
+            config for (tenant, key_region, _), config in self.index()[0].items()
+            if tenant is not None and key_region == region
+        ]
+        return sorted(configs, key=lambda config: config.pricing_config_id)
+
+    def stats(self):
+        # a hit is a lookup served without reloading the catalogue
+        lookups = self._counters["hits"] + self._counters["loads"]
+        report = {
+            "configs": len({config.pricing_config_id for config in (self._index or ({}, {}))[0].values()}),
+            "version": self._version,
+            "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else None,
+        }
+        report.update(self._counters)
+        return report
+
+
+pricing_catalogue = PricingCatalogue(
+    get_redis_client(getattr(settings, "PRICING_CATALOGUE_REDIS_URL", None)),
+    max_age=getattr(settings, "PRICING_CATALOGUE_MAX_AGE_SECONDS", 300),
+)
+
+metrics.register("pricing_catalogue", pricing_catalogue.stats)
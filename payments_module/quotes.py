@@ -0,0 +1,165 @@
+from decimal import Decimal
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+from payments_module.surge import surge_engine
+from payments_module.surge_windows import NO_SURGE, surge_windows
+
+
+DEFAULT_MINOR_DIGITS = 2
+
+
+class FareQuotes(NamedTuple):
+    """
+    Fares for N trips x M vehicle types. Every amount array is (N, M) int64
+    in minor units (`digits` decimal places); final = subtotal + tax for
+    tax-exclusive regions and final = subtotal (tax included) otherwise.
+    """
+    vehicle_types: List[int]
+    currency: str
+    digits: int
+    surge_multiplier: Decimal
+    tax_percent: Optional[Decimal]
+    base_fare: np.ndarray
+    distance_fare: np.ndarray
+    time_fare: np.ndarray
+    tax_amount: np.ndarray
+    final_fare: np.ndarray
+
+    def amount(self, minor):
+        return Decimal(int(minor)).scaleb(-self.digits)
+
+    def breakdown(self, trip, column):
+        """
+        The quote for one trip and vehicle type, as Decimals
+        """
+        return {
+            "vehicle_type": self.vehicle_types[column],
+            "base_fare": self.amount(self.base_fare[trip, column]),
+            "distance_fare": self.amount(self.distance_fare[trip, column]),
+            "time_fare": self.amount(self.time_fare[trip, column]),
+            "surge_multiplier": self.surge_multiplier,
+            "tax_amount": self.amount(self.tax_amount[trip, column]),
+            "final_fare": self.amount(self.final_fare[trip, column]),
+        }
+
+    def formatted(self, minor):
+        """
+        An (N, M) minor-unit array as nested lists of decimal strings,
+        which is how DRF renders Decimals, without building one per amount
+        """
+        if self.digits == 0:
+            return minor.astype(str).tolist()
+
+        units, cents = np.divmod(np.abs(minor), 10 ** self.digits)
+        sign = np.where(minor < 0, "-", "")
+        return np.char.add(
+            np.char.add(sign, units.astype(str)),
+            np.char.add(".", np.char.zfill(cents.astype(str), self.digits)),
+        ).tolist()
+
+    def rows(self):
+        """
+        One list per trip of one quote dict per vehicle type
+        """
+        surge = str(self.surge_multiplier)
+        columns = [
+            self.formatted(array) for array in
+            (self.base_fare, self.distance_fare, self.time_fare, self.tax_amount, self.final_fare)
+        ]
+        return [
+            [
+                {
+                    "vehicle_type": vehicle_type,
+                    "base_fare": base,
+                    "distance_fare": distance,
+                    "time_fare": time,
+                    "surge_multiplier": surge,
+                    "tax_amount": tax,
+                    "final_fare": final,
+                }
+                for vehicle_type, base, distance, time, tax, final
+                in zip(self.vehicle_types, *trip)
+            ]
+            for trip in zip(*columns)
+        ]
+
+
+def minor_digits(minor_unit):
+    """
+    Decimal places of a currency from Country.minor_unit ("2", "0", ...)
+    """
+    minor_unit = str(minor_unit or "").strip()
+    return int(minor_unit) if minor_unit.isdigit() else DEFAULT_MINOR_DIGITS
+
+
+def to_minor(values, digits):
+    """
+    Float amounts to int64 minor units, rounding half up. The amounts are
+    first rounded to 6 places so float noise (2.675 held as 2.67499...)
+    cannot decide which way a half rounds.
+    """
+    scaled = np.round(np.asarray(values, dtype=np.float64) * 10 ** digits, 6)
+    return np.floor(scaled + 0.5).astype(np.int64)
+
+
+def surge_for(profile, pickup_cell=None, at=None):
+    """
+    The surge multiplier for a pickup in the region of `profile`: a
+    SurgePricing window in force overrides the surge engine; otherwise a
+    surge-enabled region prices at the engine's multiplier for the pickup
+    cell, and everything else at 1.0
+    """
+    window = surge_windows.window(profile.region_code, at)
+    if window is not None:
+        return window.surge_multiplier
+    if pickup_cell is None or not profile.is_surge_enabled:
+        return NO_SURGE
+    return Decimal(f"{surge_engine.multiplier(pickup_cell, at):.1f}")
+
+
+def quote_fares(profile, distances_km, durations_min, rates, at=None, pickup_cell=None, surge=None):
+    """
+    Prices every trip (distance, duration) for every vehicle type in
+    `rates` ({vehicle_type: PricingConfig}) in one pass: (base + per-km +
+    per-minute) x the surge (`surge`, or `surge_for` the pickup), plus tax
+    from the region profile. Floats are only used between the Decimal
+    inputs and the minor-unit rounding at the end.
+    """
+    configs = list(rates.values())
+    digits = minor_digits(profile.minor_unit)
+    if surge is None:
+        surge = surge_for(profile, pickup_cell, at)
+
+    distances = np.asarray(distances_km, dtype=np.float64)[:, None]
+    durations = np.asarray(durations_min, dtype=np.float64)[:, None]
+    base = np.array([float(c.base_fare) for c in configs], dtype=np.float64)[None, :]
+    per_km = np.array([float(c.rate_per_km) for c in configs], dtype=np.float64)[None, :]
+    per_min = np.array([float(c.rate_per_min) for c in configs], dtype=np.float64)[None, :]
+
+    base_fare = np.broadcast_to(base, (len(distances), len(configs)))
+    distance_fare = distances * per_km
+    time_fare = durations * per_min
+    subtotal = (base_fare + distance_fare + time_fare) * float(surge)
+
+    rate = float(profile.tax_percent or 0) / 100
+    if str(profile.tax_model).lower() == "inclusive":
+        final_fare = to_minor(subtotal, digits)
+        tax_amount = to_minor(subtotal - subtotal / (1 + rate), digits)
+    else:
+        tax_amount = to_minor(subtotal * rate, digits)
+        final_fare = to_minor(subtotal, digits) + tax_amount
+
+    return FareQuotes(
+        vehicle_types=list(rates),
+        currency=profile.currency_code,
+        digits=digits,
+        surge_multiplier=surge,
+        tax_percent=profile.tax_percent,
+        base_fare=to_minor(base_fare, digits),
+        distance_fare=to_minor(distance_fare, digits),
+        time_fare=to_minor(time_fare, digits),
+        tax_amount=tax_amount,
+        final_fare=final_fare,
+    )
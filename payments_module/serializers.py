@@ -1,5 +1,12 @@
+import numpy as np
+from django.conf import settings
 from rest_framework import serializers
 from payments_module.models import Payment, PaymentGatewayEvent,PricingConfig, SurgePricing, Settlement, RideFareSnapshot
+from payments_module.persistence import payment_writer
+from payments_module.pricing_catalogue import pricing_catalogue
+from rides.models import Region
+from rides.region_profiles import region_profiles
+from rides.serializers import BookRideSerializer
 
 class PaymentCreateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -14,6 +21,9 @@ class PaymentCreateSerializer(serializers.ModelSerializer):
             "payment_method"
         ]
 
+    def create(self, validated_data):
+        return payment_writer.save(Payment(**validated_data))
+
 
 class PaymentStatusSerializer(serializers.ModelSerializer):
     payment_status = serializers.CharField(source="payment_status.status_name")
@@ -54,6 +64,60 @@ class FareCalculateSerializer(serializers.Serializer):
     duration_min = serializers.DecimalField(max_digits=10, decimal_places=4)
     region_id = serializers.UUIDField()
     vehicle_type = serializers.IntegerField()
+    tenant_id = serializers.UUIDField(required=False)
+    from_location = serializers.IntegerField(required=False)    # pickup cell; the ride's when left out
+
+class FareQuoteSerializer(serializers.Serializer):
+    region_id = serializers.UUIDField()
+    tenant_id = serializers.UUIDField(required=False)
+    from_location = serializers.IntegerField(required=False)    # pickup cell shared by the trips
+    vehicle_types = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+    trips = serializers.ListField(child=serializers.DictField(), allow_empty=False)
+
+    def validate_trips(self, trips):
+        """
+        [{"distance_km", "duration_min"}, ...] as two float arrays
+        """
+        max_trips = getattr(settings, "FARE_QUOTE_MAX_TRIPS", 5000)
+        if len(trips) > max_trips:
+            raise serializers.ValidationError(f"At most {max_trips} trips per request")
+
+        try:
+            values = np.array(
+                [(trip["distance_km"], trip["duration_min"]) for trip in trips], dtype=np.float64
+            )
+        except (KeyError, TypeError, ValueError):
+            raise serializers.ValidationError("Each trip needs numeric distance_km and duration_min")
+        if not np.isfinite(values).all() or (values < 0).any():
+            raise serializers.ValidationError("Distances and durations must be non-negative numbers")
+        return values[:, 0], values[:, 1]
+
+    def validate(self, data):
+        try:
+            data["region_profile"] = region_profiles.get(data["region_id"])
+        except Region.DoesNotExist:
+            raise serializers.ValidationError({"region_id": "Unknown region"})
+
+        rates = pricing_catalogue.for_region(
+            data["region_id"], data.get("vehicle_types"), data.get("tenant_id")
+        )
+        missing = set(data.get("vehicle_types", ())) - set(rates)
+        if missing:
+            raise serializers.ValidationError(
+                {"vehicle_types": f"No pricing for vehicle types {sorted(missing)}"}
+            )
+        if not rates:
+            raise serializers.ValidationError({"region_id": "Region has no pricing"})
+
+        data["rates"] = rates
+        return data
+
+
+class UpfrontFareSerializer(BookRideSerializer):
+    user_id = None
+    tenant_id = serializers.UUIDField(required=False)
+    vehicle_types = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+
 
 class RideFareSnapshotSerializer(serializers.ModelSerializer):
     class Meta:
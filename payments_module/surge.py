@@ -0,0 +1,351 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import NamedTuple
+
+import h3
+import numpy as np
+from h3.api import numpy_int as h3_int
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from drivers.presence import driver_presence
+from ride_sharing import metrics
+from ride_sharing.local_redis import is_local_url
+from rides.geofence import geofences
+from rides.models import Region
+from rides.spatial_index import open_ride_index, to_h3_cell
+
+logger = logging.getLogger(__name__)
+
+
+class SurgeGrid:
+    """
+    The cells surge is computed over: every cell of every surge-enabled
+    region's geofence, sorted, with each cell's region and the ids of its
+    six neighbours (-1 outside the grid) precomputed once per load.
+    """
+
+    def __init__(self, cells, region_ids, regions):
+        order = np.argsort(cells)
+        self.cells = np.asarray(cells, dtype=np.uint64)[order]
+        self.region_ids = np.asarray(region_ids, dtype=np.int32)[order]
+        self.regions = list(regions)
+        self.neighbours = self._neighbour_ids()
+
+    @classmethod
+    def for_regions(cls, region_codes):
+        cells, region_ids, regions = [], [], []
+        for region_code in region_codes:
+            region_cells = geofences.cells_of(region_code)
+            if not len(region_cells):
+                continue
+            cells.append(region_cells)
+            region_ids.append(np.full(len(region_cells), len(regions), dtype=np.int32))
+            regions.append(str(region_code))
+
+        if not cells:
+            return cls(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int32), [])
+        return cls(np.concatenate(cells), np.concatenate(region_ids), regions)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def ids(self, cell_ints):
+        """
+        Grid ids for uint64 cell ints, -1 for cells outside the grid
+        """
+        cell_ints = np.asarray(cell_ints, dtype=np.uint64)
+        if not len(self.cells):
+            return np.full(len(cell_ints), -1, dtype=np.int64)
+
+        ids = np.searchsorted(self.cells, cell_ints)
+        ids[ids >= len(self.cells)] = 0
+        return np.where(self.cells[ids] == cell_ints, ids, -1)
+
+    def _neighbour_ids(self):
+        neighbours = np.full((len(self.cells), 6), -1, dtype=np.int64)
+        if not len(self.cells):
+            return neighbours
+
+        # pentagons have five neighbours; the sixth slot stays 0, outside the grid
+        rings = np.zeros((len(self.cells), 6), dtype=np.uint64)
+        for row, cell in enumerate(self.cells.tolist()):
+            disk = h3_int.grid_disk(cell, 1)
+            ring = disk[disk != cell]
+            rings[row, :len(ring)] = ring
+
+        neighbours[:] = self.ids(rings.ravel()).reshape(rings.shape)
+        return neighbours
+
+    def counts(self, cell_counts, resolution):
+        """
+        {cell: count} (any resolution at or finer than `resolution`) as a
+        dense float array over the grid; cells outside it are ignored
+        """
+        dense = np.zeros(len(self.cells), dtype=np.float64)
+        if not cell_counts:
+            return dense
+
+        ints, values = [], []
+        for cell, count in cell_counts.items():
+            cell = to_h3_cell(cell, resolution)
+            if cell is not None:
+                ints.append(h3.str_to_int(cell))
+                values.append(count)
+
+        ids = self.ids(np.array(ints, dtype=np.uint64))
+        inside = ids >= 0
+        np.add.at(dense, ids[inside], np.asarray(values, dtype=np.float64)[inside])
+        return dense
+
+
+class SurgeTable(NamedTuple):
+    grid: SurgeGrid
+    multipliers: np.ndarray           # float32, one per grid cell
+    demand: np.ndarray
+    supply: np.ndarray
+    effective_from: object
+    expires_at: object
+
+
+class SurgeEngine:
+    """
+    Surge multipliers per H3 cell from open BOOKED rides (demand, from the
+    open ride index) and idle online drivers (supply, from driver
+    presence), over every cell of every surge-enabled region.
+
+    Each recompute is a handful of numpy passes over the whole grid:
+    demand and supply are blended with their neighbours'
+    (`neighbour_weight`), the demand/supply ratio above `threshold` raises
+    the multiplier by `sensitivity` per unit, capped at `cap`, then it is
+    smoothed against the previous table (`alpha`), limited to `max_step`
+    per recompute and rounded to 0.1. Tables are valid for `ttl_seconds`;
+    a cell with no current table prices at 1.0.
+
+    The grid is rebuilt when the geofence version changes (any worker's
+    Region save bumps it) and once it is `grid_max_age` seconds old; a
+    rebuild that yields the same cells keeps the old grid, so smoothing
+    carries on across it.
+
+    Nothing is computed until `start()`, which the WSGI and ASGI entry
+    points call when SURGE_ENGINE_ENABLED is set, so management commands
+    and tests never run the recompute thread by accident. Supply comes
+    from driver presence, so `start()` refuses to run on an in-process
+    registry: each worker would only count the drivers whose heartbeats
+    it happened to receive.
+    """
+
+    def __init__(
+        self,
+        resolution=9,
+        interval=30.0,
+        ttl_seconds=90,
+        threshold=1.0,
+        sensitivity=0.5,
+        cap=3.0,
+        alpha=0.5,
+        max_step=0.5,
+        neighbour_weight=0.5,
+        grid_max_age=300,
+    ):
+        self.resolution = resolution
+        self.interval = interval
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.sensitivity = sensitivity
+        self.cap = cap
+        self.alpha = alpha
+        self.max_step = max_step
+        self.neighbour_weight = neighbour_weight
+        self.grid_max_age = grid_max_age
+        self._lock = threading.Lock()
+        self._grid = None
+        self._grid_version = None
+        self._grid_loaded_at = 0.0
+        self._table = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            "recomputes": 0, "failed": 0, "grid_loads": 0, "last_compute_ms": 0.0, "max_compute_ms": 0.0,
+        }
+
+    def grid(self):
+        version = geofences.current_version()
+        grid = self._grid
+        if (
+            grid is not None
+            and version == self._grid_version
+            and time.monotonic() - self._grid_loaded_at <= self.grid_max_age
+        ):
+            return grid
+
+        enabled = {
+            str(code) for code in
+            Region.objects.filter(is_surge_enabled=True).values_list("region_code", flat=True)
+        }
+        loaded = SurgeGrid.for_regions([code for code in geofences.regions() if code in enabled])
+        if grid is None or loaded.regions != grid.regions or not np.array_equal(loaded.cells, grid.cells):
+            grid = loaded
+
+        with self._lock:
+            self._grid = grid
+            self._grid_version = version
+            self._grid_loaded_at = time.monotonic()
+            self._counters["grid_loads"] += 1
+        return grid
+
+    def _blend(self, values, grid):
+        padded = np.append(values, 0.0)
+        return values + self.neighbour_weight * padded[grid.neighbours].sum(axis=1)
+
+    def compute(self, grid, demand, supply, previous=None, now=None):
+        """
+        A SurgeTable for dense demand and supply arrays over `grid`
+        """
+        now = timezone.now() if now is None else now
+
+        demand_blend = self._blend(demand, grid)
+        supply_blend = self._blend(supply, grid)
+
+        ratio = demand_blend / np.maximum(supply_blend, 1.0)
+        target = np.clip(1.0 + self.sensitivity * (ratio - self.threshold), 1.0, self.cap)
+
+        if previous is not None and previous.grid is grid:
+            last = previous.multipliers.astype(np.float64)
+            smoothed = self.alpha * target + (1.0 - self.alpha) * last
+            target = last + np.clip(smoothed - last, -self.max_step, self.max_step)
+        else:
+            target = np.minimum(target, 1.0 + self.max_step)
+
+        multipliers = (np.round(target * 10) / 10).astype(np.float32)
+
+        return SurgeTable(
+            grid=grid,
+            multipliers=multipliers,
+            demand=demand,
+            supply=supply,
+            effective_from=now,
+            expires_at=now + timedelta(seconds=self.ttl_seconds),
+        )
+
+    def recompute(self):
+        """
+        Counts demand and supply now and publishes a new table
+        """
+        started = time.perf_counter()
+        grid = self.grid()
+
+        demand = grid.counts(open_ride_index.cell_counts(), self.resolution)
+        supply = grid.counts(driver_presence.cell_counts(), self.resolution)
+        table = self.compute(grid, demand, supply, previous=self._table)
+
+        with self._lock:
+            self._table = table
+
+        elapsed = round((time.perf_counter() - started) * 1000, 2)
+        self._counters["recomputes"] += 1
+        self._counters["last_compute_ms"] = elapsed
+        self._counters["max_compute_ms"] = max(self._counters["max_compute_ms"], elapsed)
+        return table
+
+    def current(self, at=None):
+        """
+        The table in effect at `at` (now by default), or None
+        """
+        table = self._table
+        at = timezone.now() if at is None else at
+        if table is None or not (table.effective_from <= at < table.expires_at):
+            return None
+        return table
+
+    def multiplier(self, cell, at=None):
+        """
+        Surge multiplier for a pickup cell, 1.0 outside surge regions or
+        when no table is in effect
+        """
+        table = self.current(at)
+        cell = to_h3_cell(cell, self.resolution)
+        if table is None or cell is None:
+            return 1.0
+
+        row = table.grid.ids([h3.str_to_int(cell)])[0]
+        return float(table.multipliers[row]) if row >= 0 else 1.0
+
+    def region_multipliers(self, at=None):
+        """
+        {region_code: demand-weighted mean multiplier} from the current table
+        """
+        table = self.current(at)
+        if table is None or not len(table.grid):
+            return {}
+
+        grid = table.grid
+        weights = np.bincount(grid.region_ids, weights=table.demand, minlength=len(grid.regions))
+        weighted = np.bincount(
+            grid.region_ids, weights=table.demand * table.multipliers, minlength=len(grid.regions)
+        )
+        means = np.divide(weighted, weights, out=np.ones(len(grid.regions)), where=weights > 0)
+        return {region: round(float(mean), 2) for region, mean in zip(grid.regions, means)}
+
+    def start(self):
+        """
+        Starts recomputing every `interval` seconds on a background thread
+        """
+        # heartbeats land in whichever worker the driver hit; an in-process registry undercounts supply
+        if is_local_url(getattr(settings, "DRIVER_PRESENCE_REDIS_URL", None)):
+            raise ImproperlyConfigured(
+                "the surge engine needs DRIVER_PRESENCE_REDIS_URL pointing at a redis shared by every worker"
+            )
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="surge-engine", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.recompute()
+            except Exception:
+                self._counters["failed"] += 1
+                logger.exception("surge recompute failed")
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        table = self._table
+        report = {"cells": len(table.grid) if table else 0}
+        if table is not None and len(table.grid):
+            report["surging_cells"] = int((table.multipliers > 1.0).sum())
+            report["max_multiplier"] = float(table.multipliers.max())
+            report["expires_at"] = table.expires_at.isoformat()
+        report.update(self._counters)
+        return report
+
+
+surge_engine = SurgeEngine(
+    resolution=getattr(settings, "SURGE_RESOLUTION", 9),
+    interval=getattr(settings, "SURGE_RECOMPUTE_SECONDS", 30.0),
+    ttl_seconds=getattr(settings, "SURGE_TTL_SECONDS", 90),
+    threshold=getattr(settings, "SURGE_THRESHOLD", 1.0),
+    sensitivity=getattr(settings, "SURGE_SENSITIVITY", 0.5),
+    cap=getattr(settings, "SURGE_CAP", 3.0),
+    alpha=getattr(settings, "SURGE_SMOOTHING", 0.5),
+    max_step=getattr(settings, "SURGE_MAX_STEP", 0.5),
+    neighbour_weight=getattr(settings, "SURGE_NEIGHBOUR_WEIGHT", 0.5),
+    grid_max_age=getattr(settings, "SURGE_GRID_MAX_AGE_SECONDS", 300),
+)
+
+metrics.register("surge", surge_engine.stats)
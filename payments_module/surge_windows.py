@@ -0,0 +1,171 @@
+import heapq
+import threading
+import time
+from bisect import bisect_right
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from payments_module.models import SurgePricing
+from ride_sharing import metrics
+
+
+NO_SURGE = Decimal("1.0")
+
+
+class SurgeTimeline:
+    """
+    One region's surge windows flattened into consecutive segments, each
+    holding the window in force over it (the newest row when windows
+    overlap) or None. "Which window applies at T" is a binary search over
+    the segment starts.
+    """
+
+    def __init__(self, windows):
+        self.windows = sorted(windows, key=lambda w: (w.effective_from, w.surge_pricing_id))
+        self.starts, self.winners = self._segments(self.windows)
+        self.first_expiry = min((w.expires_at for w in self.windows), default=None)
+
+    @staticmethod
+    def _segments(windows):
+        points = sorted({w.effective_from for w in windows} | {w.expires_at for w in windows})
+        starts, winners = [], []
+        active = []            # heap of (-surge_pricing_id, window)
+        pending = iter(windows)
+        upcoming = next(pending, None)
+
+        for point in points:
+            while upcoming is not None and upcoming.effective_from <= point:
+                heapq.heappush(active, (-upcoming.surge_pricing_id, id(upcoming), upcoming))
+                upcoming = next(pending, None)
+            # the newest window may have ended; anything under it is checked as it surfaces
+            while active and active[0][2].expires_at <= point:
+                heapq.heappop(active)
+
+            winner = active[0][2] if active else None
+            if winners and winners[-1] is winner:
+                continue
+            starts.append(point)
+            winners.append(winner)
+
+        return starts, winners
+
+    def at(self, when):
+        index = bisect_right(self.starts, when) - 1
+        return self.winners[index] if index >= 0 else None
+
+    def prune(self, now):
+        """
+        The timeline without windows that expired before `now`, or self if
+        none did
+        """
+        live = [w for w in self.windows if w.expires_at > now]
+        return self if len(live) == len(self.windows) else SurgeTimeline(live)
+
+
+class SurgeWindowIndex:
+    """
+    Active and upcoming SurgePricing windows per region, in memory.
+
+    A region's windows are read once (and again after `max_age` seconds,
+    to pick up rows written by other workers); after that a window comes
+    into force at its effective_from and lapses at its expires_at without
+    any query. Saves through the ORM update the region's timeline in
+    place once their transaction commits.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._timelines = {}       # region_code -> (loaded_at, SurgeTimeline)
+        self._counters = {"lookups": 0, "loads": 0, "updates": 0}
+
+        post_save.connect(self._on_save, sender=SurgePricing, weak=False)
+        post_delete.connect(self._on_delete, sender=SurgePricing, weak=False)
+
+    def _on_save(self, sender, instance, **kwargs):
+        # a window saved in a transaction that rolls back must never price a fare
+        transaction.on_commit(lambda: self.add(instance))
+
+    def _on_delete(self, sender, instance, **kwargs):
+        transaction.on_commit(lambda: self.invalidate(instance.region_id))
+
+    def invalidate(self, region_code=None):
+        with self._lock:
+            if region_code is None:
+                self._timelines.clear()
+            else:
+                self._timelines.pop(str(region_code), None)
+
+    def _load(self, region_code):
+        windows = list(
+            SurgePricing.objects.filter(region_id=region_code, expires_at__gt=timezone.now())
+        )
+        timeline = SurgeTimeline(windows)
+        with self._lock:
+            self._timelines[str(region_code)] = (time.monotonic(), timeline)
+        self._counters["loads"] += 1
+        return timeline
+
+    def timeline(self, region_code):
+        entry = self._timelines.get(str(region_code))
+        if entry is None or time.monotonic() - entry[0] > self.max_age:
+            return self._load(region_code)
+        return entry[1]
+
+    def add(self, window):
+        """
+        Puts a new or edited window into its region's timeline, if loaded
+        """
+        key = str(window.region_id)
+        with self._lock:
+            entry = self._timelines.get(key)
+            if entry is None:
+                return
+
+            loaded_at, timeline = entry
+            others = [
+                w for w in timeline.prune(timezone.now()).windows
+                if w.surge_pricing_id != window.surge_pricing_id
+            ]
+            self._timelines[key] = (loaded_at, SurgeTimeline(others + [window]))
+            self._counters["updates"] += 1
+
+    def window(self, region_code, at=None):
+        """
+        The SurgePricing row in force for `region_code` at `at` (now by
+        default), or None
+        """
+        now = timezone.now()
+        at = now if at is None else at
+        timeline = self.timeline(region_code)
+        self._counters["lookups"] += 1
+
+        window = timeline.at(at)
+        if timeline.first_expiry is not None and timeline.first_expiry <= now:
+            # drop lapsed windows so the timeline stays as small as what is left
+            with self._lock:
+                entry = self._timelines.get(str(region_code))
+                if entry is not None and entry[1] is timeline:
+                    self._timelines[str(region_code)] = (entry[0], timeline.prune(now))
+        return window
+
+    def multiplier(self, region_code, at=None):
+        window = self.window(region_code, at)
+        return window.surge_multiplier if window is not None else NO_SURGE
+
+    def stats(self):
+        report = {
+            "regions": len(self._timelines),
+            "windows": sum(len(timeline.windows) for _, timeline in self._timelines.values()),
+        }
+        report.update(self._counters)
+        return report
+
+
+surge_windows = SurgeWindowIndex(max_age=getattr(settings, "SURGE_WINDOWS_MAX_AGE_SECONDS", 60))
+
+metrics.register("surge_windows", surge_windows.stats)
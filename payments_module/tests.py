@@ -1,3 +1,478 @@
-from django.test import TestCase
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import h3
+import numpy as np
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DataError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from authentication.models import Tenant
+from drivers.presence import DriverPresenceRegistry
+from drivers.models import VehicleType
+from payments_module.models import Payment, PricingConfig, RideFareSnapshot, SurgePricing
+from payments_module.pricing_catalogue import PricingCatalogue
+from payments_module.quotes import quote_fares, surge_for, to_minor
+from payments_module.surge import SurgeEngine, SurgeGrid
+from payments_module.surge_windows import SurgeTimeline, SurgeWindowIndex
+from payments_module.upfront_fares import UpfrontFareCache
+from ride_sharing.group_commit import GroupCommitTimeout, GroupCommitWriter, _Pending
+from ride_sharing.local_redis import LocalRedis
+from ride_sharing.test_utils import CENTER, cell_int, make_driver, make_lookups, make_region, make_ride
+from rides.geofence import GeofenceIndex
+from rides.models import Region
+from rides.region_profiles import RegionProfile, region_profiles
+from rides.spatial_index import OpenRideIndex
+
+
+def rates(base="30", per_km="10", per_min="1"):
+    return {1: PricingConfig(base_fare=Decimal(base), rate_per_km=Decimal(per_km), rate_per_min=Decimal(per_min))}
+
+
+def make_pricing(region, base_fare="30"):
+    return PricingConfig.objects.create(
+        tenant=Tenant.objects.create(tenant_name="test"),
+        region=region,
+        vehicle_type=VehicleType.objects.create(vehicle_name="Auto", vehicle_category="auto"),
+        base_fare=Decimal(base_fare), rate_per_km=Decimal("10"), rate_per_min=Decimal("1"),
+    )
+
+
+def profile(tax_model="GST", tax_percent="5", minor_unit="2"):
+    return RegionProfile(
+        region=Region(region_code=uuid.uuid4()), currency_code="INR", currency_symbol="Rs",
+        minor_unit=minor_unit, timezone="Asia/Kolkata", tax_model=tax_model,
+        tax_percent=Decimal(tax_percent), is_surge_enabled=False, is_service_active=True, version=0,
+    )
+
+
+class QuoteFaresTests(SimpleTestCase):
+    def test_every_trip_is_priced_for_every_vehicle_type(self):
+        two_types = {**rates(), 2: rates("50", "15", "2")[1]}
+        quotes = quote_fares(profile(), [1, 10], [5, 20], two_types, surge=Decimal("1.5"))
+
+        self.assertEqual(quotes.vehicle_types, [1, 2])
+        self.assertEqual(quotes.final_fare.shape, (2, 2))
+        # (50 + 150 + 40) x 1.5 = 360, plus 5% tax
+        self.assertEqual(quotes.breakdown(1, 1)["final_fare"], Decimal("378.00"))
+        self.assertEqual(quotes.breakdown(1, 1)["tax_amount"], Decimal("18.00"))
+        self.assertEqual(quotes.breakdown(0, 0)["base_fare"], Decimal("30.00"))
+
+    def test_inclusive_tax_is_carved_out_of_the_fare(self):
+        quotes = quote_fares(profile(tax_model="inclusive"), [10], [20], rates(), surge=Decimal("1.0"))
+
+        self.assertEqual(quotes.breakdown(0, 0)["final_fare"], Decimal("150.00"))
+        self.assertEqual(quotes.breakdown(0, 0)["tax_amount"], Decimal("7.14"))
+
+    def test_minor_units_round_half_up_without_float_noise(self):
+        self.assertEqual(to_minor([2.675, 2.665, -0.005], 2).tolist(), [268, 267, 0])
+
+        quotes = quote_fares(profile(minor_unit="0", tax_percent="0"), [0.5], [0], rates("0", "1", "0"),
+                             surge=Decimal("1.0"))
+        self.assertEqual(quotes.breakdown(0, 0)["final_fare"], Decimal("1"))
+
+    def test_rows_render_amounts_as_decimal_strings(self):
+        quotes = quote_fares(profile(), [10], [20], rates(), surge=Decimal("1.0"))
+
+        self.assertEqual(quotes.rows(), [[{
+            "vehicle_type": 1, "base_fare": "30.00", "distance_fare": "100.00", "time_fare": "20.00",
+            "surge_multiplier": "1.0", "tax_amount": "7.50", "final_fare": "157.50",
+        }]])
+
+    def test_invalid_trips_are_rejected_before_pricing(self):
+        response = self.client.post(
+            "/payments/pricing/quote/",
+            {"region_id": str(uuid.uuid4()), "trips": [{"distance_km": -1, "duration_min": 5}]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("trips", response.json())
+
+
+class SurgeQuoteTests(TestCase):
+    def setUp(self):
+        self.region = make_region(is_surge_enabled=True)
+        self.profile = region_profiles.get(self.region.region_code)
+
+        # demand four times the supply at the pickup: 1.0 + 0.5 x (4 - 1), capped by the first step
+        self.engine = SurgeEngine(neighbour_weight=0.0, max_step=1.0)
+        grid = SurgeGrid(np.array([cell_int()], dtype=np.uint64), [0], [str(self.region.region_code)])
+        self.engine._table = self.engine.compute(grid, np.array([4.0]), np.array([1.0]))
+        patcher = mock.patch("payments_module.quotes.surge_engine", self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_engine_prices_the_pickup_cell(self):
+        self.assertEqual(surge_for(self.profile, CENTER), Decimal("2.0"))
+        self.assertEqual(surge_for(self.profile, cell_int()), Decimal("2.0"))
+        self.assertEqual(surge_for(self.profile), Decimal("1.0"))
+
+        quotes = quote_fares(self.profile, [10], [20], rates(), pickup_cell=CENTER)
+        self.assertEqual(quotes.surge_multiplier, Decimal("2.0"))
+        self.assertEqual(quotes.breakdown(0, 0)["final_fare"], Decimal("315.00"))      # 150 x 2 + 5% tax
+
+    def test_surge_windows_override_the_engine(self):
+        now = timezone.now()
+        SurgePricing.objects.create(
+            region=self.region, surge_multiplier=Decimal("1.5"),
+            effective_from=now - timedelta(minutes=1), expires_at=now + timedelta(hours=1),
+        )
+        self.assertEqual(surge_for(self.profile, CENTER), Decimal("1.5"))
+
+    def test_regions_without_surge_ignore_the_engine(self):
+        profile = self.profile._replace(is_surge_enabled=False)
+        self.assertEqual(surge_for(profile, CENTER), Decimal("1.0"))
+
+    def test_reading_the_table_does_not_start_the_engine(self):
+        engine = SurgeEngine()
+        self.assertIsNone(engine.current())
+        self.assertIsNone(engine._thread)
+
+
+class SurgeEngineTests(TestCase):
+    def setUp(self):
+        lat, lng = h3.cell_to_latlng(CENTER)
+        self.region = make_region(is_surge_enabled=True, geo_boundary=[
+            [lat - 0.01, lng - 0.01], [lat - 0.01, lng + 0.01], [lat + 0.01, lng + 0.01], [lat + 0.01, lng - 0.01],
+        ])
+        self.geofences = GeofenceIndex(tempfile.mkdtemp(), LocalRedis())
+        patcher = mock.patch("payments_module.surge.geofences", self.geofences)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(DRIVER_PRESENCE_REDIS_URL=None)
+    def test_engine_refuses_to_start_on_in_process_presence(self):
+        engine = SurgeEngine()
+        with self.assertRaises(ImproperlyConfigured):
+            engine.start()
+        self.assertIsNone(engine._thread)
+
+    def test_geofence_bumps_from_any_worker_rebuild_the_grid(self):
+        engine = SurgeEngine()
+        grid = engine.grid()
+        self.assertEqual(grid.regions, [str(self.region.region_code)])
+        self.assertIs(engine.grid(), grid)
+
+        Region.objects.filter(pk=self.region.pk).update(is_surge_enabled=False)
+        self.assertIs(engine.grid(), grid)
+
+        self.geofences.bump()
+        self.assertEqual(len(engine.grid()), 0)
+
+    def test_grid_is_reloaded_after_max_age_and_kept_when_unchanged(self):
+        engine = SurgeEngine(grid_max_age=0)
+        grid = engine.grid()
+
+        time.sleep(0.01)
+        self.assertIs(engine.grid(), grid)
+        self.assertEqual(engine.stats()["grid_loads"], 2)
+
+        Region.objects.filter(pk=self.region.pk).update(is_surge_enabled=False)
+        time.sleep(0.01)
+        self.assertEqual(len(engine.grid()), 0)
+
+
+    def test_recompute_prices_open_rides_against_online_drivers_in_steps(self):
+        make_lookups()
+        index = OpenRideIndex(resolution=9, refresh_seconds=3600)
+        presence = DriverPresenceRegistry(LocalRedis())
+        for target, value in (("open_ride_index", index), ("driver_presence", presence)):
+            patcher = mock.patch(f"payments_module.surge.{target}", value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        for _ in range(4):
+            make_ride(self.region)
+        index.reload()
+        presence.heartbeat(str(make_driver().driver_id), CENTER)
+        engine = SurgeEngine(neighbour_weight=0.0)
+
+        # four rides per driver targets 1.0 + 0.5 x (4 - 1) = 2.5, reached at most 0.5 per recompute
+        engine.recompute()
+        self.assertEqual(engine.multiplier(CENTER), 1.5)
+        engine.recompute()
+        self.assertEqual(engine.multiplier(CENTER), 2.0)
+
+        self.assertEqual(engine.multiplier(h3.grid_ring(CENTER, 1)[0]), 1.0)
+        self.assertEqual(engine.region_multipliers(), {str(self.region.region_code): 2.0})
+
+class SurgeTimelineTests(SimpleTestCase):
+    def window(self, surge_pricing_id, start, end, multiplier="1.5"):
+        base = timezone.now().replace(microsecond=0)
+        return SurgePricing(
+            surge_pricing_id=surge_pricing_id, surge_multiplier=Decimal(multiplier),
+            effective_from=base + timedelta(minutes=start), expires_at=base + timedelta(minutes=end),
+        )
+
+    def test_newest_overlapping_window_wins_until_it_expires(self):
+        old, new = self.window(1, 0, 60, "1.5"), self.window(2, 10, 20, "2.0")
+        timeline = SurgeTimeline([new, old])
+        at = lambda minutes: old.effective_from + timedelta(minutes=minutes)
+
+        self.assertIsNone(timeline.at(at(-1)))
+        self.assertIs(timeline.at(at(5)), old)
+        self.assertIs(timeline.at(at(10)), new)
+        self.assertIs(timeline.at(at(20)), old)
+        self.assertIsNone(timeline.at(at(60)))
+
+    def test_prune_drops_expired_windows(self):
+        old, new = self.window(1, -30, -10), self.window(2, -5, 30)
+        timeline = SurgeTimeline([old, new])
+
+        pruned = timeline.prune(timezone.now())
+        self.assertEqual(pruned.windows, [new])
+        self.assertIs(pruned.prune(timezone.now()), pruned)
+
+
+class SurgeWindowIndexTests(TestCase):
+    def setUp(self):
+        self.region = make_region()
+        self.index = SurgeWindowIndex()
+        self.index.window(self.region.region_code)
+
+    def create_window(self, multiplier):
+        now = timezone.now()
+        return SurgePricing.objects.create(
+            region=self.region, surge_multiplier=Decimal(multiplier),
+            effective_from=now - timedelta(minutes=1), expires_at=now + timedelta(hours=1),
+        )
+
+    def test_rolled_back_windows_never_apply(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.create_window("3.0")
+                raise RuntimeError
+        self.assertEqual(self.index.multiplier(self.region.region_code), Decimal("1.0"))
+
+    def test_committed_windows_apply_without_a_reload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_window("1.8")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.index.multiplier(self.region.region_code), Decimal("1.8"))
+
+
+class PricingCatalogueTests(TestCase):
+    def setUp(self):
+        self.region = make_region()
+        self.config = make_pricing(self.region)
+
+    def base_fare(self, catalogue):
+        return catalogue.get(self.region.region_code, self.config.vehicle_type_id).base_fare
+
+    def test_version_bumps_reload_every_worker_sharing_the_counter(self):
+        client = LocalRedis()
+        catalogue, other_worker = PricingCatalogue(client), PricingCatalogue(client)
+        self.assertEqual(self.base_fare(catalogue), Decimal("30"))
+
+        PricingConfig.objects.filter(pk=self.config.pk).update(base_fare=Decimal("45"))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.base_fare(catalogue), Decimal("30"))
+
+        other_worker.bump()
+        self.assertEqual(self.base_fare(catalogue), Decimal("45"))
+        self.assertEqual(catalogue.stats()["invalidations"], 1)
+
+    def test_catalogue_is_reloaded_after_max_age(self):
+        catalogue = PricingCatalogue(LocalRedis(), max_age=0)
+        self.assertEqual(self.base_fare(catalogue), Decimal("30"))
+
+        PricingConfig.objects.filter(pk=self.config.pk).update(base_fare=Decimal("45"))
+        time.sleep(0.01)
+        self.assertEqual(self.base_fare(catalogue), Decimal("45"))
+        self.assertEqual(catalogue.stats()["expirations"], 1)
+
+
+class UpfrontFareCacheTests(TestCase):
+    def setUp(self):
+        self.region = make_region()
+        self.profile = region_profiles.get(self.region.region_code)
+        self.vehicle_type = make_pricing(self.region).vehicle_type_id
+        self.cache = UpfrontFareCache(resolution=7)
+
+        hub = h3.cell_to_parent(CENTER, 7)
+        self.same_cell = next(cell for cell in h3.cell_to_children(hub, 9) if cell != CENTER)
+        self.far = h3.cell_to_center_child(h3.grid_ring(hub, 3)[0], 9)
+
+    def quote(self, to_location):
+        fares = self.cache.quote(self.profile, h3.str_to_int(CENTER), h3.str_to_int(to_location))
+        return fares[self.vehicle_type]
+
+    def test_trips_between_distant_cells_are_cached(self):
+        first = self.quote(self.far)
+        self.assertEqual(self.quote(self.far), first)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["entries"], 1)
+
+    def test_trips_within_a_cell_are_priced_exactly(self):
+        fare = self.quote(self.same_cell)
+        self.assertGreater(fare["distance_fare"], 0)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+        self.assertEqual(self.cache.stats()["exact"], 1)
+
+        self.assertEqual(self.quote(CENTER)["distance_fare"], 0)
+
+    def test_entries_are_repriced_after_their_ttl(self):
+        self.cache.ttl = 0
+        self.quote(self.far)
+        time.sleep(0.01)
+        self.quote(self.far)
+
+        self.assertEqual(self.cache.stats()["expired"], 1)
+        self.assertEqual(self.cache.stats()["hits"], 0)
+
+
+class GroupCommitWriterTests(TransactionTestCase):
+    def setUp(self):
+        make_lookups()
+        self.ride, self.details = make_ride(make_region())
+        self.writer = GroupCommitWriter(RideFareSnapshot, max_wait=0.05)
+        self.addCleanup(self.writer.stop)
+
+    def snapshot(self, currency="INR"):
+        return RideFareSnapshot(
+            ride_id=self.ride.ride_id, rider_id=self.details.rider_id, base_fare=Decimal("30"),
+            distance_fare=Decimal("60"), time_fare=Decimal("10"), surge_multiplier=Decimal("1.0"),
+            tax_amount=Decimal("5"), final_fare=Decimal("105"), currency=currency,
+        )
+
+    def test_a_lone_save_skips_the_writer_thread(self):
+        self.assertIsNotNone(self.writer.save(self.snapshot()).pk)
+        self.assertEqual(self.writer.stats()["direct"], 1)
+        self.assertIsNone(self.writer._thread)
+
+    def test_overlapping_saves_share_batches_and_errors_reach_only_their_caller(self):
+        callers = 8
+        results = [None] * callers
+        start = threading.Barrier(callers)
+        # as if another request were mid-insert, so every caller queues
+        self.writer._saving = 1
+
+        def save(n):
+            start.wait()
+            try:
+                results[n] = self.writer.save(self.snapshot("TOOLONG" if n == 3 else "INR"))
+            except Exception as error:
+                results[n] = error
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=save, args=(n,)) for n in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIsInstance(results[3], DataError)
+        saved = [result for n, result in enumerate(results) if n != 3]
+        self.assertTrue(all(isinstance(row, RideFareSnapshot) and row.pk for row in saved))
+        self.assertEqual(RideFareSnapshot.objects.count(), callers - 1)
+        self.assertLess(self.writer.stats()["batches"], callers)
+        self.assertEqual(self.writer.stats()["failed"], 1)
+
+    def test_a_failed_batch_is_retried_row_by_row(self):
+        batch = [_Pending(self.snapshot()), _Pending(self.snapshot("TOOLONG")), _Pending(self.snapshot())]
+        self.writer._write(batch)
+
+        self.assertEqual([pending.error is None for pending in batch], [True, False, True])
+        self.assertEqual(RideFareSnapshot.objects.count(), 2)
+
+    def test_callers_that_timed_out_still_learn_the_outcome(self):
+        outcomes = []
+        pending = _Pending(self.snapshot("TOOLONG"))
+        pending.abandoned = True
+        pending.when_done(lambda instance, error: outcomes.append(error))
+
+        self.writer._queue.put(pending)
+        self.writer._stop.set()
+        self.writer._run()
+
+        self.assertIsInstance(outcomes[0], DataError)
+        self.assertEqual(self.writer.stats()["abandoned_failed"], 1)
+
+        pending.when_done(lambda instance, error: outcomes.append(error))
+        self.assertIs(outcomes[1], outcomes[0])
+
+
+class PaymentCreateTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.ride, self.details = make_ride(make_region())
+        self.driver = make_driver()
+
+    def create(self):
+        return self.client.post(
+            "/payments/create/",
+            {"rider": str(self.details.rider_id), "driver": str(self.driver.driver_id),
+             "ride": str(self.ride.ride_id), "amount_total": "105.00", "currency": "INR"},
+            content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY="pay-1",
+        )
+
+    def queue_without_writing(self):
+        """
+        Patches the payment writer so saves time out, returning their pending rows
+        """
+        queued = []
+
+        def slow(payment):
+            queued.append(_Pending(payment))
+            raise GroupCommitTimeout("not written in time", queued[-1])
+
+        patcher = mock.patch("payments_module.serializers.payment_writer.save", side_effect=slow)
+        self.addCleanup(patcher.stop)
+        return patcher.start(), queued
+
+    def test_a_write_timeout_answers_202_and_replays_the_written_payment(self):
+        save, queued = self.queue_without_writing()
+        first, waiting = self.create(), self.create()
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(first.json()["payment_status"], "PENDING")
+        self.assertEqual(waiting.status_code, 409)
+
+        queued[0].instance.save(force_insert=True)
+        queued[0].finish()
+        retry = self.create()
+
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.json()["payment_id"], first.json()["payment_id"])
+        self.assertEqual(save.call_count, 1)
+
+    def test_a_write_that_fails_after_the_202_releases_the_key(self):
+        save, queued = self.queue_without_writing()
+        first = self.create()
+
+        queued[0].error = DataError("value too long")
+        queued[0].finish()
+        self.assertEqual(
+            self.client.get(f"/payments/status/{first.json()['payment_id']}/").status_code, 404
+        )
+
+        self.assertEqual(self.create().status_code, 202)
+        self.assertEqual(save.call_count, 2)
+
+    def test_a_fare_snapshot_timeout_answers_202_with_the_fare(self):
+        config = make_pricing(self.ride.region)
+
+        def slow(snapshot):
+            raise GroupCommitTimeout("not written in time", _Pending(snapshot))
+
+        with mock.patch("payments_module.views.fare_snapshot_writer.save", side_effect=slow):
+            response = self.client.post(
+                "/payments/pricing/calculate/",
+                {"ride_id": str(self.ride.ride_id), "rider_id": str(self.details.rider_id),
+                 "distance_km": "10", "duration_min": "20", "region_id": str(self.ride.region_id),
+                 "vehicle_type": config.vehicle_type_id},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Decimal(response.json()["final_fare"]), Decimal("157.50"))
+        self.assertIsNone(response.json()["breakdown"]["ride_fare_snapshot_id"])
@@ -0,0 +1,180 @@
+import threading
+import time
+from collections import OrderedDict
+
+import h3
+from django.conf import settings
+
+from payments_module.pricing_catalogue import pricing_catalogue
+from payments_module.quotes import quote_fares, surge_for
+from ride_sharing import metrics
+from rides.eta import eta_service
+from rides.region_profiles import region_profiles
+from rides.spatial_index import to_h3_cell
+
+
+class UpfrontFareCache:
+    """
+    Upfront fares per (region, origin cell, destination cell, vehicle
+    type, tenant, surge multiplier) with origin and destination coarsened
+    to `resolution`, so quotes repeated between the same hub and
+    neighbourhood are one dictionary hit.
+
+    A trip between two cells is priced from their centres: the great
+    circle distance times `road_factor`, and the ETA table's travel time
+    (distance at the default speed where the region has none). The surge
+    multiplier for the pickup (see `surge_for`) is part of the key, so a
+    window or the surge engine changing it never serves an old fare.
+    Pricing or region profile version changes drop every entry, and an
+    entry is repriced once it is `ttl` seconds old, so edits other workers
+    did not announce are picked up too. Entries beyond `max_entries` are
+    evicted least recently used first.
+
+    Cell centres say nothing about trips within one cell or between
+    neighbouring cells, so those are priced exactly from the pickup and
+    dropoff and never cached.
+    """
+
+    def __init__(self, max_entries=50000, resolution=7, road_factor=1.3, ttl=300):
+        self.max_entries = max_entries
+        self.resolution = resolution
+        self.road_factor = road_factor
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._fares = OrderedDict()     # key -> (fare, stored_at)
+        self._versions = None
+        self._counters = {"hits": 0, "misses": 0, "expired": 0, "exact": 0, "evictions": 0, "invalidations": 0}
+
+    def cell_pair(self, from_location, to_location):
+        """
+        (origin, destination) hex cells at the cache resolution, or None
+        """
+        origin = to_h3_cell(from_location, self.resolution)
+        destination = to_h3_cell(to_location, self.resolution)
+        if origin is None or destination is None:
+            return None
+        if h3.get_resolution(origin) != self.resolution or h3.get_resolution(destination) != self.resolution:
+            return None
+        return origin, destination
+
+    def is_short(self, origin, destination):
+        """
+        Whether two cache cells are the same or adjacent
+        """
+        return origin == destination or h3.are_neighbor_cells(origin, destination)
+
+    def trip(self, region_code, origin, destination):
+        """
+        (distance_km, duration_min) between the centres of two cells
+        """
+        distance_km = self.road_factor * h3.great_circle_distance(
+            h3.cell_to_latlng(origin), h3.cell_to_latlng(destination), unit="km"
+        )
+        # the finest child at the centre maps to the centre cell at any table resolution
+        seconds = eta_service.eta_seconds(
+            region_code, h3.cell_to_center_child(origin, 15), h3.cell_to_center_child(destination, 15)
+        )
+        if seconds is None:
+            seconds = distance_km / eta_service.default_speed_kmh * 3600
+        return distance_km, seconds / 60
+
+    def _check_versions(self):
+        versions = (pricing_catalogue.current_version(), region_profiles.current_version())
+        if versions == self._versions:
+            return
+
+        with self._lock:
+            if self._versions is not None and self._fares:
+                self._counters["invalidations"] += 1
+            self._fares.clear()
+            self._versions = versions
+
+    def quote(self, profile, from_location, to_location, vehicle_types=None, tenant_id=None):
+        """
+        {vehicle_type: fare breakdown} for a trip in the region of
+        `profile`, or None when either location is not a valid cell.
+        Breakdowns are shared between callers and must not be modified.
+        """
+        pair = self.cell_pair(from_location, to_location)
+        if pair is None:
+            return None
+
+        self._check_versions()
+        region_code = str(profile.region_code)
+        rates = pricing_catalogue.for_region(region_code, vehicle_types, tenant_id)
+        surge = surge_for(profile, from_location)
+        tenant = str(tenant_id) if tenant_id is not None else None
+
+        if self.is_short(*pair):
+            return self.exact(profile, from_location, to_location, rates, surge)
+
+        fares, missing = {}, {}
+        now = time.monotonic()
+        with self._lock:
+            for vehicle_type, config in rates.items():
+                key = (region_code, *pair, vehicle_type, tenant, surge)
+                entry = self._fares.get(key)
+                if entry is not None and now - entry[1] > self.ttl:
+                    del self._fares[key]
+                    self._counters["expired"] += 1
+                    entry = None
+                if entry is None:
+                    missing[vehicle_type] = config
+                else:
+                    self._fares.move_to_end(key)
+                    fares[vehicle_type] = entry[0]
+        self._counters["hits"] += len(fares)
+
+        if missing:
+            self._counters["misses"] += len(missing)
+            distance_km, duration_min = self.trip(region_code, *pair)
+            quotes = quote_fares(profile, [distance_km], [duration_min], missing, surge=surge)
+
+            with self._lock:
+                for column, vehicle_type in enumerate(quotes.vehicle_types):
+                    fare = quotes.breakdown(0, column)
+                    fares[vehicle_type] = fare
+                    self._fares[(region_code, *pair, vehicle_type, tenant, surge)] = (fare, now)
+
+                while len(self._fares) > self.max_entries:
+                    self._fares.popitem(last=False)
+                    self._counters["evictions"] += 1
+
+        return {vehicle_type: fares[vehicle_type] for vehicle_type in rates}
+
+    def exact(self, profile, from_location, to_location, rates, surge):
+        """
+        Fares for a trip between the pickup and dropoff cells themselves,
+        bypassing the cache
+        """
+        self._counters["exact"] += len(rates)
+        if not rates:
+            return {}
+
+        distance_km, duration_min = self.trip(
+            str(profile.region_code), to_h3_cell(from_location), to_h3_cell(to_location)
+        )
+        quotes = quote_fares(profile, [distance_km], [duration_min], rates, surge=surge)
+        return {
+            vehicle_type: quotes.breakdown(0, column)
+            for column, vehicle_type in enumerate(quotes.vehicle_types)
+        }
+
+    def stats(self):
+        lookups = self._counters["hits"] + self._counters["misses"]
+        report = {
+            "entries": len(self._fares),
+            "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else None,
+        }
+        report.update(self._counters)
+        return report
+
+
+upfront_fares = UpfrontFareCache(
+    max_entries=getattr(settings, "UPFRONT_FARE_CACHE_SIZE", 50000),
+    resolution=getattr(settings, "UPFRONT_FARE_RESOLUTION", 7),
+    road_factor=getattr(settings, "UPFRONT_FARE_ROAD_FACTOR", 1.3),
+    ttl=getattr(settings, "UPFRONT_FARE_TTL_SECONDS", 300),
+)
+
+metrics.register("upfront_fares", upfront_fares.stats)
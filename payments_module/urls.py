@@ -13,6 +13,8 @@ urlpatterns = [
     path("pricing/config/<uuid:region_id>/", PricingConfigView.as_view()),
     path("pricing/config/", PricingConfigCreateView.as_view()),
     path("pricing/calculate/", FareCalculateView.as_view()),
+    path("pricing/quote/", FareQuoteView.as_view()),
+    path("pricing/upfront/", UpfrontFareView.as_view()),
     path("pricing/surge/<uuid:region_id>/", SurgePricingView.as_view()),
     path("pricing/surge/", SurgePricingCreateView.as_view()),
 
@@ -5,24 +5,47 @@ from django.utils.timezone import now
 from decimal import Decimal
 
 from authentication.models import User
-from drivers.models import VehicleType
 from payments_module.models import Payment, PaymentStatusLookup, RideFareSnapshot, Wallet, WalletTransaction
+from payments_module.persistence import fare_snapshot_writer
+from payments_module.pricing_catalogue import pricing_catalogue
+from payments_module.quotes import quote_fares
 from payments_module.serializers import *
+from payments_module.surge_windows import surge_windows
+from payments_module.upfront_fares import upfront_fares
+from ride_sharing.group_commit import GroupCommitTimeout
+from ride_sharing.idempotency import defer, idempotent
+from ride_sharing.lookups import payment_statuses
+from rides.models import RideDetailsForRiders
+from rides.region_profiles import region_profiles
 
 
 #endpoints related to payments
 
 class PaymentCreateView(APIView):
+    @idempotent("payments.create", owner_field="rider")
     def post(self, request):
         serializer = PaymentCreateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        pending_status = PaymentStatusLookup.objects.get(status_name="PENDING")
+        pending_status = payment_statuses.get("PENDING")
 
-        payment = serializer.save(
-            payment_status=pending_status,
-            created_at=now()
-        )
+        try:
+            payment = serializer.save(
+                payment_status=pending_status,
+                created_at=now()
+            )
+        except GroupCommitTimeout as timeout:
+            # the row may still be written: answer with its id and keep the key claimed
+            # until the writer reports back, then keep the 201 or let a retry run again
+            settle = defer(request)
+            timeout.when_done(lambda payment, error: settle(None if error else Response(
+                PaymentStatusSerializer(payment).data,
+                status=status.HTTP_201_CREATED
+            )))
+            return Response(
+                PaymentStatusSerializer(timeout.instance).data,
+                status=status.HTTP_202_ACCEPTED
+            )
 
         return Response(
             PaymentStatusSerializer(payment).data,
@@ -35,7 +58,7 @@ class PaymentCompleteView(APIView):
         payment_id = request.data.get("payment_id")
 
         payment = Payment.objects.get(payment_id=payment_id)
-        completed_status = PaymentStatusLookup.objects.get(status_name="COMPLETED")
+        completed_status = payment_statuses.get("COMPLETED")
 
         payment.payment_status = completed_status
         payment.save()
@@ -45,7 +68,10 @@ class PaymentCompleteView(APIView):
 
 class PaymentStatusView(APIView):
     def get(self, request, payment_id):
-        payment = Payment.objects.get(payment_id=payment_id)
+        payment = Payment.objects.filter(payment_id=payment_id).select_related("payment_status").first()
+        if payment is None:
+            # also the answer for a 202 payment whose write has not landed (or failed)
+            return Response({"error": "Payment not found"}, status=status.HTTP_404_NOT_FOUND)
         return Response(PaymentStatusSerializer(payment).data)
 
 
@@ -74,7 +100,17 @@ class PaymentGatewayEventCreateView(APIView):
 
 class PricingConfigView(APIView):
     def get(self, request, region_id):
-        config = PricingConfig.objects.get(region_id=region_id)
+        vehicle_type = request.query_params.get("vehicle_type")
+        if vehicle_type is None:
+            configs = pricing_catalogue.region_configs(region_id)
+            return Response(PricingConfigSerializer(configs, many=True).data)
+
+        if not vehicle_type.isdigit():
+            return Response({"error": "vehicle_type must be an integer"}, status=400)
+
+        config = pricing_catalogue.get(region_id, int(vehicle_type), request.query_params.get("tenant_id"))
+        if config is None:
+            return Response({"error": "No pricing for this region and vehicle type"}, status=status.HTTP_404_NOT_FOUND)
         return Response(PricingConfigSerializer(config).data)
 
 
@@ -91,39 +127,105 @@ class FareCalculateView(APIView):
         serializer = FareCalculateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
-        # print("serialized data", data)
-
-        pricing = PricingConfig.objects.filter(region_id=data["region_id"], vehicle_type = VehicleType.objects.get(vehicle_type_id = data["vehicle_type"]))
-        # print("pricing_config object", pricing[0])
-        surge = SurgePricing.objects.filter(region=pricing[0].region_id).last()
-
-        surge_multiplier = surge.surge_multiplier if surge else Decimal("1.0")
-
-        base = pricing[0].base_fare
-        distance_fare = pricing[0].rate_per_km * data["distance_km"]
-        time_fare = pricing[0].rate_per_min * data["duration_min"]
-
-        total = (base + distance_fare + time_fare) * surge_multiplier
-
-        snapshot = RideFareSnapshot.objects.create(
-            ride_id=data["ride_id"],
-            rider_id=data["rider_id"],
-            base_fare=base,
-            distance_fare=distance_fare,
-            time_fare=time_fare,
-            surge_multiplier=surge_multiplier,
-            tax_amount=Decimal("0.0"),
-            final_fare=total,
-            currency="INR"
+
+        config = pricing_catalogue.get(data["region_id"], data["vehicle_type"], data.get("tenant_id"))
+        if config is None:
+            return Response({"error": "No pricing for this region and vehicle type"}, status=400)
+
+        pickup_cell = data.get("from_location")
+        if pickup_cell is None:
+            pickup_cell = (
+                RideDetailsForRiders.objects
+                .filter(ride_id=data["ride_id"])
+                .values_list("from_location", flat=True)
+                .first()
+            )
+
+        quotes = quote_fares(
+            region_profiles.get(data["region_id"]),
+            [data["distance_km"]],
+            [data["duration_min"]],
+            {data["vehicle_type"]: config},
+            pickup_cell=pickup_cell,
         )
+        fare = quotes.breakdown(0, 0)
+
+        # the fare for a ride is kept; quotes without a ride go through FareQuoteView
+        try:
+            snapshot = fare_snapshot_writer.save(RideFareSnapshot(
+                ride_id=data["ride_id"],
+                rider_id=data["rider_id"],
+                base_fare=fare["base_fare"],
+                distance_fare=fare["distance_fare"],
+                time_fare=fare["time_fare"],
+                surge_multiplier=fare["surge_multiplier"],
+                tax_amount=fare["tax_amount"],
+                final_fare=fare["final_fare"],
+                currency=quotes.currency
+            ))
+        except GroupCommitTimeout as timeout:
+            # the snapshot may still be written, so the client must not retry: the fare
+            # is final, only its snapshot id is not known yet
+            snapshot_serializer = RideFareSnapshotSerializer(timeout.instance)
+            return Response(
+                {"final_fare": timeout.instance.final_fare, "breakdown": snapshot_serializer.data},
+                status=status.HTTP_202_ACCEPTED
+            )
 
         snapshot_serializer = RideFareSnapshotSerializer(snapshot)
         return Response({"final_fare": snapshot.final_fare, "breakdown": snapshot_serializer.data})
-    
+
+
+class FareQuoteView(APIView):
+    def post(self, request):
+        serializer = FareQuoteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        distances, durations = data["trips"]
+        quotes = quote_fares(
+            data["region_profile"], distances, durations, data["rates"], pickup_cell=data.get("from_location")
+        )
+
+        return Response({
+            "region_id": data["region_id"],
+            "currency": quotes.currency,
+            "surge_multiplier": quotes.surge_multiplier,
+            "tax_percent": quotes.tax_percent,
+            "quotes": quotes.rows(),
+        })
+
+
+class UpfrontFareView(APIView):
+    def post(self, request):
+        serializer = UpfrontFareSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        fares = upfront_fares.quote(
+            data["region_profile"],
+            data["from_location"],
+            data["to_location"],
+            data.get("vehicle_types"),
+            data.get("tenant_id"),
+        )
+        if fares is None:
+            return Response({"error": "from_location and to_location must be H3 cells"}, status=400)
+
+        missing = set(data.get("vehicle_types", ())) - set(fares)
+        if missing or not fares:
+            return Response({"error": "No pricing for this region and vehicle type"}, status=400)
+
+        return Response({
+            "region_code": data["region_code"],
+            "currency": data["region_profile"].currency_code,
+            "quotes": list(fares.values()),
+        })
+
 
 class SurgePricingView(APIView):
     def get(self, request, region_id):
-        surge = SurgePricing.objects.filter(region_id=region_id).last()
+        surge = surge_windows.window(region_id)
         return Response(SurgePricingSerializer(surge).data)
 
 
@@ -160,9 +262,7 @@ class SettlementUpdateView(APIView):
         status_name = request.data.get("status")
 
         settlement = Settlement.objects.get(settlement_id=settlement_id)
-        settlement.payment_status = PaymentStatusLookup.objects.get(
-            status_name=status_name
-        )
+        settlement.payment_status = payment_statuses.get(status_name)
         settlement.save()
 
         return Response({"updated": True, "settlement_id": settlement_id , "status_name": status_name})
@@ -2,6 +2,7 @@
 ASGI config for ride_sharing project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django; WebSocket connections go to the ride offer consumer.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
@@ -9,8 +10,24 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ride_sharing.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from rides.consumers import DriverOfferConsumer  # noqa: E402  (needs apps loaded)
+
+driver_offers = DriverOfferConsumer()
+
+if settings.SURGE_ENGINE_ENABLED:
+    from payments_module.surge import surge_engine
+
+    surge_engine.start()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        return await driver_offers(scope, receive, send)
+    return await django_application(scope, receive, send)
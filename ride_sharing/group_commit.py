@@ -0,0 +1,219 @@
+import logging
+import queue
+import threading
+import time
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitTimeout(Exception):
+    """
+    The writer did not confirm `instance` within the caller's timeout. The
+    row may still be written, so callers must not insert it again;
+    `when_done` learns the final outcome.
+    """
+
+    def __init__(self, message, pending):
+        super().__init__(message)
+        self.instance = pending.instance
+        self.when_done = pending.when_done
+
+
+class _Pending:
+    __slots__ = ("instance", "done", "error", "abandoned", "_lock", "_callbacks")
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.done = threading.Event()
+        self.error = None
+        self.abandoned = False
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def when_done(self, callback):
+        """
+        Calls `callback(instance, error)` once the row is written (error
+        None) or has failed; straight away if that already happened
+        """
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self.instance, self.error)
+
+    def finish(self):
+        with self._lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self.instance, self.error)
+            except Exception:
+                logger.exception("group commit callback failed")
+
+
+class GroupCommitWriter:
+    """
+    Inserts model instances from concurrent requests in shared batches.
+
+    `save()` queues the unsaved instance and blocks until a writer thread
+    has inserted it, then returns it with its primary key (and any
+    auto_now_add fields) set. The writer takes every queued row, up to
+    `max_batch` (see `_collect`), and inserts them with one bulk_create in
+    one transaction. If the batch fails it retries the rows one by one, so
+    only the callers whose rows are bad get the error.
+
+    Batching only pays off when requests overlap. A caller that finds no
+    other save in progress inserts its row itself with a plain INSERT, so
+    a lone request costs what it did before the writer existed; one
+    already inside a transaction does the same, so the row commits or
+    rolls back with that transaction. Batched rows go through bulk_create,
+    which sends no post_save signals; receivers cannot rely on them.
+
+    A caller that times out gets GroupCommitTimeout and can register for
+    the outcome; a row that fails after its caller gave up is logged and
+    counted under "abandoned_failed".
+    """
+
+    def __init__(self, model, max_batch=500, max_wait=0.002, timeout=10.0):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._saving = 0
+        self._counters = {
+            "rows": 0, "batches": 0, "last_batch": 0, "largest_batch": 0, "direct": 0,
+            "row_retries": 0, "failed": 0, "timeouts": 0, "abandoned_failed": 0, "last_commit_ms": 0.0,
+        }
+
+    def save(self, instance):
+        with self._lock:
+            direct = connection.in_atomic_block or (self._saving == 0 and self._queue.empty())
+            self._saving += 1
+
+        try:
+            if direct:
+                # save() is one statement; bulk_create would wrap it in BEGIN/COMMIT
+                instance.save(force_insert=True)
+                self._counters["direct"] += 1
+                return instance
+
+            pending = _Pending(instance)
+            self._queue.put(pending)
+            self._ensure_started()
+
+            if not pending.done.wait(self.timeout):
+                pending.abandoned = True
+                self._counters["timeouts"] += 1
+                raise GroupCommitTimeout(f"{self.model.__name__} not written within {self.timeout}s", pending)
+            if pending.error is not None:
+                raise pending.error
+            return instance
+        finally:
+            with self._lock:
+                self._saving -= 1
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name=f"group-commit-{self.model._meta.db_table}", daemon=True
+                )
+                self._thread.start()
+
+    def _collect(self):
+        """
+        The next batch: one row, blocking briefly, then whatever else is
+        queued. Rows that queued up during the previous write make the
+        next batch by themselves; beyond that the writer waits up to
+        `max_wait` only while the batch is smaller than the previous one,
+        so a lone caller, or callers that are all in the batch, never wait.
+        """
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+        expected = min(self._counters["last_batch"], self.max_batch)
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if len(batch) >= expected or remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except Exception as error:
+                logger.exception("group commit for %s failed", self.model._meta.db_table)
+                for pending in batch:
+                    pending.error = pending.error or error
+            finally:
+                for pending in batch:
+                    if pending.abandoned and pending.error is not None:
+                        self._counters["abandoned_failed"] += 1
+                        logger.error(
+                            "%s row failed after its caller timed out: %s", self.model._meta.db_table, pending.error
+                        )
+                    pending.finish()
+        # the thread's connection would otherwise stay open after it exits
+        connection.close()
+
+    def _write(self, batch):
+        # the writer keeps its connection between batches; one that broke is reopened
+        if connection.connection is not None and connection.errors_occurred and not connection.is_usable():
+            connection.close()
+
+        started = time.perf_counter()
+        try:
+            # bulk_create is one statement in its own transaction
+            self.model.objects.bulk_create([pending.instance for pending in batch])
+        except Exception:
+            # one bad row fails the whole statement; find it
+            self._counters["row_retries"] += len(batch)
+            for pending in batch:
+                try:
+                    self.model.objects.bulk_create([pending.instance])
+                except Exception as error:
+                    self._counters["failed"] += 1
+                    pending.error = error
+        finally:
+            self._counters["batches"] += 1
+            self._counters["rows"] += len(batch)
+            self._counters["last_batch"] = len(batch)
+            self._counters["largest_batch"] = max(self._counters["largest_batch"], len(batch))
+            self._counters["last_commit_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        report = {
+            "queued": self._queue.qsize(),
+            "rows_per_batch": round(self._counters["rows"] / self._counters["batches"], 2)
+            if self._counters["batches"] else None,
+        }
+        report.update(self._counters)
+        return report
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import threading
+from functools import wraps
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from ride_sharing import metrics
+from ride_sharing.local_redis import get_redis_client, is_local_url
+
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+REPLAYED_HEADER = "Idempotent-Replayed"
+KEY = "idempotency:{}:{}:{}"    # scope, caller, client key -> stored response
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyStore:
+    """
+    Responses to POSTs that carried an Idempotency-Key header, kept for
+    `ttl_seconds` so a client retrying the same request gets the first
+    response back instead of running the view again.
+
+    A key is claimed with an in-flight marker before the view runs, so a
+    retry that arrives while the first attempt is still working is told
+    to wait (409) rather than racing it. Only 2xx/4xx responses are kept;
+    a 5xx releases the key so the client can retry for real. A view whose
+    outcome is not known yet when it answers can `defer` the key instead.
+
+    Keys are only seen by the workers sharing `client`. With the default
+    per-process client (`shared` False) a retry routed to another worker
+    runs the view again, so deployments with more than one worker must
+    set IDEMPOTENCY_REDIS_URL.
+    """
+
+    def __init__(self, client, ttl_seconds=86400, in_flight_seconds=30, shared=True):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.in_flight_seconds = in_flight_seconds
+        self.shared = shared
+        self._counters = {
+            "stored": 0, "replayed": 0, "in_flight": 0, "mismatched": 0, "released": 0, "deferred": 0,
+        }
+
+    def claim(self, scope, caller, key, fingerprint):
+        """
+        Returns None if the key is now ours to run, otherwise the stored
+        entry ({"fingerprint", "status", "data"}; status None while the
+        first attempt is still running)
+        """
+        name = KEY.format(scope, caller, key)
+        marker = json.dumps({"fingerprint": fingerprint, "status": None})
+        if self.client.set(name, marker, ex=self.in_flight_seconds, nx=True):
+            return None
+
+        stored = self.client.get(name)
+        if stored is None:
+            # expired between the two calls; try once more
+            if self.client.set(name, marker, ex=self.in_flight_seconds, nx=True):
+                return None
+            stored = self.client.get(name) or marker
+        return json.loads(stored)
+
+    def save(self, scope, caller, key, fingerprint, response):
+        self.client.set(
+            KEY.format(scope, caller, key),
+            json.dumps(
+                {"fingerprint": fingerprint, "status": response.status_code, "data": response.data},
+                cls=JSONEncoder
+            ),
+            ex=self.ttl_seconds
+        )
+        self._counters["stored"] += 1
+
+    def hold(self, scope, caller, key, fingerprint):
+        """
+        Renews the in-flight marker of a claimed key
+        """
+        marker = json.dumps({"fingerprint": fingerprint, "status": None})
+        self.client.set(KEY.format(scope, caller, key), marker, ex=self.in_flight_seconds)
+        self._counters["deferred"] += 1
+
+    def release(self, scope, caller, key):
+        self.client.delete(KEY.format(scope, caller, key))
+        self._counters["released"] += 1
+
+    def count(self, outcome):
+        self._counters[outcome] += 1
+
+    def stats(self):
+        report = {"shared": self.shared}
+        report.update(self._counters)
+        return report
+
+
+_idempotency_url = getattr(settings, "IDEMPOTENCY_REDIS_URL", None)
+
+idempotency_store = IdempotencyStore(
+    get_redis_client(_idempotency_url, max_keys=getattr(settings, "IDEMPOTENCY_MAX_KEYS", 100000)),
+    ttl_seconds=getattr(settings, "IDEMPOTENCY_TTL_SECONDS", 86400),
+    in_flight_seconds=getattr(settings, "IDEMPOTENCY_IN_FLIGHT_SECONDS", 30),
+    shared=not is_local_url(_idempotency_url),
+)
+
+metrics.register("idempotency", idempotency_store.stats)
+
+
+class Claim:
+    """
+    The key a request is running under. `settle` stores the final
+    response, or releases the key when given None (or a 5xx).
+    """
+
+    def __init__(self, store, scope, caller, key, fingerprint):
+        self.store = store
+        self.scope = scope
+        self.caller = caller
+        self.key = key
+        self.fingerprint = fingerprint
+        self.deferred = False
+        self.settled = False
+        self._lock = threading.Lock()
+
+    def settle(self, response):
+        with self._lock:
+            if self.settled:
+                return
+            self.settled = True
+            if response is None or response.status_code >= 500 or not hasattr(response, "data"):
+                self.store.release(self.scope, self.caller, self.key)
+            else:
+                self.store.save(self.scope, self.caller, self.key, self.fingerprint, response)
+
+    def hold(self):
+        with self._lock:
+            if not self.settled:
+                self.store.hold(self.scope, self.caller, self.key, self.fingerprint)
+
+
+def defer(request):
+    """
+    For a view that answers before its outcome is known (a 202 for a write
+    that is still queued): the response it returns is not stored and the
+    key stays claimed, so a retry is told to wait (409) rather than run
+    the view again. Returns `settle(response)`, to call once the outcome
+    is known, with the final response to keep for replays or None to
+    release the key so the next retry runs for real.
+    """
+    claim = getattr(request, "idempotency_claim", None)
+    if claim is None:
+        return lambda response: None
+    claim.deferred = True
+    return claim.settle
+
+
+def caller_of(request, owner_field=None):
+    """
+    Who is making the request: the authenticated user, else the
+    `owner_field` of the body (the rider a booking is for), else "-"
+    """
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+
+    owner = request.data.get(owner_field) if owner_field and hasattr(request.data, "get") else None
+    return f"{owner_field}:{owner}" if owner else "-"
+
+
+def idempotent(scope, owner_field=None, store=None):
+    """
+    Decorates an APIView handler so requests carrying an Idempotency-Key
+    header run at most once per key within `scope` and caller (see
+    `caller_of`), so one client cannot replay another's response by
+    reusing its key. Repeats get the stored response (with an
+    Idempotent-Replayed header) without the view or the ORM being
+    touched; reusing a key for a different body is rejected with 422.
+    Requests without the header run as before.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            key = request.META.get(HEADER)
+            if not key:
+                return handler(view, request, *args, **kwargs)
+
+            if len(key) > MAX_KEY_LENGTH:
+                return Response(
+                    {"error": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            active = store or idempotency_store
+            caller = caller_of(request, owner_field)
+            fingerprint = hashlib.sha256(request.body).hexdigest()
+            stored = active.claim(scope, caller, key, fingerprint)
+
+            if stored is not None:
+                if stored["fingerprint"] != fingerprint:
+                    active.count("mismatched")
+                    return Response(
+                        {"error": "Idempotency-Key was already used with a different request"},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                    )
+                if stored["status"] is None:
+                    active.count("in_flight")
+                    return Response(
+                        {"error": "A request with this Idempotency-Key is still being processed"},
+                        status=status.HTTP_409_CONFLICT,
+                        headers={"Retry-After": "1"}
+                    )
+
+                active.count("replayed")
+                return Response(
+                    stored["data"],
+                    status=stored["status"],
+                    headers={REPLAYED_HEADER: "true"}
+                )
+
+            claim = request.idempotency_claim = Claim(active, scope, caller, key, fingerprint)
+            try:
+                response = handler(view, request, *args, **kwargs)
+            except Exception:
+                claim.settle(None)
+                raise
+
+            if claim.deferred:
+                claim.hold()
+            else:
+                claim.settle(response)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,323 @@
+import heapq
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the subset of the redis-py client we use
+    (strings with expiry, hashes, sets, sorted sets and pub/sub).
+
+    Values are kept as str, matching a redis.Redis(decode_responses=True)
+    client, so code written against it runs unchanged on a real server.
+    `max_keys` bounds the keyspace with LRU eviction, like maxmemory-policy
+    allkeys-lru. Expired keys are dropped when read and, like redis'
+    active expiry, by every write, so keys that are never read again do
+    not pile up.
+    """
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys
+        self._lock = threading.RLock()
+        self._data = OrderedDict()
+        self._expires = {}
+        self._expiry_heap = []  # (expires_at, name); stale entries are skipped
+        self._channels = {}     # channel -> set(LocalPubSub)
+
+    # ---------------- keys ----------------
+
+    def _live(self, name):
+        expires_at = self._expires.get(name)
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+            return None
+
+        value = self._data.get(name)
+        if value is not None:
+            self._data.move_to_end(name)
+        return value
+
+    def _set_expiry(self, name, expires_at):
+        self._expires[name] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, name))
+
+    def _sweep(self):
+        now = time.time()
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, name = heapq.heappop(heap)
+            if self._expires.get(name) == expires_at:
+                self._data.pop(name, None)
+                del self._expires[name]
+
+    def _store(self, name, value):
+        self._sweep()
+        self._data[name] = value
+        self._data.move_to_end(name)
+
+        if self.max_keys is not None:
+            while len(self._data) > self.max_keys:
+                evicted, _ = self._data.popitem(last=False)
+                self._expires.pop(evicted, None)
+
+    def _container(self, name, factory):
+        value = self._live(name)
+        if value is None:
+            value = factory()
+            self._store(name, value)
+        return value
+
+    def _drop_if_empty(self, name, value):
+        if not value:
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+
+    def delete(self, *names):
+        with self._lock:
+            removed = 0
+            for name in names:
+                if self._live(name) is not None:
+                    del self._data[name]
+                    self._expires.pop(name, None)
+                    removed += 1
+            return removed
+
+    def exists(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._live(name) is not None)
+
+    def expire(self, name, seconds):
+        with self._lock:
+            if self._live(name) is None:
+                return False
+            self._set_expiry(name, time.time() + seconds)
+            return True
+
+    def dbsize(self):
+        with self._lock:
+            return len(self._data)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self._expiry_heap.clear()
+            return True
+
+    # ---------------- strings ----------------
+
+    def get(self, name):
+        with self._lock:
+            return self._live(name)
+
+    def set(self, name, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._live(name) is not None:
+                return None
+
+            self._store(name, str(value))
+            if ex is not None:
+                self._set_expiry(name, time.time() + ex)
+            else:
+                self._expires.pop(name, None)
+            return True
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            value = int(self._live(name) or 0) + amount
+            self._store(name, str(value))
+            return value
+
+    # ---------------- hashes ----------------
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self._lock:
+            data = self._container(name, dict)
+            items = dict(mapping or {})
+            if key is not None:
+                items[key] = value
+
+            added = sum(1 for k in items if k not in data)
+            data.update({k: str(v) for k, v in items.items()})
+            return added
+
+    def hget(self, name, key):
+        with self._lock:
+            data = self._live(name)
+            return data.get(key) if data else None
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._live(name) or {})
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            data = self._live(name)
+            if not data:
+                return 0
+
+            removed = sum(1 for key in keys if data.pop(key, None) is not None)
+            self._drop_if_empty(name, data)
+            return removed
+
+    def hlen(self, name):
+        with self._lock:
+            return len(self._live(name) or ())
+
+    # ---------------- sets ----------------
+
+    def sadd(self, name, *values):
+        with self._lock:
+            members = self._container(name, set)
+            before = len(members)
+            members.update(str(value) for value in values)
+            return len(members) - before
+
+    def srem(self, name, *values):
+        with self._lock:
+            members = self._live(name)
+            if not members:
+                return 0
+
+            before = len(members)
+            members.difference_update(str(value) for value in values)
+            removed = before - len(members)
+            self._drop_if_empty(name, members)
+            return removed
+
+    def smembers(self, name):
+        with self._lock:
+            return set(self._live(name) or ())
+
+    def scard(self, name):
+        with self._lock:
+            return len(self._live(name) or ())
+
+    # ---------------- sorted sets ----------------
+
+    def zadd(self, name, mapping):
+        with self._lock:
+            scores = self._container(name, dict)
+            mapping = {str(m): float(s) for m, s in mapping.items()}
+            added = sum(1 for member in mapping if member not in scores)
+            scores.update(mapping)
+            return added
+
+    def zrem(self, name, *members):
+        with self._lock:
+            scores = self._live(name)
+            if not scores:
+                return 0
+
+            removed = sum(1 for m in members if scores.pop(m, None) is not None)
+            self._drop_if_empty(name, scores)
+            return removed
+
+    def zscore(self, name, member):
+        with self._lock:
+            scores = self._live(name)
+            return scores.get(str(member)) if scores else None
+
+    def zrangebyscore(self, name, min, max):
+        low = float(min)
+        high = float(max)
+
+        with self._lock:
+            scores = self._live(name) or {}
+            hits = [(s, m) for m, s in scores.items() if low <= s <= high]
+
+        return [member for _, member in sorted(hits)]
+
+    def zremrangebyscore(self, name, min, max):
+        low = float(min)
+        high = float(max)
+
+        with self._lock:
+            scores = self._live(name)
+            if not scores:
+                return 0
+
+            expired = [m for m, s in scores.items() if low <= s <= high]
+            for member in expired:
+                del scores[member]
+            self._drop_if_empty(name, scores)
+            return len(expired)
+
+    def zcard(self, name):
+        with self._lock:
+            return len(self._live(name) or ())
+
+    # ---------------- pub/sub ----------------
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        for subscriber in subscribers:
+            subscriber._messages.put({"type": "message", "channel": channel, "data": str(message)})
+        return len(subscribers)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return LocalPubSub(self)
+
+
+class LocalPubSub:
+    """
+    The get_message() side of redis-py's PubSub, for LocalRedis.publish
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.channels = set()
+        self._messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        with self.client._lock:
+            for channel in channels:
+                self.client._channels.setdefault(channel, set()).add(self)
+        self.channels.update(channels)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return self._messages.get(timeout=timeout) if timeout else self._messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.client._lock:
+            for channel in self.channels:
+                self.client._channels.get(channel, set()).discard(self)
+        self.channels.clear()
+
+
+_local_clients = {}
+_local_clients_lock = threading.Lock()
+
+
+def is_local_url(url):
+    """
+    True when `url` selects a per-process LocalRedis rather than a server
+    """
+    return not url or url.startswith("local://")
+
+
+def get_redis_client(url=None, max_keys=None):
+    """
+    Returns a redis client for `url`. With no url (or a local:// url) an
+    in-process LocalRedis is returned, shared within the worker by callers
+    asking for the same url and `max_keys`, so a bounded store never
+    evicts the keys of an unbounded one (or the other way round).
+    """
+    if is_local_url(url):
+        with _local_clients_lock:
+            key = (url or "local://default", max_keys)
+            client = _local_clients.get(key)
+            if client is None:
+                client = _local_clients[key] = LocalRedis(max_keys=max_keys)
+            return client
+
+    import redis
+
+    return redis.Redis.from_url(url, decode_responses=True)
@@ -0,0 +1,133 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from app_admin.models import KYCStatusLookup, KYCTypeLookup
+from authentication.models import TenantStatusLookup, UserStatusLookup
+from drivers.models import DriverStatusLookup
+from issues.models import NotificationStatusLookup, PriorityLookup, SOSAlertStatusLookup, TicketStatusLookup
+from payments_module.models import PaymentStatusLookup
+from ride_sharing import metrics
+from rides.models import RegionTypeLookup, RideStatusLookup
+
+
+class LookupCache:
+    """
+    One worker-wide copy of a small static *Lookup table, indexed by its
+    name column and by primary key.
+
+    The table is read on first use and again after `invalidate()`, after
+    `max_age` seconds, or when a name/id is missing (a row added since
+    the last load). Saves and deletes through the ORM invalidate it, so
+    only edits made outside this worker wait for `max_age`.
+    """
+
+    def __init__(self, model, name_field, max_age=300):
+        self.model = model
+        self.name_field = name_field
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._by_name = None
+        self._by_id = None
+        self._loaded_at = 0.0
+        self._counters = {"hits": 0, "loads": 0}
+
+        post_save.connect(self._on_change, sender=model, weak=False)
+        post_delete.connect(self._on_change, sender=model, weak=False)
+
+    def _on_change(self, sender, **kwargs):
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._by_name = None
+            self._by_id = None
+
+    def _load(self):
+        rows = list(self.model.objects.all())
+
+        with self._lock:
+            self._by_name = {getattr(row, self.name_field): row for row in rows}
+            self._by_id = {row.pk: row for row in rows}
+            self._loaded_at = time.monotonic()
+            self._counters["loads"] += 1
+
+    def _tables(self):
+        by_name, by_id = self._by_name, self._by_id
+        if by_name is None or time.monotonic() - self._loaded_at > self.max_age:
+            self._load()
+            by_name, by_id = self._by_name, self._by_id
+        return by_name, by_id
+
+    def _find(self, index, key):
+        row = self._tables()[index].get(key)
+        if row is None:
+            self._load()
+            row = self._tables()[index].get(key)
+            if row is None:
+                raise self.model.DoesNotExist(
+                    f"{self.model.__name__} matching {key!r} does not exist."
+                )
+
+        self._counters["hits"] += 1
+        return row
+
+    def get(self, name):
+        """
+        The row whose name column equals `name`, like
+        Model.objects.get(<name_field>=name)
+        """
+        return self._find(0, name)
+
+    def by_id(self, pk):
+        return self._find(1, int(pk))
+
+    def all(self):
+        return list(self._tables()[1].values())
+
+    def stats(self):
+        report = {"rows": len(self._by_id or ())}
+        report.update(self._counters)
+        return report
+
+
+_caches = {}
+
+
+def register(model, name_field):
+    """
+    Returns the LookupCache for `model`, creating it on first call
+    """
+    cache = _caches.get(model)
+    if cache is None:
+        cache = _caches[model] = LookupCache(
+            model, name_field, max_age=getattr(settings, "LOOKUP_CACHE_MAX_AGE_SECONDS", 300)
+        )
+    return cache
+
+
+def invalidate_all():
+    for cache in _caches.values():
+        cache.invalidate()
+
+
+def stats():
+    return {cache.model.__name__: cache.stats() for cache in _caches.values()}
+
+
+metrics.register("lookups", stats)
+
+ride_statuses = register(RideStatusLookup, "ride_status")
+region_types = register(RegionTypeLookup, "region_type")
+payment_statuses = register(PaymentStatusLookup, "status_name")
+driver_statuses = register(DriverStatusLookup, "status_name")
+user_statuses = register(UserStatusLookup, "status_name")
+tenant_statuses = register(TenantStatusLookup, "status_name")
+kyc_statuses = register(KYCStatusLookup, "kyc_status")
+kyc_types = register(KYCTypeLookup, "kyc_type")
+ticket_statuses = register(TicketStatusLookup, "ticket_status")
+notification_statuses = register(NotificationStatusLookup, "notification_status")
+sos_alert_statuses = register(SOSAlertStatusLookup, "sos_alert_status")
+priorities = register(PriorityLookup, "priority")
@@ -0,0 +1,22 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+
+
+_providers = {}
+
+
+def register(name, provider):
+    """
+    Registers a zero-argument callable returning a dict of counters,
+    reported under `name` by MetricsView
+    """
+    _providers[name] = provider
+
+
+def snapshot():
+    return {name: provider() for name, provider in sorted(_providers.items())}
+
+
+class MetricsView(APIView):
+    def get(self, request):
+        return Response(snapshot())
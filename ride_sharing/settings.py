@@ -142,3 +142,154 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",
 ]
 CORS_ALLOW_CREDENTIALS = True
+
+# H3 index of BOOKED rides used for driver ride discovery
+OPEN_RIDE_INDEX_RESOLUTION = 9
+OPEN_RIDE_INDEX_REFRESH_SECONDS = 5
+
+# Ride offers pushed over /ws/drivers/<id>/offers/. Set the URL to a redis
+# shared by every worker so offers booked in one reach drivers on another.
+RIDE_OFFERS_REDIS_URL = getenv('RIDE_OFFERS_REDIS_URL')
+RIDE_OFFER_TTL_SECONDS = 3600
+
+# Online-driver presence registry. Leave the URL unset to keep presence
+# in-process, or point it at a shared redis (redis://...) for all workers.
+DRIVER_PRESENCE_REDIS_URL = getenv('DRIVER_PRESENCE_REDIS_URL')
+DRIVER_PRESENCE_TTL_SECONDS = 30
+DRIVER_PRESENCE_RESOLUTION = 9
+# How long a driver on a ride stays out of matching if the ride's end is never recorded
+DRIVER_PRESENCE_BUSY_TTL_SECONDS = 4 * 3600
+
+# Batched ride-driver matching (python manage.py run_matching). Needs a
+# shared DRIVER_PRESENCE_REDIS_URL, or it would never see any drivers.
+MATCHING_MAX_PICKUP_RINGS = 3
+
+# Bulk GPS ingestion (POST /rides/location/batch/)
+LOCATION_BATCH_MAX_POINTS = 5000
+
+# Write-behind buffer behind POST /rides/location/
+LOCATION_BUFFER_MAX_POINTS = 50000
+LOCATION_BUFFER_FLUSH_POINTS = 2000
+LOCATION_BUFFER_FLUSH_INTERVAL = 0.5
+# Times a batch that failed for reasons other than its data is retried before it is dropped
+LOCATION_BUFFER_MAX_ATTEMPTS = 10
+
+# Post-ride trajectory compaction (manage.py compact_trajectories)
+TRAJECTORY_TOLERANCE_M = 5.0
+TRAJECTORY_FINAL_STATUSES = ("COMPLETED", "CANCELLED")
+
+# Worker-wide *Lookup table caches (ride_sharing.lookups)
+LOOKUP_CACHE_MAX_AGE_SECONDS = 300
+
+# Per-driver rejected-ride cache. Only used with a shared REDIS_URL; unset,
+# ride discovery reads driver_ride_rejections for the rides around the driver
+# instead. A rejected ride stays hidden from that driver while it is open
+REJECTED_RIDES_REDIS_URL = getenv('REJECTED_RIDES_REDIS_URL')
+# How long a cached entry outlives a missed ride close; entries are reloaded every half of it
+REJECTED_RIDES_TTL_SECONDS = 1800
+
+# Driver ride discovery: widen ring by ring until this many rides or MAX_K
+RIDE_DISCOVERY_MIN_CANDIDATES = 20
+RIDE_DISCOVERY_MAX_K = 3
+
+# H3 cell-to-cell ETA tables (manage.py build_eta_matrix)
+ETA_MATRIX_DIR = getenv('ETA_MATRIX_DIR', str(BASE_DIR / 'eta_tables'))
+ETA_RESOLUTIONS = (9, 8, 7)
+ETA_DEFAULT_SPEED_KMH = 25.0
+# Unit ride_location_log.speed arrives in from the driver apps: "km/h", "m/s" (what Android and iOS
+# location APIs report) or "mph". build_eta_matrix converts with it and skips regions whose pings disagree
+LOCATION_SPEED_UNIT = getenv('LOCATION_SPEED_UNIT', 'km/h')
+# How often workers look for rebuilt tables
+ETA_RELOAD_CHECK_SECONDS = 30
+# Largest table built (n x n x 2 bytes: 30,000 cells is about 1.7 GiB);
+# regions over it are served from a coarser resolution
+ETA_MAX_CELLS = 30000
+
+# "grid" prices pickups in H3 rings, "eta" in seconds from the ETA tables
+MATCHING_COST = getenv('MATCHING_COST', 'grid')
+MATCHING_MAX_PICKUP_SECONDS = 600
+
+# Ride status machine: status -> statuses it may move to (rides.state_machine)
+RIDE_STATUS_TRANSITIONS = {
+    "BOOKED": ["DRIVER_ASSIGNED", "CANCELLED"],
+    "DRIVER_ASSIGNED": ["BOOKED", "RIDE_STARTED", "CANCELLED"],
+    "RIDE_STARTED": ["COMPLETED"],
+}
+
+# Idempotency-Key replay store for booking/payment POSTs, keyed per caller. Unset REDIS_URL keeps
+# it in-process, which only holds for a single worker: set it wherever more than one runs
+IDEMPOTENCY_REDIS_URL = getenv('IDEMPOTENCY_REDIS_URL')
+IDEMPOTENCY_TTL_SECONDS = 86400
+IDEMPOTENCY_IN_FLIGHT_SECONDS = 30
+IDEMPOTENCY_MAX_KEYS = 100000
+
+# Ride lifecycle events (rides.events): event_log rows are written with the state change; this is
+# the best-effort in-memory queue that hands committed events to in-process subscribers
+RIDE_EVENTS_MAX_QUEUED = 20000
+RIDE_EVENTS_FLUSH_EVENTS = 500
+RIDE_EVENTS_FLUSH_INTERVAL = 0.2
+RIDE_EVENTS_MAX_ATTEMPTS = 5
+
+# Rider ride history (GET /rides/list_previous_rides/<user_id>)
+RIDE_HISTORY_PAGE_SIZE = 50
+RIDE_HISTORY_MAX_PAGE_SIZE = 200
+RIDE_HISTORY_EXPORT_CHUNK = 1000
+
+# Coalesced driver positions (drivers.locations): latest ping per driver, flushed in bulk
+DRIVER_LOCATION_FLUSH_INTERVAL = 2.0
+DRIVER_LOCATION_BATCH_SIZE = 1000
+DRIVER_LOCATION_MAX_AGE_SECONDS = 300
+
+# Region geofences: Region.geo_boundary polyfilled to H3 (manage.py build_geofences)
+GEOFENCE_CACHE_DIR = getenv('GEOFENCE_CACHE_DIR', str(BASE_DIR / 'geofence_cache'))
+GEOFENCE_RESOLUTION = 9
+# Region saves bump a version counter here (unset keeps it in-process); every worker also rebuilds after MAX_AGE
+GEOFENCE_REDIS_URL = getenv('GEOFENCE_REDIS_URL')
+GEOFENCE_MAX_AGE_SECONDS = 300
+
+# Cached region/country/state profiles for booking; unset REDIS_URL keeps the version counter in-process
+REGION_PROFILE_REDIS_URL = getenv('REGION_PROFILE_REDIS_URL')
+# ... and every worker reloads its profiles after this many seconds regardless
+REGION_PROFILE_MAX_AGE_SECONDS = 300
+
+# Surge engine (payments_module.surge): per-cell multipliers from open rides vs idle drivers, started by
+# the WSGI/ASGI entry points and applied to fares in surge-enabled regions with no SurgePricing window.
+# Off by default; enabling it needs a shared DRIVER_PRESENCE_REDIS_URL, or workers refuse to start
+SURGE_ENGINE_ENABLED = getenv('SURGE_ENGINE_ENABLED', '0') == '1'
+SURGE_RESOLUTION = 9
+SURGE_RECOMPUTE_SECONDS = 30.0
+SURGE_TTL_SECONDS = 90
+SURGE_THRESHOLD = 1.0
+SURGE_SENSITIVITY = 0.5
+SURGE_CAP = 3.0
+SURGE_SMOOTHING = 0.5
+SURGE_MAX_STEP = 0.5
+SURGE_NEIGHBOUR_WEIGHT = 0.5
+# The surge grid is rebuilt on geofence version bumps and after this many seconds regardless
+SURGE_GRID_MAX_AGE_SECONDS = 300
+
+# In-memory SurgePricing windows per region; reread after this many seconds for other workers' writes
+SURGE_WINDOWS_MAX_AGE_SECONDS = 60
+
+# Upper bound on trips priced by one batch fare quote request
+FARE_QUOTE_MAX_TRIPS = 5000
+
+# Per-worker PricingConfig catalogue; unset REDIS_URL keeps its version counter in-process
+PRICING_CATALOGUE_REDIS_URL = getenv('PRICING_CATALOGUE_REDIS_URL')
+# ... and every worker reloads it after this many seconds regardless
+PRICING_CATALOGUE_MAX_AGE_SECONDS = 300
+
+# Upfront fares cached per origin/destination cell pair at this H3 resolution, LRU-bounded
+UPFRONT_FARE_RESOLUTION = 7
+UPFRONT_FARE_CACHE_SIZE = 50000
+UPFRONT_FARE_ROAD_FACTOR = 1.3
+# cached upfront fares are repriced after this many seconds
+UPFRONT_FARE_TTL_SECONDS = 300
+
+# Fare snapshot and payment inserts from concurrent requests are grouped into shared bulk inserts
+GROUP_COMMIT_MAX_BATCH = 500
+GROUP_COMMIT_MAX_WAIT_SECONDS = 0.002
+GROUP_COMMIT_TIMEOUT_SECONDS = 10.0
+
+# Creates the tables of the unmanaged models in the test database
+TEST_RUNNER = "ride_sharing.test_runner.UnmanagedModelTestRunner"
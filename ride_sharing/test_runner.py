@@ -0,0 +1,21 @@
+from django.apps import apps
+from django.test.runner import DiscoverRunner
+
+
+class UnmanagedModelTestRunner(DiscoverRunner):
+    """
+    Most tables here are owned by the schema scripts (managed = False) and
+    there are no migrations, so the test database would have none of them.
+    Marks every model managed for the run so syncdb creates its table.
+    """
+
+    def setup_test_environment(self, *args, **kwargs):
+        self._unmanaged = [model for model in apps.get_models() if not model._meta.managed]
+        for model in self._unmanaged:
+            model._meta.managed = True
+        super().setup_test_environment(*args, **kwargs)
+
+    def teardown_test_environment(self, *args, **kwargs):
+        super().teardown_test_environment(*args, **kwargs)
+        for model in self._unmanaged:
+            model._meta.managed = False
@@ -0,0 +1,61 @@
+import random
+import uuid
+
+import h3
+
+from authentication.models import User
+from drivers.models import Driver
+from payments_module.models import PaymentStatusLookup
+from rides.models import Country, Region, Ride, RideDetailsForRiders, RideStatusLookup
+
+RIDE_STATUSES = ["BOOKED", "DRIVER_ASSIGNED", "RIDE_STARTED", "COMPLETED", "CANCELLED"]
+PAYMENT_STATUSES = ["PENDING", "COMPLETED", "FAILED"]
+
+CENTER = h3.latlng_to_cell(12.9716, 77.5946, 9)
+
+
+def cell_int(cell=CENTER):
+    return h3.str_to_int(cell)
+
+
+def make_lookups():
+    for name in RIDE_STATUSES:
+        RideStatusLookup.objects.get_or_create(ride_status=name)
+    for name in PAYMENT_STATUSES:
+        PaymentStatusLookup.objects.get_or_create(status_name=name)
+
+
+def make_region(**fields):
+    country, _ = Country.objects.get_or_create(
+        country_code="IN",
+        defaults=dict(
+            country_name="India", currency_code="INR", currency_symbol="Rs", minor_unit="2",
+            default_timezone="Asia/Kolkata", tax_model="GST", default_tax_percent=5,
+        ),
+    )
+    return Region.objects.create(country=country, region_name=fields.pop("region_name", "Bengaluru"), **fields)
+
+
+def make_user():
+    return User.objects.create(
+        first_name="test", phone=str(random.randrange(10 ** 11, 10 ** 12)), phone_country_code=91, password_hash="x"
+    )
+
+
+def make_driver(cell=CENTER):
+    return Driver.objects.create(user=make_user(), driving_licence_number="DL", current_h3_index=cell)
+
+
+def make_ride(region, status="BOOKED", pickup=CENTER, dropoff=CENTER, rider=None, driver=None):
+    ride = Ride.objects.create(
+        ride_id=uuid.uuid4(), region=region, driver=driver, currency_code="INR", timezone="Asia/Kolkata"
+    )
+    details = RideDetailsForRiders.objects.create(
+        ride=ride,
+        rider=rider or make_user(),
+        otp=123456,
+        from_location=str(cell_int(pickup)),
+        to_location=str(cell_int(dropoff)),
+        ride_status=RideStatusLookup.objects.get(ride_status=status),
+    )
+    return ride, details
@@ -16,6 +16,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from ride_sharing.metrics import MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -23,4 +24,6 @@ urlpatterns = [
     path('rides/', include('rides.urls')),
     path('app_admin/', include('app_admin.urls')),
     path('payments/', include('payments_module.urls')),
+    path('drivers/', include('drivers.urls')),
+    path('metrics/', MetricsView.as_view()),
 ]
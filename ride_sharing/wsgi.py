@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ride_sharing.settings')
 
 application = get_wsgi_application()
+
+if settings.SURGE_ENGINE_ENABLED:
+    from payments_module.surge import surge_engine
+
+    surge_engine.start()
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class RidesConfig(AppConfig):
     name = 'rides'
+
+    def ready(self):
+        # connects the ride_booked / ride_closed receivers
+        import rides.spatial_index  # noqa: F401
+        import rides.offers  # noqa: F401
+        import rides.rejections  # noqa: F401
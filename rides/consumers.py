@@ -0,0 +1,111 @@
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+
+from rides.offers import offer_broker, offer_message
+from rides.spatial_index import open_ride_index, to_h3_cell
+
+OFFERS_PATH = re.compile(r"^/ws/drivers/(?P<driver_id>[0-9a-fA-F-]{36})/offers/?$")
+
+
+class DriverOfferConsumer:
+    """
+    ASGI WebSocket endpoint that pushes ride offers around a driver's cell,
+    replacing polling of /rides/available/.
+
+    Connect to /ws/drivers/<driver_id>/offers/?h3_index=<cell>&k=1.
+    The client sends {"type": "location", "h3_index": ...} as it moves;
+    the server sends {"type": "offer", ...} and {"type": "offer_withdrawn", ...}.
+    """
+
+    queue_size = 256
+    max_k_ring = 3
+
+    def __init__(self, broker=None, index=None):
+        self.broker = offer_broker if broker is None else broker
+        self.index = open_ride_index if index is None else index
+        self.dropped = 0
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+
+        match = OFFERS_PATH.match(scope["path"])
+        params = parse_qs(scope.get("query_string", b"").decode())
+        cell = to_h3_cell(params.get("h3_index", [None])[0], self.broker.resolution)
+
+        if not match or cell is None:
+            await send({"type": "websocket.close", "code": 4400})
+            return
+
+        try:
+            k_ring = min(max(int(params.get("k", ["1"])[0]), 0), self.max_k_ring)
+        except ValueError:
+            k_ring = 1
+
+        await send({"type": "websocket.accept"})
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_size)
+
+        def deliver(payload):
+            try:
+                loop.call_soon_threadsafe(self._enqueue, queue, payload)
+            except RuntimeError:
+                pass    # loop already closed, connection is gone
+
+        subscription = self.broker.subscribe(match["driver_id"], cell, deliver, k_ring)
+        sender = asyncio.create_task(self._send_loop(queue, send))
+
+        try:
+            await self._send_current_offers(subscription.cells, queue)
+
+            while True:
+                message = await receive()
+
+                if message["type"] == "websocket.disconnect":
+                    break
+
+                if message["type"] == "websocket.receive":
+                    await self._handle(subscription, message, queue)
+        finally:
+            self.broker.unsubscribe(subscription)
+            sender.cancel()
+
+    async def _handle(self, subscription, message, queue):
+        try:
+            data = json.loads(message.get("text") or message.get("bytes") or "{}")
+        except ValueError:
+            return
+
+        if data.get("type") != "location":
+            return
+
+        covered = subscription.cells
+        self.broker.move(subscription, data.get("h3_index"))
+
+        added = subscription.cells - covered
+        if added:
+            await self._send_current_offers(added, queue)
+
+    async def _send_current_offers(self, cells, queue):
+        rides = await sync_to_async(self.index.rides_in_cells)(cells)
+        for ride in rides:
+            self.broker.track(ride)
+            self._enqueue(queue, offer_message(ride))
+
+    def _enqueue(self, queue, payload):
+        # slow consumer: drop the oldest message rather than grow unbounded
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(payload)
+
+    async def _send_loop(self, queue, send):
+        while True:
+            payload = await queue.get()
+            await send({"type": "websocket.send", "text": json.dumps(payload)})
@@ -0,0 +1,388 @@
+import math
+import os
+import threading
+import time
+from pathlib import Path
+
+import h3
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from django.conf import settings
+
+from drivers.presence import grid_ring
+from ride_sharing import metrics
+from rides.spatial_index import to_h3_cell
+
+UNKNOWN_SECONDS = np.iinfo(np.uint16).max     # unreachable / saturated entry
+
+# km/h in one unit of a reported speed (ride_location_log.speed is stored as the apps send it)
+SPEED_UNITS = {"km/h": 1.0, "m/s": 3.6, "mph": 1.609344}
+
+
+def _cell_ints(cells):
+    return np.array([h3.str_to_int(cell) for cell in cells], dtype=np.uint64)
+
+
+def center_distance_m(resolution):
+    """
+    Distance between the centres of two neighbouring cells
+    """
+    return h3.average_hexagon_edge_length(resolution, unit="m") * math.sqrt(3)
+
+
+def speed_factor(unit):
+    """
+    km/h per `unit` (a SPEED_UNITS key)
+    """
+    try:
+        return SPEED_UNITS[unit]
+    except KeyError:
+        raise ValueError(f"unknown speed unit {unit!r}, expected one of {', '.join(SPEED_UNITS)}") from None
+
+
+def speed_unit_ratio(traces, factor, min_kmh=1.0, min_pairs=20):
+    """
+    How the speeds pings report (times `factor`, in km/h) compare with the
+    speeds their positions imply: the median over consecutive pings 1 to
+    60 seconds apart of implied / reported. About 1 when the unit is
+    right, 3.6 or 1/3.6 when m/s and km/h are mixed up. `traces` are
+    per-ride [(latitude, longitude, unix seconds, speed)] in time order;
+    returns None with fewer than `min_pairs` usable pairs.
+    """
+    ratios = []
+    for trace in traces:
+        if len(trace) < 2:
+            continue
+        lat, lng, seconds, speed = (np.asarray(column, dtype=np.float64) for column in zip(*trace))
+        lat, lng = np.radians(lat), np.radians(lng)
+
+        # haversine between consecutive pings
+        a = (
+            np.sin(np.diff(lat) / 2) ** 2
+            + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lng) / 2) ** 2
+        )
+        km = 2 * 6371.0088 * np.arcsin(np.sqrt(a))
+        dt = np.diff(seconds)
+        reported = (speed[:-1] + speed[1:]) / 2 * factor
+
+        usable = (dt >= 1) & (dt <= 60) & (reported >= min_kmh)
+        ratios.append(km[usable] / (dt[usable] / 3600) / reported[usable])
+
+    ratios = np.concatenate(ratios) if ratios else np.empty(0)
+    if len(ratios) < min_pairs:
+        return None
+    return float(np.median(ratios))
+
+
+def build_eta_arrays(cell_speeds, resolution, default_speed_kmh=25.0, buffer_rings=1, path=None, max_cells=None):
+    """
+    Builds a travel-time table over the cells in `cell_speeds` ({cell: km/h})
+    plus `buffer_rings` around them. Moving between neighbours takes the
+    centre distance at the mean speed of the two cells; the table holds
+    the shortest-path seconds between every pair of cells, saturated at
+    UNKNOWN_SECONDS.
+
+    Returns (cells, matrix): cell ints sorted ascending and an (n, n)
+    uint16 array, memory-mapped at `path` (.npy) when given. Raises
+    ValueError before allocating anything when n exceeds `max_cells`.
+    """
+    cells = set()
+    for cell in cell_speeds:
+        cells.update(h3.grid_disk(cell, buffer_rings))
+
+    n = len(cells)
+    if max_cells is not None and n > max_cells:
+        raise ValueError(
+            f"{n} cells at resolution {resolution} exceed the {max_cells} cell limit "
+            f"({n * n * 2 / 2 ** 30:,.1f} GiB table)"
+        )
+
+    cells = sorted(cells, key=h3.str_to_int)
+    position = {cell: i for i, cell in enumerate(cells)}
+
+    known = [speed for speed in cell_speeds.values() if speed]
+    fallback_kmh = float(np.median(known)) if known else default_speed_kmh
+    speeds = np.array([cell_speeds.get(cell) or fallback_kmh for cell in cells]) / 3.6
+
+    step_m = center_distance_m(resolution)
+    rows, cols = [], []
+    for i, cell in enumerate(cells):
+        for neighbour in grid_ring(cell, 1):
+            j = position.get(neighbour)
+            if j is not None:
+                rows.append(i)
+                cols.append(j)
+
+    rows = np.array(rows, dtype=np.intp)
+    cols = np.array(cols, dtype=np.intp)
+    weights = step_m / ((speeds[rows] + speeds[cols]) / 2)
+    graph = csr_matrix((weights, (rows, cols)), shape=(n, n))
+
+    if path is None:
+        matrix = np.empty((n, n), dtype=np.uint16)
+    else:
+        matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint16, shape=(n, n))
+
+    # row blocks keep dijkstra's float64 output small for big regions
+    block = max(1, 2 ** 24 // max(n, 1))
+    for start in range(0, n, block):
+        seconds = dijkstra(graph, indices=np.arange(start, min(start + block, n)))
+        np.nan_to_num(seconds, copy=False, posinf=UNKNOWN_SECONDS)
+        matrix[start:start + block] = np.minimum(np.rint(seconds), UNKNOWN_SECONDS)
+
+    if path is not None:
+        matrix.flush()
+
+    return _cell_ints(cells), matrix
+
+
+class EtaTable:
+    """
+    Cell-to-cell travel times for one region at one resolution. Cells are
+    mapped to compact row ids by binary search over the sorted cell ints,
+    so a batch of lookups is a few vectorized numpy operations.
+    """
+
+    def __init__(self, cells, matrix, resolution, default_speed_kmh=25.0):
+        self.cells = cells
+        self.matrix = matrix
+        self.resolution = resolution
+        self.default_speed_kmh = default_speed_kmh
+
+    @classmethod
+    def load(cls, matrix_path, cells_path, resolution, default_speed_kmh=25.0):
+        return cls(
+            np.load(cells_path),
+            np.load(matrix_path, mmap_mode="r"),
+            resolution,
+            default_speed_kmh,
+        )
+
+    def __len__(self):
+        return len(self.cells)
+
+    def ids(self, cells):
+        """
+        Compact ids for `cells` (any resolution at or below the table's),
+        -1 for cells outside the table
+        """
+        ints = np.array(
+            [h3.str_to_int(cell) if cell else 0 for cell in (to_h3_cell(c, self.resolution) for c in cells)],
+            dtype=np.uint64
+        )
+        ids = np.searchsorted(self.cells, ints)
+        ids[ids >= len(self.cells)] = 0
+        return np.where(self.cells[ids] == ints, ids, -1) if len(self.cells) else np.full(len(ints), -1)
+
+    def _fallback(self, origin, destination):
+        """
+        Straight grid distance at the default speed, for cells the table
+        does not cover or cannot connect
+        """
+        if origin is None or destination is None:
+            return math.nan
+        try:
+            steps = h3.grid_distance(origin, destination)
+        except h3.H3BaseException:
+            return math.nan
+        return steps * center_distance_m(self.resolution) / (self.default_speed_kmh / 3.6)
+
+    def pairs(self, origins, destinations, rows, cols):
+        """
+        Seconds from origins[rows[k]] to destinations[cols[k]] for every k
+        """
+        origin_ids = self.ids(origins)[rows]
+        destination_ids = self.ids(destinations)[cols]
+
+        seconds = self.matrix[origin_ids, destination_ids].astype(np.float64)
+        missing = (origin_ids < 0) | (destination_ids < 0) | (seconds >= UNKNOWN_SECONDS)
+
+        for k in np.flatnonzero(missing):
+            seconds[k] = self._fallback(
+                to_h3_cell(origins[rows[k]], self.resolution),
+                to_h3_cell(destinations[cols[k]], self.resolution),
+            )
+        return seconds
+
+    def pairwise(self, origins, destinations):
+        index = np.arange(len(origins))
+        return self.pairs(origins, destinations, index, index)
+
+    def many_to_many(self, origins, destinations):
+        """
+        (len(origins), len(destinations)) seconds
+        """
+        rows, cols = np.meshgrid(np.arange(len(origins)), np.arange(len(destinations)), indexing="ij")
+        return self.pairs(origins, destinations, rows.ravel(), cols.ravel()).reshape(rows.shape)
+
+
+class EtaService:
+    """
+    Loads per-region ETA tables from `directory` on first use, preferring
+    the finest of `resolutions` that has been built.
+
+    Each build writes a new versioned pair of files (matrix and cells) and
+    then atomically replaces the region's `.current` pointer, so a reader
+    never sees a matrix with another build's cells. Workers check the
+    pointers every `check_interval` seconds and load a rebuilt table
+    without a restart. Builds over `max_cells` cells (n x n uint16 bytes)
+    are refused, leaving the coarser resolutions to serve the region.
+    """
+
+    def __init__(self, directory, resolutions=(9, 8, 7), default_speed_kmh=25.0, check_interval=30.0,
+                 max_cells=30000):
+        self.directory = Path(directory)
+        self.resolutions = resolutions
+        self.default_speed_kmh = default_speed_kmh
+        self.check_interval = check_interval
+        self.max_cells = max_cells
+        self._lock = threading.Lock()
+        self._tables = {}       # region_code -> (table, versions per resolution, checked at)
+        self._counters = {"lookups": 0, "pairs": 0, "misses": 0, "reloads": 0}
+
+    def pointer(self, region_code, resolution):
+        return self.directory / f"{region_code}_r{resolution}.current"
+
+    def files(self, region_code, resolution, version):
+        """
+        (matrix, cells) paths of one build
+        """
+        stem = f"{region_code}_r{resolution}.{version}"
+        return self.directory / f"{stem}.npy", self.directory / f"{stem}.cells.npy"
+
+    def current_version(self, region_code, resolution):
+        try:
+            return self.pointer(region_code, resolution).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def table(self, region_code):
+        region_code = str(region_code)
+        entry = self._tables.get(region_code)
+        now = time.monotonic()
+        if entry is not None and now - entry[2] < self.check_interval:
+            return entry[0]
+
+        with self._lock:
+            versions = tuple(self.current_version(region_code, r) for r in self.resolutions)
+            if entry is not None and entry[1] == versions:
+                self._tables[region_code] = (entry[0], versions, now)
+                return entry[0]
+
+            table = None
+            for resolution, version in zip(self.resolutions, versions):
+                if version is None:
+                    continue
+                try:
+                    table = EtaTable.load(
+                        *self.files(region_code, resolution, version), resolution, self.default_speed_kmh
+                    )
+                except FileNotFoundError:
+                    # replaced again since the pointer was read; the next check picks it up
+                    versions = None
+                    continue
+                break
+
+            if entry is not None:
+                self._counters["reloads"] += 1
+            self._tables[region_code] = (table, versions, now)
+        return table
+
+    def invalidate(self, region_code=None):
+        with self._lock:
+            if region_code is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(str(region_code), None)
+
+    def _point_to(self, region_code, resolution, version):
+        """
+        Switches the region's pointer to `version` (None removes it) and
+        deletes the build it replaced. Readers still mapping the old
+        matrix keep its inode until they reload.
+        """
+        previous = self.current_version(region_code, resolution)
+        pointer = self.pointer(region_code, resolution)
+
+        if version is None:
+            pointer.unlink(missing_ok=True)
+        else:
+            tmp = pointer.with_name(f".{pointer.name}.tmp")
+            tmp.write_text(version)
+            os.replace(tmp, pointer)
+
+        if previous is not None and previous != version:
+            for path in self.files(region_code, resolution, previous):
+                path.unlink(missing_ok=True)
+        self.invalidate(region_code)
+
+    def save(self, region_code, resolution, cell_speeds, buffer_rings=1):
+        """
+        Builds and stores a region's table, replacing any previous one.
+        Raises ValueError, keeping the previous table, when the region
+        has more than `max_cells` cells at this resolution.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        version = f"v{time.time_ns()}"
+        matrix_path, cells_path = self.files(region_code, resolution, version)
+
+        try:
+            cells, matrix = build_eta_arrays(
+                cell_speeds, resolution, self.default_speed_kmh, buffer_rings,
+                path=matrix_path, max_cells=self.max_cells
+            )
+            del matrix
+            np.save(cells_path, cells)
+        except BaseException:
+            matrix_path.unlink(missing_ok=True)
+            cells_path.unlink(missing_ok=True)
+            raise
+
+        self._point_to(region_code, resolution, version)
+        return len(cells)
+
+    def remove(self, region_code, resolution):
+        """
+        Drops a region's table at one resolution, so a coarser one serves it
+        """
+        self._point_to(region_code, resolution, None)
+
+    def pairs(self, region_code, origins, destinations, rows, cols):
+        """
+        Seconds for each (origins[rows[k]], destinations[cols[k]]), or None
+        when the region has no table
+        """
+        table = self.table(region_code)
+        self._counters["lookups"] += 1
+        if table is None:
+            self._counters["misses"] += 1
+            return None
+
+        self._counters["pairs"] += len(rows)
+        return table.pairs(origins, destinations, rows, cols)
+
+    def eta_seconds(self, region_code, origin, destination):
+        """
+        Single origin/destination ETA in whole seconds, or None
+        """
+        seconds = self.pairs(region_code, [origin], [destination], [0], [0])
+        if seconds is None or math.isnan(seconds[0]):
+            return None
+        return int(seconds[0])
+
+    def stats(self):
+        report = {"loaded_regions": sum(1 for entry in self._tables.values() if entry[0] is not None)}
+        report.update(self._counters)
+        return report
+
+
+eta_service = EtaService(
+    getattr(settings, "ETA_MATRIX_DIR", Path(settings.BASE_DIR) / "eta_tables"),
+    resolutions=getattr(settings, "ETA_RESOLUTIONS", (9, 8, 7)),
+    default_speed_kmh=getattr(settings, "ETA_DEFAULT_SPEED_KMH", 25.0),
+    check_interval=getattr(settings, "ETA_RELOAD_CHECK_SECONDS", 30.0),
+    max_cells=getattr(settings, "ETA_MAX_CELLS", 30000),
+)
+
+metrics.register("eta", eta_service.stats)
@@ -0,0 +1,276 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ride_sharing import metrics
+from ride_sharing.lookups import ride_statuses
+from rides.models import EventLog
+
+logger = logging.getLogger(__name__)
+
+
+class RideEvent(NamedTuple):
+    event_id: uuid.UUID
+    ride_id: uuid.UUID
+    ride_status: str                  # status name, e.g. "DRIVER_ASSIGNED"
+    event_time: object
+    driver_id: Optional[uuid.UUID] = None
+    latitude: Optional[str] = None
+    longitude: Optional[str] = None
+
+
+def ride_event(ride_id, ride_status, driver_id=None, latitude=None, longitude=None):
+    """
+    A new event for `ride_id` entering `ride_status`, stamped now
+    """
+    return RideEvent(
+        event_id=uuid.uuid4(),
+        ride_id=ride_id,
+        ride_status=ride_status,
+        event_time=timezone.now(),
+        driver_id=driver_id,
+        latitude=None if latitude is None else str(latitude),
+        longitude=None if longitude is None else str(longitude),
+    )
+
+
+class RideEventBus:
+    """
+    Ride lifecycle events recorded in event_log and handed to in-process
+    subscribers (notifications, analytics, surge ...).
+
+    `publish` inserts the event_log rows in the caller's transaction;
+    status transitions insert them in their compare-and-set statement
+    (see rides.state_machine), so they cost no extra round trip, and
+    booking pays one insert in its transaction. event_log is the durable
+    record: a row exists exactly when its state change committed.
+
+    Delivery to subscribers is best effort. Once the transaction commits
+    the events are queued in memory and a background thread hands them to
+    every subscriber in batches of `flush_events`. A subscriber that
+    raises gets the same events again on later flushes, up to
+    `max_attempts` times, and can use event_id to ignore repeats; after
+    that they are dropped for it. Events are also dropped when the queue
+    is full (counted as overflow) and lost if the worker exits first, so
+    subscribers that cannot miss an event must read event_log instead.
+    """
+
+    def __init__(self, max_events=20000, flush_events=500, flush_interval=0.2, max_attempts=5):
+        self.max_events = max_events
+        self.flush_events = flush_events
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._queue = deque()
+        self._subscribers = {}
+        self._retries = {}            # subscriber -> (attempts, events)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            "published": 0, "written": 0, "delivered": 0, "overflow": 0,
+            "flushes": 0, "subscriber_errors": 0, "abandoned": 0,
+            "last_flush_ms": 0.0, "max_flush_ms": 0.0,
+        }
+
+    def subscribe(self, name, handler):
+        """
+        Registers handler(events) to receive each batch of committed
+        RideEvents; a later subscribe with the same name replaces it
+        """
+        with self._lock:
+            self._subscribers[name] = handler
+
+    def unsubscribe(self, name):
+        with self._lock:
+            self._subscribers.pop(name, None)
+            self._retries.pop(name, None)
+
+    def publish(self, *events, logged=False):
+        """
+        Inserts the event_log rows for `events` in the current transaction
+        (skipped when `logged`, for callers whose statement already
+        inserted them) and queues the events for subscribers once it
+        commits; nothing is written or queued if it rolls back
+        """
+        events = list(events)
+        if not events:
+            return
+        if not logged:
+            self._write(events)
+        else:
+            self._counters["written"] += len(events)
+        transaction.on_commit(lambda: self.offer(events))
+
+    def offer(self, events):
+        """
+        Queues committed events for delivery. Runs in on_commit, so it
+        never touches the database or a subscriber.
+        """
+        with self._lock:
+            full = len(self._queue) + len(events) > self.max_events
+            if not full:
+                self._queue.extend(events)
+                depth = len(self._queue)
+            self._counters["published"] += len(events)
+
+        if full:
+            self._counters["overflow"] += len(events)
+            logger.warning("ride event queue full, %s events not delivered to subscribers", len(events))
+            return
+
+        self._ensure_started()
+        if depth >= self.flush_events:
+            self._wakeup.set()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="ride-events", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("ride event flush failed")
+
+    def _take(self):
+        with self._lock:
+            count = min(len(self._queue), self.flush_events)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def flush(self):
+        """
+        Delivers everything queued so far, retrying subscribers that
+        failed last time. Returns the number of events delivered.
+        """
+        delivered = 0
+
+        with self._flush_lock:
+            while True:
+                batch = self._take()
+                if not batch:
+                    break
+
+                started = time.perf_counter()
+                try:
+                    self._deliver(batch)
+                finally:
+                    elapsed = round((time.perf_counter() - started) * 1000, 2)
+                    self._counters["flushes"] += 1
+                    self._counters["last_flush_ms"] = elapsed
+                    self._counters["max_flush_ms"] = max(self._counters["max_flush_ms"], elapsed)
+                delivered += len(batch)
+
+            if not delivered:
+                self._retry_subscribers()
+
+        return delivered
+
+    def _write(self, events):
+        EventLog.objects.bulk_create(
+            [
+                EventLog(
+                    event_id=event.event_id,
+                    ride_id=event.ride_id,
+                    ride_status_id=ride_statuses.get(event.ride_status).pk,
+                    latitude=event.latitude,
+                    longitude=event.longitude,
+                    event_time=event.event_time,
+                )
+                for event in events
+            ]
+        )
+        self._counters["written"] += len(events)
+
+    def _deliver(self, batch):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+
+        for name, handler in subscribers:
+            with self._lock:
+                attempts, pending = self._retries.get(name, (0, []))
+            self._send(name, handler, attempts, pending + batch)
+
+    def _retry_subscribers(self):
+        with self._lock:
+            retries = [
+                (name, self._subscribers[name], attempts, events)
+                for name, (attempts, events) in self._retries.items()
+                if name in self._subscribers
+            ]
+
+        for name, handler, attempts, events in retries:
+            self._send(name, handler, attempts, events)
+
+    def _send(self, name, handler, attempts, events):
+        try:
+            handler(events)
+        except Exception:
+            attempts += 1
+            self._counters["subscriber_errors"] += 1
+            logger.exception("ride event subscriber %s failed (attempt %s)", name, attempts)
+
+            with self._lock:
+                if attempts >= self.max_attempts:
+                    self._retries.pop(name, None)
+                    self._counters["abandoned"] += len(events)
+                else:
+                    self._retries[name] = (attempts, events)
+            return
+
+        with self._lock:
+            self._retries.pop(name, None)
+        self._counters["delivered"] += len(events)
+
+    def stop(self, flush=True):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if flush:
+            self.flush()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def stats(self):
+        report = {
+            "depth": len(self),
+            "capacity": self.max_events,
+            "subscribers": len(self._subscribers),
+            "retrying": {name: len(events) for name, (_, events) in self._retries.items()},
+        }
+        report.update(self._counters)
+        return report
+
+
+ride_events = RideEventBus(
+    max_events=getattr(settings, "RIDE_EVENTS_MAX_QUEUED", 20000),
+    flush_events=getattr(settings, "RIDE_EVENTS_FLUSH_EVENTS", 500),
+    flush_interval=getattr(settings, "RIDE_EVENTS_FLUSH_INTERVAL", 0.2),
+    max_attempts=getattr(settings, "RIDE_EVENTS_MAX_ATTEMPTS", 5),
+)
+
+metrics.register("ride_events", ride_events.stats)
+
+atexit.register(ride_events.stop)
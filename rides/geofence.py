@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import h3
+import numpy as np
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from ride_sharing import metrics
+from ride_sharing.local_redis import get_redis_client
+from rides.models import Region, TenantRegion
+from rides.spatial_index import to_h3_cell
+
+
+VERSION_KEY = "geofences:version"
+
+def boundary_shape(boundary):
+    """
+    An h3 shape for a Region.geo_boundary: GeoJSON (Polygon, MultiPolygon,
+    Feature or FeatureCollection, [lng, lat] order) or a bare list of
+    [lat, lng] pairs tracing the outer ring. Returns None when empty.
+    """
+    if not boundary:
+        return None
+
+    if isinstance(boundary, str):
+        boundary = json.loads(boundary)
+
+    if isinstance(boundary, list):
+        return h3.LatLngPoly([(float(lat), float(lng)) for lat, lng in boundary])
+
+    if boundary.get("type") == "Feature":
+        return boundary_shape(boundary.get("geometry"))
+
+    if boundary.get("type") == "FeatureCollection":
+        polygons = []
+        for feature in boundary.get("features", []):
+            shape = boundary_shape(feature)
+            if shape is not None:
+                polygons.extend(shape if isinstance(shape, h3.LatLngMultiPoly) else [shape])
+        return h3.LatLngMultiPoly(*polygons) if polygons else None
+
+    return h3.geo_to_h3shape(boundary)
+
+
+def polyfill(boundary, resolution):
+    """
+    Cell ints (uint64, sorted) whose centres fall inside the boundary
+    """
+    shape = boundary_shape(boundary)
+    if shape is None:
+        return np.empty(0, dtype=np.uint64)
+
+    cells = np.array([h3.str_to_int(cell) for cell in h3.h3shape_to_cells(shape, resolution)], dtype=np.uint64)
+    cells.sort()
+    return cells
+
+
+def boundary_fingerprint(boundary, resolution):
+    raw = json.dumps(boundary, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(f"{resolution}:{raw}".encode()).hexdigest()[:16]
+
+
+class GeofenceIndex:
+    """
+    Every active region's geo_boundary polyfilled into H3 cells at
+    `resolution`, flattened into one {cell int: region_code} dict so a
+    pickup resolves to its region with a single lookup.
+
+    Polyfills are cached in `cache_dir` under the boundary's fingerprint,
+    so a worker only recomputes regions whose boundary changed. Region and
+    TenantRegion saves bump a version counter in a redis-compatible
+    client, as region profiles do, and every worker sharing the client
+    rebuilds its index on next use. The index is also rebuilt once it is
+    `max_age` seconds old, which bounds how long edits made elsewhere go
+    unseen when the counter is per-process or a save bypassed the ORM.
+    """
+
+    def __init__(self, cache_dir, client, resolution=9, max_age=300):
+        self.cache_dir = Path(cache_dir)
+        self.client = client
+        self.resolution = resolution
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._by_cell = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._cells = {}
+        self._tenants = {}
+        self._counters = {
+            "lookups": 0, "misses": 0, "loads": 0, "polyfills": 0, "cache_hits": 0, "invalidations": 0,
+        }
+        self._last_load_ms = 0.0
+        self._overlaps = 0
+
+        for model in (Region, TenantRegion):
+            post_save.connect(self._on_change, sender=model, weak=False)
+            post_delete.connect(self._on_change, sender=model, weak=False)
+
+    def _on_change(self, sender, **kwargs):
+        self.bump()
+
+    def bump(self):
+        self.client.incr(VERSION_KEY)
+
+    def current_version(self):
+        return int(self.client.get(VERSION_KEY) or 0)
+
+    def invalidate(self):
+        """
+        Drops this worker's index only; `bump` reaches every worker
+        """
+        with self._lock:
+            self._by_cell = None
+
+    def path(self, region_code, fingerprint):
+        return self.cache_dir / f"{region_code}_r{self.resolution}_{fingerprint}.npy"
+
+    def region_cells(self, region_code, boundary):
+        """
+        The polyfill of one region, from the disk cache when its boundary
+        has not changed since it was stored
+        """
+        path = self.path(region_code, boundary_fingerprint(boundary, self.resolution))
+        if path.exists():
+            self._counters["cache_hits"] += 1
+            return np.load(path)
+
+        cells = polyfill(boundary, self.resolution)
+        self._counters["polyfills"] += 1
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.tmp.npy")
+        np.save(tmp, cells)
+        os.replace(tmp, path)
+        return cells
+
+    def load(self, version=None):
+        started = time.perf_counter()
+        version = self.current_version() if version is None else version
+
+        regions = (
+            Region.objects
+            .filter(is_service_active=True, geo_boundary__isnull=False)
+            .order_by("region_code")
+            .values_list("region_code", "geo_boundary")
+        )
+        tenants = {}
+        for region_code, tenant_id in (
+            TenantRegion.objects.filter(is_active=True).values_list("region_id", "tenant_id")
+        ):
+            tenants.setdefault(str(region_code), []).append(tenant_id)
+
+        by_cell, cells, overlaps = {}, {}, 0
+        for region_code, boundary in regions:
+            region_code = str(region_code)
+            region_cells = self.region_cells(region_code, boundary)
+            if not len(region_cells):
+                continue
+
+            cells[region_code] = region_cells
+            before = len(by_cell)
+            # the first region (by code) keeps a cell claimed by two regions
+            for cell in region_cells.tolist():
+                by_cell.setdefault(cell, region_code)
+            overlaps += len(region_cells) - (len(by_cell) - before)
+
+        with self._lock:
+            if self._by_cell is not None and version != self._version:
+                self._counters["invalidations"] += 1
+            self._by_cell = by_cell
+            self._version = version
+            self._loaded_at = time.monotonic()
+            self._cells = cells
+            self._tenants = tenants
+            self._overlaps = overlaps
+            self._counters["loads"] += 1
+            self._last_load_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def _index(self):
+        version = self.current_version()
+        by_cell = self._by_cell
+        if by_cell is None or version != self._version or time.monotonic() - self._loaded_at > self.max_age:
+            self.load(version)
+            by_cell = self._by_cell
+        return by_cell
+
+    def regions(self):
+        """
+        region_codes (str) that have a geofence
+        """
+        self._index()
+        return sorted(self._cells)
+
+    def covers(self, region_code):
+        """
+        Whether `region_code` has a boundary to check pickups against
+        """
+        self._index()
+        return str(region_code) in self._cells
+
+    def region_for_cell(self, cell):
+        """
+        region_code (str) of the active region containing `cell` (int, hex
+        or decimal string at any resolution at or finer than the index),
+        or None
+        """
+        by_cell = self._index()
+        self._counters["lookups"] += 1
+
+        cell = to_h3_cell(cell, self.resolution)
+        if cell is None or h3.get_resolution(cell) != self.resolution:
+            self._counters["misses"] += 1
+            return None
+
+        region_code = by_cell.get(h3.str_to_int(cell))
+        if region_code is None:
+            self._counters["misses"] += 1
+        return region_code
+
+    def regions_for_cells(self, cells):
+        """
+        region_for_cell over many cells, for bucketing by region
+        """
+        return [self.region_for_cell(cell) for cell in cells]
+
+    def tenants_for_cell(self, cell):
+        """
+        Tenant ids with an active TenantRegion on the region of `cell`
+        """
+        region_code = self.region_for_cell(cell)
+        return list(self._tenants.get(region_code, ())) if region_code else []
+
+    def cells_of(self, region_code):
+        """
+        Sorted uint64 cell ints covering `region_code` (empty if none)
+        """
+        self._index()
+        return self._cells.get(str(region_code), np.empty(0, dtype=np.uint64))
+
+    def stats(self):
+        report = {
+            "regions": len(self._cells),
+            "cells": len(self._by_cell or ()),
+            "overlapping_cells": self._overlaps,
+            "last_load_ms": self._last_load_ms,
+            "version": self._version,
+        }
+        report.update(self._counters)
+        return report
+
+
+geofences = GeofenceIndex(
+    getattr(settings, "GEOFENCE_CACHE_DIR", Path(settings.BASE_DIR) / "geofence_cache"),
+    get_redis_client(getattr(settings, "GEOFENCE_REDIS_URL", None)),
+    resolution=getattr(settings, "GEOFENCE_RESOLUTION", 9),
+    max_age=getattr(settings, "GEOFENCE_MAX_AGE_SECONDS", 300),
+)
+
+metrics.register("geofences", geofences.stats)
@@ -0,0 +1,83 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.utils.encoders import JSONEncoder
+
+from rides.models import RideDetailsForRiders
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row):
+    """
+    Opaque cursor pointing just past `row` in newest-first order
+    """
+    raw = f"{row.created_at.isoformat()}|{row.ride_detail_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, ride_detail_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(ride_detail_id)
+    except (ValueError, UnicodeDecodeError) as error:
+        raise InvalidCursor(f"invalid cursor {cursor!r}") from error
+
+
+def history_queryset(user_id, after=None):
+    """
+    A rider's rides newest first, with ride, region and status joined in.
+    `after` is a decoded cursor; the keyset filter lets the database start
+    at that row through an index on (rider_id, created_at, ride_detail_id)
+    instead of counting past every earlier one.
+    """
+    rides = (
+        RideDetailsForRiders.objects
+        .filter(rider_id=user_id)
+        .select_related("ride__region", "ride_status")
+        .order_by("-created_at", "-ride_detail_id")
+    )
+    if after is not None:
+        created_at, ride_detail_id = after
+        rides = rides.filter(
+            Q(created_at__lt=created_at)
+            | Q(created_at=created_at, ride_detail_id__lt=ride_detail_id)
+        )
+    return rides
+
+
+def history_page(user_id, cursor=None, limit=50):
+    """
+    Returns (rows, next_cursor); next_cursor is None on the last page
+    """
+    after = decode_cursor(cursor) if cursor else None
+    rows = list(history_queryset(user_id, after)[:limit + 1])
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def iter_history_ndjson(user_id, serializer_class, chunk_size=1000):
+    """
+    Yields a rider's whole history as newline-delimited JSON, one keyset
+    page of `chunk_size` rows per query so memory stays flat however long
+    the history is
+    """
+    encoder = JSONEncoder()
+    after = None
+    while True:
+        rows = list(history_queryset(user_id, after)[:chunk_size])
+        if not rows:
+            return
+
+        yield "".join(encoder.encode(item) + "\n" for item in serializer_class(rows, many=True).data)
+
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1].created_at, rows[-1].ride_detail_id)
@@ -0,0 +1,206 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections
+
+from drivers.locations import driver_locations
+from ride_sharing import metrics
+from rides.location_ingest import drop_unknown_references, write_location_points
+
+logger = logging.getLogger(__name__)
+
+
+class LocationWriteBuffer:
+    """
+    Write-behind buffer for GPS pings. Requests enqueue points and return
+    at once; a background thread writes them to ride_location_log in large
+    batches once `flush_points` are waiting or every `flush_interval`
+    seconds, and hands each driver's latest point to driver_locations.
+
+    The queue is bounded: when it holds `max_points`, offers are refused
+    (and counted as dropped) so callers can shed load instead of growing
+    memory without limit.
+
+    A batch the database rejects for its data is split in halves until
+    the bad points are isolated; those are logged and dropped
+    (dead-lettered) and the rest written. A batch that fails for any
+    other reason (the database being unreachable) is set aside and
+    retried after newer points on later flushes, at most `max_attempts`
+    times, so one failure never blocks the queue.
+    """
+
+    def __init__(self, max_points=50000, flush_points=2000, flush_interval=0.5, max_attempts=10):
+        self.max_points = max_points
+        self.flush_points = flush_points
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._queue = deque()
+        self._retries = deque()     # (attempts, batch), only touched under _flush_lock
+        self._retrying = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            "accepted": 0, "dropped": 0, "written": 0, "rejected": 0,
+            "flushes": 0, "failed_flushes": 0, "splits": 0, "dead_lettered": 0,
+            "last_flush_ms": 0.0, "max_flush_ms": 0.0,
+        }
+
+    def offer(self, points):
+        """
+        Queues `points` for writing. Returns False, keeping none of them,
+        when the buffer is full.
+        """
+        with self._lock:
+            if len(self._queue) + self._retrying + len(points) > self.max_points:
+                self._counters["dropped"] += len(points)
+                return False
+
+            self._queue.extend(points)
+            self._counters["accepted"] += len(points)
+            depth = len(self._queue)
+
+        self._ensure_started()
+        if depth >= self.flush_points:
+            self._wakeup.set()
+        return True
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="location-write-buffer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("location buffer flush failed")
+
+    def _take(self):
+        with self._lock:
+            count = min(len(self._queue), self.flush_points)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def flush(self):
+        """
+        Writes everything queued so far, one batch of `flush_points` at a
+        time, then retries the batches set aside by earlier flushes.
+        Returns the number of points written.
+        """
+        written = 0
+
+        with self._flush_lock:
+            close_old_connections()
+
+            while True:
+                batch = self._take()
+                if not batch:
+                    break
+                count = self._flush_batch(batch, 0)
+                if count is None:
+                    # the database is failing; leave the rest for the next flush
+                    return written
+                written += count
+
+            for _ in range(len(self._retries)):
+                attempts, batch = self._retries.popleft()
+                with self._lock:
+                    self._retrying -= len(batch)
+                written += self._flush_batch(batch, attempts) or 0
+
+        return written
+
+    def _flush_batch(self, batch, attempts):
+        """
+        Points written, or None when the batch failed and was set aside
+        (or dropped after `max_attempts`)
+        """
+        started = time.perf_counter()
+        try:
+            return self._write_or_split(batch)
+        except Exception as error:
+            self._counters["failed_flushes"] += 1
+            logger.exception("location buffer flush of %s points failed", len(batch))
+            if attempts + 1 >= self.max_attempts:
+                self._dead_letter(batch, error)
+            else:
+                self._retries.append((attempts + 1, batch))
+                with self._lock:
+                    self._retrying += len(batch)
+            return None
+        finally:
+            elapsed = round((time.perf_counter() - started) * 1000, 2)
+            self._counters["flushes"] += 1
+            self._counters["last_flush_ms"] = elapsed
+            self._counters["max_flush_ms"] = max(self._counters["max_flush_ms"], elapsed)
+
+    def _write_or_split(self, batch):
+        try:
+            return self._write(batch)
+        except (DataError, IntegrityError) as error:
+            # bad rows: halve the batch until they are isolated
+            if len(batch) == 1:
+                self._dead_letter(batch, error)
+                return 0
+            self._counters["splits"] += 1
+            middle = len(batch) // 2
+            return self._write_or_split(batch[:middle]) + self._write_or_split(batch[middle:])
+
+    def _dead_letter(self, batch, error):
+        self._counters["dead_lettered"] += len(batch)
+        for point in batch:
+            logger.warning("dropping location point %s: %s", point, error)
+
+    def _write(self, batch):
+        known, rejected = drop_unknown_references(batch)
+
+        written = write_location_points(known)
+        driver_locations.update_many(known)
+
+        self._counters["written"] += written
+        self._counters["rejected"] += len(rejected)
+        return written
+
+    def stop(self, flush=True):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if flush:
+            self.flush()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def stats(self):
+        report = {"depth": len(self), "retrying": self._retrying, "capacity": self.max_points}
+        report.update(self._counters)
+        return report
+
+
+location_buffer = LocationWriteBuffer(
+    max_points=getattr(settings, "LOCATION_BUFFER_MAX_POINTS", 50000),
+    flush_points=getattr(settings, "LOCATION_BUFFER_FLUSH_POINTS", 2000),
+    flush_interval=getattr(settings, "LOCATION_BUFFER_FLUSH_INTERVAL", 0.5),
+    max_attempts=getattr(settings, "LOCATION_BUFFER_MAX_ATTEMPTS", 10),
+)
+
+metrics.register("location_buffer", location_buffer.stats)
+
+atexit.register(location_buffer.stop)
@@ -0,0 +1,258 @@
+import random
+import threading
+import time
+import uuid
+from decimal import Decimal, InvalidOperation
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from drivers.models import Driver
+from rides.models import Ride, RideLocationLog
+
+
+class LocationPoint(NamedTuple):
+    ride_id: uuid.UUID
+    driver_id: uuid.UUID
+    latitude: float
+    longitude: float
+    heading_towards: object
+    h3_index: str
+    speed: object
+
+
+def _uuid(value):
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+_speed_field = RideLocationLog._meta.get_field("speed")
+SPEED_STEP = Decimal(1).scaleb(-_speed_field.decimal_places)
+MAX_SPEED = Decimal(10 ** (_speed_field.max_digits - _speed_field.decimal_places)) - SPEED_STEP
+
+
+class SpeedError(ValueError):
+    pass
+
+
+def parse_speed(value):
+    """
+    A speed as the Decimal RideLocationLog.speed stores, or None. Rejects
+    NaN, infinities, negatives and anything the column cannot hold, which
+    would otherwise fail the whole insert batch.
+    """
+    if value is None or value == "":
+        return None
+
+    speed = Decimal(str(value))
+    if not speed.is_finite():
+        raise SpeedError("speed must be a finite number")
+
+    try:
+        speed = speed.quantize(SPEED_STEP)
+    except InvalidOperation:
+        speed = None        # too many digits to round, far out of range
+    if speed is None or not 0 <= speed <= MAX_SPEED:
+        raise SpeedError(f"speed must be between 0 and {MAX_SPEED}")
+    return speed
+
+
+def parse_point(raw, defaults=None):
+    """
+    Validates one GPS ping without a full ModelSerializer pass.
+    `defaults` supplies ride_id / driver_id shared by a whole batch.
+    """
+    if defaults:
+        raw = {**defaults, **raw}
+
+    try:
+        latitude = float(raw["latitude"])
+        longitude = float(raw["longitude"])
+        h3_index = str(raw["h3_index"])
+        heading = raw.get("heading_towards")
+        point = LocationPoint(
+            ride_id=_uuid(raw["ride_id"] if "ride_id" in raw else raw["ride"]),
+            driver_id=_uuid(raw["driver_id"]),
+            latitude=latitude,
+            longitude=longitude,
+            heading_towards=None if heading is None else str(heading),
+            h3_index=h3_index,
+            speed=parse_speed(raw.get("speed")),
+        )
+    except KeyError as missing:
+        raise ValueError(f"{missing.args[0]} is required")
+    except SpeedError:
+        raise
+    except (TypeError, ValueError, InvalidOperation, AttributeError):
+        raise ValueError("invalid value")
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("latitude/longitude out of range")
+    if len(h3_index) > 20:
+        raise ValueError("h3_index too long")
+
+    return point
+
+
+def parse_location_batch(data):
+    """
+    Accepts either a list of points or {"ride_id", "driver_id", "points": [...]}
+    where the top-level ids apply to every point that does not set its own.
+    Points decoded from binary frames pass through as they are.
+    Raises ValidationError listing the bad points by position.
+    """
+    defaults = None
+    points = data
+
+    if isinstance(data, dict):
+        points = data.get("points")
+        defaults = {key: data[key] for key in ("ride_id", "driver_id") if key in data}
+
+    if not isinstance(points, list) or not points:
+        raise ValidationError({"points": "A non-empty list of points is required"})
+
+    max_points = getattr(settings, "LOCATION_BATCH_MAX_POINTS", 5000)
+    if len(points) > max_points:
+        raise ValidationError({"points": f"At most {max_points} points per batch"})
+
+    parsed = []
+    errors = {}
+
+    for position, raw in enumerate(points):
+        if isinstance(raw, LocationPoint):
+            # already decoded and checked by LocationFrameParser
+            parsed.append(raw)
+            continue
+        if not isinstance(raw, dict):
+            errors[position] = "expected an object"
+            continue
+        try:
+            parsed.append(parse_point(raw, defaults))
+        except ValueError as error:
+            errors[position] = str(error)
+
+    if errors:
+        raise ValidationError({"points": errors})
+
+    return parsed
+
+
+def drop_unknown_references(points):
+    """
+    Resolves the batch's drivers and rides with one query each and splits
+    the points into (known, rejected)
+    """
+    driver_ids = {point.driver_id for point in points}
+    ride_ids = {point.ride_id for point in points}
+
+    known_drivers = set(Driver.objects.filter(pk__in=driver_ids).values_list("pk", flat=True))
+    known_rides = set(Ride.objects.filter(pk__in=ride_ids).values_list("pk", flat=True))
+
+    known, rejected = [], []
+    for point in points:
+        if point.driver_id in known_drivers and point.ride_id in known_rides:
+            known.append(point)
+        else:
+            rejected.append(point)
+
+    return known, rejected
+
+
+_log_id_lock = threading.Lock()
+_last_log_id = (0, 0)     # (unix ms, 74-bit sequence)
+
+
+def ordered_log_ids(count):
+    """
+    `count` log ids laid out like UUIDv7 (millisecond timestamp first,
+    then a sequence) that sort in the order they were made in this
+    process. A flush stamps all its rows with one updated_at, so the id
+    is what keeps a ride's points in arrival order.
+    """
+    global _last_log_id
+
+    with _log_id_lock:
+        millis = time.time_ns() // 1_000_000
+        last_millis, sequence = _last_log_id
+        if millis > last_millis:
+            # start low in a fresh millisecond, leaving room to count up
+            sequence = random.getrandbits(64)
+        else:
+            millis = last_millis
+        _last_log_id = (millis, sequence + count)
+
+    ids = []
+    for value in range(sequence + 1, sequence + count + 1):
+        ids.append(uuid.UUID(int=(
+            millis << 80 | 0x7 << 76 | (value >> 62) << 64 | 0b10 << 62 | value & ((1 << 62) - 1)
+        )))
+    return ids
+
+
+def write_location_points(points, batch_size=2000):
+    """
+    Inserts points into ride_location_log, with COPY when the driver
+    supports it (psycopg 3) and bulk_create otherwise
+    """
+    if not points:
+        return 0
+
+    now = timezone.now()
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            raw_cursor = getattr(cursor, "cursor", None)
+
+            if connection.vendor == "postgresql" and hasattr(raw_cursor, "copy"):
+                # raise django.db errors (DataError, IntegrityError) as the ORM path does
+                with connection.wrap_database_errors:
+                    _copy_points(raw_cursor, points, now)
+            else:
+                RideLocationLog.objects.bulk_create(
+                    [_as_model(log_id, point) for log_id, point in zip(ordered_log_ids(len(points)), points)],
+                    batch_size=batch_size
+                )
+
+    return len(points)
+
+
+_COPY_COLUMNS = (
+    "log_id", "ride_id", "driver_id", "latitude", "longitude",
+    "heading_towards", "h3_index", "speed", "updated_at",
+)
+
+
+def _copy_points(raw_cursor, points, now):
+    sql = "COPY {} ({}) FROM STDIN".format(
+        connection.ops.quote_name(RideLocationLog._meta.db_table),
+        ", ".join(_COPY_COLUMNS),
+    )
+
+    with raw_cursor.copy(sql) as copy:
+        for log_id, point in zip(ordered_log_ids(len(points)), points):
+            copy.write_row((
+                log_id,
+                point.ride_id,
+                point.driver_id,
+                repr(point.latitude),
+                repr(point.longitude),
+                point.heading_towards,
+                point.h3_index,
+                point.speed,
+                now,
+            ))
+
+
+def _as_model(log_id, point):
+    return RideLocationLog(
+        log_id=log_id,
+        ride_id=point.ride_id,
+        driver_id=point.driver_id,
+        latitude=repr(point.latitude),
+        longitude=repr(point.longitude),
+        heading_towards=point.heading_towards,
+        h3_index=point.h3_index,
+        speed=point.speed,
+    )
@@ -0,0 +1,141 @@
+import random
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from drivers.models import Driver, VehicleDriverAssignment
+from ride_sharing.lookups import ride_statuses
+from rides.models import EventLog, Ride, RideDetailsForRiders
+from rides.state_machine import accept_ride
+
+
+def accept_with_row_lock(ride_id, driver_id, otp):
+    """
+    The previous AcceptRideView flow, kept for comparison: lock the details
+    row, check it, then write details, ride and event_log separately
+    """
+    with transaction.atomic():
+        details = RideDetailsForRiders.objects.select_for_update().get(ride_id=ride_id)
+        if details.ride_status_id != ride_statuses.get("BOOKED").pk or details.verification_status:
+            return "already_accepted"
+        if details.otp != int(otp):
+            return "invalid_otp"
+
+        accepted = ride_statuses.get("DRIVER_ASSIGNED")
+        details.verification_status = True
+        details.ride_status = accepted
+        details.save()
+
+        now = timezone.now()
+        vehicle = VehicleDriverAssignment.objects.filter(
+            driver_id=driver_id, start_time__lte=now, end_time__gte=now
+        ).first()
+        Ride.objects.filter(ride_id=ride_id).update(driver_id=driver_id, vehicle=vehicle)
+        EventLog.objects.create(ride_id=ride_id, ride_status=accepted)
+    return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Has many threads race to accept the same BOOKED rides and checks each "
+        "ride was accepted exactly once. Moves the sampled rides to DRIVER_ASSIGNED."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rides", type=int, default=50)
+        parser.add_argument("--threads", type=int, default=32)
+        parser.add_argument("--mode", choices=["cas", "lock"], default="cas")
+        parser.add_argument("--reset", action="store_true", help="put the sampled rides back to BOOKED first")
+
+    def handle(self, *args, **options):
+        booked = ride_statuses.get("BOOKED")
+
+        if options["reset"]:
+            sample = list(
+                RideDetailsForRiders.objects.order_by("ride_id")
+                .values_list("ride_id", flat=True)[:options["rides"]]
+            )
+            RideDetailsForRiders.objects.filter(ride_id__in=sample).update(
+                ride_status=booked, verification_status=False
+            )
+            Ride.objects.filter(ride_id__in=sample).update(driver=None, vehicle=None)
+
+        rides = list(
+            RideDetailsForRiders.objects
+            .filter(ride_status=booked, verification_status=False)
+            .order_by("ride_id")
+            .values_list("ride_id", "otp")[:options["rides"]]
+        )
+        drivers = list(Driver.objects.values_list("driver_id", flat=True)[:options["threads"]])
+        if not rides or not drivers:
+            self.stdout.write("need BOOKED rides and drivers in the database")
+            return
+
+        accept = accept_ride if options["mode"] == "cas" else accept_with_row_lock
+        wins = {ride_id: [] for ride_id, _ in rides}
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        start = threading.Barrier(options["threads"])
+        started_at = timezone.now()
+
+        def worker(n):
+            driver_id = drivers[n % len(drivers)]
+            order = list(rides)
+            random.Random(n).shuffle(order)
+            start.wait()
+            try:
+                for ride_id, otp in order:
+                    began = time.perf_counter()
+                    try:
+                        result = accept(ride_id, driver_id, otp)
+                    except Exception as error:
+                        with lock:
+                            errors.append(repr(error))
+                        continue
+                    elapsed = time.perf_counter() - began
+                    with lock:
+                        latencies.append(elapsed)
+                        if result is None:
+                            wins[ride_id].append(driver_id)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(options["threads"])]
+        began = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - began
+
+        events = {}
+        for ride_id in EventLog.objects.filter(
+            ride_id__in=list(wins),
+            ride_status=ride_statuses.get("DRIVER_ASSIGNED"),
+            event_time__gte=started_at
+        ).values_list("ride_id", flat=True):
+            events[ride_id] = events.get(ride_id, 0) + 1
+        assigned = dict(Ride.objects.filter(ride_id__in=list(wins)).values_list("ride_id", "driver_id"))
+
+        exactly_once = sum(
+            1 for ride_id, winners in wins.items()
+            if len(winners) == 1 and events.get(ride_id) == 1 and assigned.get(ride_id) == winners[0]
+        )
+        latencies.sort()
+
+        self.stdout.write(
+            f"{options['mode']}: {len(rides)} rides x {options['threads']} threads, "
+            f"{len(latencies)} attempts in {wall:.2f}s ({len(latencies) / wall:,.0f}/s)"
+        )
+        self.stdout.write(
+            f"  latency p50 {statistics.median(latencies) * 1000:.2f} ms, "
+            f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms"
+        )
+        self.stdout.write(f"  accepted exactly once: {exactly_once}/{len(rides)}, errors: {len(errors)}")
+        if errors:
+            self.stdout.write(f"  first error: {errors[0]}")
@@ -0,0 +1,99 @@
+import time
+import uuid
+
+import h3
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from authentication.models import User
+from ride_sharing.lookups import ride_statuses
+from rides.eta import eta_service
+from rides.geofence import geofences
+from rides.models import Region, Ride, RideDetailsForRiders
+from rides.serializers import BookRideSerializer
+
+
+def book_with_lookups(user_id, region_code, from_location, to_location):
+    """
+    The previous BookRideSerializer.create flow, kept for comparison:
+    user, region and the region's country are read on every booking
+    """
+    user = User.objects.get(user_id=user_id)
+    region = Region.objects.get(region_code=region_code)
+
+    ride = Ride.objects.create(
+        ride_id=uuid.uuid4(),
+        region=region,
+        currency_code=region.country.currency_code,
+        timezone=region.country.default_timezone,
+        ride_eta_seconds=eta_service.eta_seconds(region.region_code, from_location, to_location)
+    )
+    RideDetailsForRiders.objects.create(
+        ride=ride,
+        rider=user,
+        otp=123456,
+        from_location=from_location,
+        to_location=to_location,
+        ride_status=ride_statuses.get("BOOKED")
+    )
+    return ride
+
+
+def book_with_profile(user_id, region_code, from_location, to_location):
+    serializer = BookRideSerializer(data={
+        "user_id": user_id,
+        "region_code": region_code,
+        "from_location": from_location,
+        "to_location": to_location,
+    })
+    serializer.is_valid(raise_exception=True)
+    ride, _ = serializer.save()
+    return ride
+
+
+class Command(BaseCommand):
+    help = (
+        "Counts the queries and time per booking with per-request region/user "
+        "lookups and with the region profile cache. Inserts the booked rides."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bookings", type=int, default=200)
+
+    def handle(self, *args, **options):
+        user = User.objects.first()
+        region = Region.objects.filter(is_service_active=True).first()
+        if user is None or region is None:
+            self.stdout.write("need a user and an active region in the database")
+            return
+
+        # a pickup inside the region's geofence when it has one
+        cells = geofences.cells_of(region.region_code)
+        if len(cells):
+            from_location = to_location = int(cells[len(cells) // 2])
+        else:
+            from_location = to_location = h3.str_to_int(h3.latlng_to_cell(12.9716, 77.5946, 9))
+
+        for name, book in (("lookups", book_with_lookups), ("profile", book_with_profile)):
+            # one warm-up booking fills the worker caches
+            book(str(user.user_id), str(region.region_code), from_location, to_location)
+
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                for _ in range(options["bookings"]):
+                    book(str(user.user_id), str(region.region_code), from_location, to_location)
+                elapsed = time.perf_counter() - started
+
+            kinds = {}
+            for query in captured.captured_queries:
+                kind = query["sql"].lstrip().split(None, 1)[0].upper()
+                kinds[kind] = kinds.get(kind, 0) + 1
+
+            per_booking = ", ".join(
+                f"{count / options['bookings']:.2f} {kind}" for kind, count in sorted(kinds.items())
+            )
+            self.stdout.write(
+                f"{name:>8}: {len(captured) / options['bookings']:.2f} queries per booking ({per_booking}), "
+                f"{elapsed / options['bookings'] * 1000:.2f} ms per booking"
+            )
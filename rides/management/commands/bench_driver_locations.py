@@ -0,0 +1,77 @@
+import random
+import time
+
+import h3
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from drivers.locations import DriverLocationState
+from drivers.models import Driver
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays driver pings against the drivers table, once with one UPDATE per "
+        "ping and once through the coalescing DriverLocationState, and reports "
+        "rows written per ping. Overwrites the sampled drivers' positions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drivers", type=int, default=500)
+        parser.add_argument("--seconds", type=int, default=20, help="simulated seconds of pings")
+        parser.add_argument("--ping-interval", type=float, default=1.0, help="seconds between a driver's pings")
+        parser.add_argument("--flush-interval", type=float, default=2.0)
+
+    def handle(self, *args, **options):
+        drivers = [str(d) for d in Driver.objects.values_list("driver_id", flat=True)[:options["drivers"]]]
+        if not drivers:
+            self.stdout.write("need drivers in the database")
+            return
+
+        rng = random.Random(0)
+        ticks = int(options["seconds"] / options["ping_interval"])
+        pings = []
+        for tick in range(ticks):
+            for driver_id in drivers:
+                lat = 12.9716 + rng.uniform(-0.05, 0.05)
+                lng = 77.5946 + rng.uniform(-0.05, 0.05)
+                pings.append((tick * options["ping_interval"], driver_id, lat, lng, h3.latlng_to_cell(lat, lng, 9)))
+
+        # naive: one UPDATE drivers per ping
+        started = time.perf_counter()
+        for _, driver_id, lat, lng, cell in pings:
+            Driver.objects.filter(driver_id=driver_id).update(
+                current_h3_index=cell,
+                last_location=f"{lat},{lng}",
+                location_updated_at=timezone.now()
+            )
+        naive_seconds = time.perf_counter() - started
+        naive_rows = len(pings)
+
+        # coalesced: keep the latest per driver and flush every
+        # flush-interval simulated seconds (the background thread's own
+        # interval is pushed out of the way)
+        state = DriverLocationState(flush_interval=3600)
+        next_flush = options["flush_interval"]
+        started = time.perf_counter()
+        for at, driver_id, lat, lng, cell in pings:
+            if at >= next_flush:
+                state.flush()
+                next_flush += options["flush_interval"]
+            state.update(driver_id, cell, lat, lng)
+        state.flush()
+        coalesced_seconds = time.perf_counter() - started
+        report = state.stats()
+
+        self.stdout.write(
+            f"{len(pings):,} pings from {len(drivers)} drivers over {options['seconds']}s "
+            f"(every {options['ping_interval']}s)"
+        )
+        self.stdout.write(
+            f"  per-ping UPDATE : {naive_rows:>8,} rows, {naive_rows:>6,} statements, "
+            f"{naive_seconds:6.2f}s, 1.00 rows/ping"
+        )
+        self.stdout.write(
+            f"  coalesced       : {report['rows_written']:>8,} rows, {report['statements']:>6,} statements, "
+            f"{coalesced_seconds:6.2f}s, {report['rows_per_ping']:.2f} rows/ping"
+        )
@@ -0,0 +1,52 @@
+import tempfile
+import time
+
+import h3
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from rides.eta import EtaService
+
+
+class Command(BaseCommand):
+    help = "Builds a synthetic ETA table and measures batched lookup cost"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--radius", type=int, default=30, help="k of the city disk")
+        parser.add_argument("--resolution", type=int, default=9)
+        parser.add_argument("--origins", type=int, default=1000)
+        parser.add_argument("--destinations", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=7)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        center = h3.latlng_to_cell(12.9716, 77.5946, options["resolution"])
+        city = list(h3.grid_disk(center, options["radius"]))
+        cell_speeds = {cell: float(rng.uniform(10, 50)) for cell in city}
+
+        with tempfile.TemporaryDirectory() as directory:
+            service = EtaService(directory, resolutions=(options["resolution"],))
+
+            started = time.perf_counter()
+            service.save("bench", options["resolution"], cell_speeds, buffer_rings=0)
+            self.stdout.write(f"build: {len(city)} cells in {time.perf_counter() - started:.2f}s")
+
+            table = service.table("bench")
+            origins = list(rng.choice(city, options["origins"]))
+            destinations = list(rng.choice(city, options["destinations"]))
+
+            started = time.perf_counter()
+            matrix = table.many_to_many(origins, destinations)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"many-to-many {matrix.shape[0]}x{matrix.shape[1]}: {elapsed * 1000:.1f} ms, "
+                f"{elapsed / matrix.size * 1e6:.3f} us per pair"
+            )
+
+            started = time.perf_counter()
+            seconds = table.pairwise(origins, destinations)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"pairwise {len(seconds)}: {elapsed * 1000:.1f} ms, {elapsed / len(seconds) * 1e6:.3f} us per pair"
+            )
+            self.stdout.write(f"median ETA {np.median(matrix):.0f}s, max {matrix.max():.0f}s")
@@ -0,0 +1,58 @@
+import json
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from rides.location_ingest import parse_location_batch, write_location_points
+
+
+class Command(BaseCommand):
+    help = "Measures batched GPS ingestion throughput (parse, and optionally write)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=100000)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--rides", type=int, default=200)
+        parser.add_argument(
+            "--write", nargs=2, metavar=("RIDE_ID", "DRIVER_ID"),
+            help="also write to ride_location_log using an existing ride and driver"
+        )
+
+    def handle(self, *args, **options):
+        if options["write"]:
+            rides = [(uuid.UUID(options["write"][0]), uuid.UUID(options["write"][1]))]
+        else:
+            rides = [(uuid.uuid4(), uuid.uuid4()) for _ in range(options["rides"])]
+
+        batches = [
+            json.dumps([self._point(*random.choice(rides)) for _ in range(options["batch_size"])])
+            for _ in range(max(options["points"] // options["batch_size"], 1))
+        ]
+        total = len(batches) * options["batch_size"]
+
+        started = time.perf_counter()
+        parsed = [parse_location_batch(json.loads(body)) for body in batches]
+        parse_seconds = time.perf_counter() - started
+        self.stdout.write(f"json decode + validate: {total / parse_seconds:,.0f} points/sec")
+
+        if options["write"]:
+            started = time.perf_counter()
+            for points in parsed:
+                write_location_points(points)
+            write_seconds = time.perf_counter() - started
+            self.stdout.write(f"write:                  {total / write_seconds:,.0f} points/sec")
+            self.stdout.write(f"end to end:             {total / (parse_seconds + write_seconds):,.0f} points/sec")
+
+    @staticmethod
+    def _point(ride_id, driver_id):
+        return {
+            "ride_id": str(ride_id),
+            "driver_id": str(driver_id),
+            "latitude": 12.9 + random.random() / 10,
+            "longitude": 77.5 + random.random() / 10,
+            "heading_towards": str(random.randint(0, 359)),
+            "h3_index": "8960145b487ffff",
+            "speed": round(random.uniform(0, 60), 2),
+        }
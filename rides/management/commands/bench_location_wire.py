@@ -0,0 +1,55 @@
+import json
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from rides.location_ingest import parse_point
+from rides.parsers import decode_location_frames, encode_location_frames
+
+
+class Command(BaseCommand):
+    help = "Compares decode cost of JSON and binary location frames per 10k points"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=10000)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        ride_id, driver_id = uuid.uuid4(), uuid.uuid4()
+        points = [
+            {
+                "ride_id": str(ride_id),
+                "driver_id": str(driver_id),
+                "latitude": str(12.9 + random.random() / 10),
+                "longitude": str(77.5 + random.random() / 10),
+                "heading_towards": str(random.randint(0, 359)),
+                "h3_index": "8960145b487ffff",
+                "speed": str(round(random.uniform(0, 60), 2)),
+            }
+            for _ in range(options["points"])
+        ]
+
+        json_body = json.dumps(points).encode()
+        frame_body = encode_location_frames(points)
+
+        def decode_json():
+            return [parse_point(point) for point in json.loads(json_body)]
+
+        def decode_frames():
+            return decode_location_frames(frame_body)
+
+        assert [p.h3_index for p in decode_json()] == [p.h3_index for p in decode_frames()]
+
+        scale = 10000 / options["points"]
+        for name, body, decode in (("json", json_body, decode_json), ("frames", frame_body, decode_frames)):
+            started = time.perf_counter()
+            for _ in range(options["repeat"]):
+                decode()
+            elapsed = (time.perf_counter() - started) / options["repeat"]
+
+            self.stdout.write(
+                f"{name:<7} {len(body) / options['points']:6.1f} bytes/point  "
+                f"{elapsed * scale * 1000:7.2f} ms per 10k points"
+            )
@@ -0,0 +1,50 @@
+import time
+
+import h3
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from rides.matching import min_cost_matching, candidate_pairs, grid_distances
+
+
+class Command(BaseCommand):
+    help = "Benchmarks candidate pricing and assignment on synthetic rides and drivers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rides", type=int, default=10000)
+        parser.add_argument("--drivers", type=int, default=10000)
+        parser.add_argument("--radius", type=int, default=60, help="k of the city disk at res 9")
+        parser.add_argument("--max-pickup-rings", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=7)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        center = h3.latlng_to_cell(12.9716, 77.5946, 9)
+        city = np.array(list(h3.grid_disk(center, options["radius"])))
+
+        ride_cells = list(rng.choice(city, options["rides"]))
+        driver_cells = list(rng.choice(city, options["drivers"]))
+
+        max_rings = options["max_pickup_rings"]
+
+        started = time.perf_counter()
+        rows, cols = candidate_pairs(ride_cells, driver_cells, max_rings)
+        costs = grid_distances(ride_cells, driver_cells, rows, cols)
+        built = time.perf_counter()
+        matched_rows, matched_cols = min_cost_matching(
+            rows, cols, costs, len(ride_cells), len(driver_cells), max_rings
+        )
+        solved = time.perf_counter()
+
+        matched = len(matched_rows)
+        pickup = {(r, c): cost for r, c, cost in zip(rows, cols, costs)}
+        mean_pickup = np.mean([pickup[pair] for pair in zip(matched_rows, matched_cols)]) if matched else 0
+        total = solved - started
+
+        self.stdout.write(
+            f"{options['rides']}x{options['drivers']} over {city.size} cells, {rows.size} candidate pairs\n"
+            f"  pricing:    {(built - started) * 1000:.0f} ms\n"
+            f"  assignment: {(solved - built) * 1000:.0f} ms\n"
+            f"  matched:    {matched} (mean pickup {mean_pickup:.2f} rings)\n"
+            f"  throughput: {matched / total:,.0f} matches/sec"
+        )
@@ -0,0 +1,113 @@
+import time
+import uuid
+from datetime import datetime
+
+import h3
+from django.core.management.base import BaseCommand
+
+from drivers.models import Driver
+from ride_sharing.local_redis import LocalRedis
+from ride_sharing.lookups import ride_statuses
+from rides.models import DriverRideRejection, RideDetailsForRiders
+from rides.rejections import RejectedRideCache
+from rides.spatial_index import OpenRide
+
+
+class Command(BaseCommand):
+    help = (
+        "Shows driver ride discovery latency as a driver's rejection history grows, "
+        "with a shared rejected-ride cache and with the database lookup used when "
+        "REJECTED_RIDES_REDIS_URL is unset. The database run inserts rejections for "
+        "an existing driver and rides and deletes them afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--open-rides", type=int, default=200, help="open rides around the driver")
+        parser.add_argument("--history", type=int, nargs="+", default=[0, 1000, 10000, 100000])
+        parser.add_argument("--polls", type=int, default=2000)
+        parser.add_argument("--db-polls", type=int, default=200, help="polls per database run")
+
+    def handle(self, *args, **options):
+        self.bench_cache(options)
+        self.bench_database(options)
+
+    def bench_cache(self, options):
+        cell = h3.latlng_to_cell(12.9716, 77.5946, 9)
+        cells = list(h3.grid_disk(cell, 3))
+        driver_id = uuid.uuid4()
+
+        rides = [
+            OpenRide(uuid.uuid4(), cells[i % len(cells)], "", "", None, "", datetime.now())
+            for i in range(options["open_rides"])
+        ]
+
+        self.stdout.write("shared cache:")
+        for history in options["history"]:
+            cache = RejectedRideCache(LocalRedis())
+            cache.mark_loaded(driver_id)
+
+            # the driver rejected `history` rides that have since closed,
+            # plus every tenth ride that is still open around them
+            for _ in range(history):
+                ride_id = uuid.uuid4()
+                cache.add(driver_id, ride_id)
+                cache.discard_ride(ride_id)
+            for ride in rides[::10]:
+                cache.add(driver_id, ride.ride_id)
+
+            started = time.perf_counter()
+            for _ in range(options["polls"]):
+                visible = cache.exclude_rejected(driver_id, rides)
+            elapsed = (time.perf_counter() - started) / options["polls"]
+
+            self.stdout.write(
+                f"  history {history:>7}: {elapsed * 1e6:8.1f} us per poll, "
+                f"{len(visible)} of {len(rides)} rides visible"
+            )
+
+    def bench_database(self, options):
+        driver = Driver.objects.first()
+        booked = list(
+            RideDetailsForRiders.objects
+            .filter(ride_status=ride_statuses.get("BOOKED"))
+            .values_list("ride_id", flat=True)[:options["open_rides"]]
+        )
+        closed = (
+            RideDetailsForRiders.objects
+            .exclude(ride_status=ride_statuses.get("BOOKED"))
+            .values_list("ride_id", flat=True)
+            .first()
+        )
+        if driver is None or not booked or closed is None:
+            self.stdout.write("database: needs a driver, booked rides and a closed ride in the database")
+            return
+
+        cache = RejectedRideCache(LocalRedis(), shared=False)
+        inserted = []
+        self.stdout.write("database (REJECTED_RIDES_REDIS_URL unset):")
+        try:
+            open_rejections = [DriverRideRejection(ride_id=ride_id, driver=driver) for ride_id in booked[::10]]
+            inserted += DriverRideRejection.objects.bulk_create(open_rejections)
+
+            previous = 0
+            for history in sorted(options["history"]):
+                # the history is rejections of a ride that has since closed
+                inserted += DriverRideRejection.objects.bulk_create(
+                    [DriverRideRejection(ride_id=closed, driver=driver) for _ in range(history - previous)],
+                    batch_size=5000,
+                )
+                previous = history
+
+                started = time.perf_counter()
+                for _ in range(options["db_polls"]):
+                    rejected = cache.rejected_by(driver.driver_id, candidates=booked)
+                elapsed = (time.perf_counter() - started) / options["db_polls"]
+
+                self.stdout.write(
+                    f"  history {history:>7}: {elapsed * 1e6:8.1f} us per poll, "
+                    f"{len(rejected)} open rides rejected"
+                )
+        finally:
+            ids = [row.pk for row in inserted]
+            for start in range(0, len(ids), 10000):
+                DriverRideRejection.objects.filter(pk__in=ids[start:start + 10000]).delete()
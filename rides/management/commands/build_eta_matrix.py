@@ -0,0 +1,125 @@
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from rides.eta import SPEED_UNITS, eta_service, speed_factor, speed_unit_ratio
+from rides.models import Region, RideLocationLog
+from rides.spatial_index import to_h3_cell
+
+
+# implied / reported speed outside this band means the configured unit is wrong
+UNIT_RATIO_RANGE = (0.5, 2.0)
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds per-region H3 cell-to-cell ETA tables from ride_location_log speeds, "
+        "converted to km/h from LOCATION_SPEED_UNIT. A region whose reported speeds "
+        "disagree with the distance between consecutive pings is skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--region", action="append", help="region_code; all regions by default")
+        parser.add_argument("--resolution", type=int, nargs="+", default=[9, 8, 7], choices=[7, 8, 9])
+        parser.add_argument("--days", type=int, default=30, help="only use pings from the last N days")
+        parser.add_argument("--buffer-rings", type=int, default=1)
+        parser.add_argument("--min-speed-kmh", type=float, default=1.0, help="ignore pings slower than this")
+        parser.add_argument(
+            "--speed-unit", choices=sorted(SPEED_UNITS),
+            default=getattr(settings, "LOCATION_SPEED_UNIT", "km/h"),
+            help="unit of ride_location_log.speed (LOCATION_SPEED_UNIT by default)",
+        )
+        parser.add_argument("--check-rides", type=int, default=200, help="rides sampled to check the speed unit")
+
+    def traces(self, region_code, since, limit):
+        """
+        [(latitude, longitude, unix seconds, speed)] per sampled ride, in ping order
+        """
+        ride_ids = list(
+            RideLocationLog.objects
+            .filter(ride__region_id=region_code, updated_at__gte=since, speed__isnull=False)
+            .values_list("ride_id", flat=True)
+            .distinct()[:limit]
+        )
+        traces = defaultdict(list)
+        pings = (
+            RideLocationLog.objects
+            .filter(ride_id__in=ride_ids, speed__isnull=False)
+            .order_by("ride_id", "updated_at", "log_id")
+            .values_list("ride_id", "latitude", "longitude", "updated_at", "speed")
+        )
+        for ride_id, latitude, longitude, updated_at, speed in pings.iterator(chunk_size=10000):
+            try:
+                point = (float(latitude), float(longitude), updated_at.timestamp(), float(speed))
+            except (TypeError, ValueError):
+                continue
+            traces[ride_id].append(point)
+        return list(traces.values())
+
+    def handle(self, *args, **options):
+        try:
+            factor = speed_factor(options["speed_unit"])
+        except ValueError as error:
+            raise CommandError(str(error))
+
+        regions = options["region"] or [
+            str(code) for code in Region.objects.values_list("region_code", flat=True)
+        ]
+        since = timezone.now() - timedelta(days=options["days"])
+
+        for region_code in regions:
+            speeds = defaultdict(list)
+            pings = (
+                RideLocationLog.objects
+                .filter(
+                    ride__region_id=region_code, updated_at__gte=since,
+                    speed__gte=options["min_speed_kmh"] / factor
+                )
+                .values_list("h3_index", "speed")
+                .iterator(chunk_size=10000)
+            )
+            for h3_index, speed in pings:
+                speeds[h3_index].append(float(speed) * factor)
+
+            if not speeds:
+                self.stdout.write(f"{region_code}: no location history, skipped")
+                continue
+
+            ratio = speed_unit_ratio(
+                self.traces(region_code, since, options["check_rides"]), factor, options["min_speed_kmh"]
+            )
+            if ratio is not None and not UNIT_RATIO_RANGE[0] <= ratio <= UNIT_RATIO_RANGE[1]:
+                self.stdout.write(
+                    f"{region_code}: skipped, pings move {ratio:.2f}x the speed they report in "
+                    f"{options['speed_unit']}; check LOCATION_SPEED_UNIT"
+                )
+                continue
+
+            for resolution in options["resolution"]:
+                by_cell = defaultdict(list)
+                for h3_index, values in speeds.items():
+                    cell = to_h3_cell(h3_index, resolution)
+                    if cell is not None:
+                        by_cell[cell].extend(values)
+
+                cell_speeds = {cell: float(np.median(values)) for cell, values in by_cell.items()}
+
+                started = time.perf_counter()
+                try:
+                    cells = eta_service.save(
+                        region_code, resolution, cell_speeds, buffer_rings=options["buffer_rings"]
+                    )
+                except ValueError as error:
+                    # an older table at this resolution would keep being preferred
+                    eta_service.remove(region_code, resolution)
+                    self.stdout.write(f"{region_code} r{resolution}: skipped, {error}")
+                    continue
+                self.stdout.write(
+                    f"{region_code} r{resolution}: {cells} cells, {cells * cells * 2 / 2 ** 20:,.1f} MiB "
+                    f"in {time.perf_counter() - started:.1f}s"
+                )
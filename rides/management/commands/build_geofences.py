@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rides.geofence import geofences
+
+
+class Command(BaseCommand):
+    help = (
+        "Polyfills every active region's geo_boundary into the geofence disk "
+        "cache, so workers start without recomputing them"
+    )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        geofences.load()
+        elapsed = time.perf_counter() - started
+
+        report = geofences.stats()
+        for region_code in geofences.regions():
+            self.stdout.write(f"{region_code}: {len(geofences.cells_of(region_code)):,} cells")
+
+        self.stdout.write(
+            f"{report['regions']} regions, {report['cells']:,} cells at r{geofences.resolution} "
+            f"({report['polyfills']} polyfilled, {report['cache_hits']} from cache, "
+            f"{report['overlapping_cells']:,} overlapping) in {elapsed:.2f}s"
+        )
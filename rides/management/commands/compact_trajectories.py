@@ -0,0 +1,63 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from rides.models import RideTrajectory
+from rides.trajectory import compact_rides, completed_ride_ids
+
+
+class Command(BaseCommand):
+    help = "Simplifies completed rides' location logs into delta-encoded trajectories"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--tolerance-m", type=float,
+            default=getattr(settings, "TRAJECTORY_TOLERANCE_M", 5.0)
+        )
+        parser.add_argument("--batch-size", type=int, default=200)
+        parser.add_argument("--limit", type=int, default=None, help="stop after this many rides")
+        parser.add_argument("--keep-raw", action="store_true", help="do not delete the raw rows")
+
+    def handle(self, *args, **options):
+        if RideTrajectory._meta.db_table not in connection.introspection.table_names():
+            raise CommandError(
+                f"{RideTrajectory._meta.db_table} does not exist: run rides/sql/ride_trajectories.sql first"
+            )
+
+        totals = {"rides": 0, "raw_points": 0, "kept_points": 0, "raw_bytes": 0, "stored_bytes": 0}
+        started = time.perf_counter()
+        done = set()
+
+        while options["limit"] is None or totals["rides"] < options["limit"]:
+            batch_size = options["batch_size"]
+            if options["limit"] is not None:
+                batch_size = min(batch_size, options["limit"] - totals["rides"])
+
+            # a trace with no usable points never gets a trajectory and
+            # would be listed again, so skip rides this run already handled
+            ride_ids = [r for r in completed_ride_ids(limit=batch_size + len(done)) if r not in done][:batch_size]
+            if not ride_ids:
+                break
+
+            report = compact_rides(ride_ids, options["tolerance_m"], prune=not options["keep_raw"])
+            done.update(ride_ids)
+            for key, value in report.items():
+                totals[key] += value
+
+        elapsed = max(time.perf_counter() - started, 1e-9)
+
+        if not totals["rides"]:
+            self.stdout.write("nothing to compact")
+            return
+
+        self.stdout.write(
+            f"rides: {totals['rides']}  points: {totals['raw_points']} -> {totals['kept_points']} "
+            f"({totals['kept_points'] / max(totals['raw_points'], 1):.1%} kept)"
+        )
+        self.stdout.write(
+            f"storage: ~{totals['raw_bytes'] / 1024:,.0f} KiB -> ~{totals['stored_bytes'] / 1024:,.0f} KiB "
+            f"({1 - totals['stored_bytes'] / max(totals['raw_bytes'], 1):.1%} smaller)"
+        )
+        self.stdout.write(f"throughput: {totals['rides'] / elapsed:,.1f} rides/sec")
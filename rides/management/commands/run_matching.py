@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ride_sharing.local_redis import is_local_url
+from rides.matching import matching_engine
+
+
+class Command(BaseCommand):
+    help = "Runs the batched ride-driver matching engine"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval-ms", type=int, default=500)
+
+    def handle(self, *args, **options):
+        # heartbeats land in the web workers; an in-process registry here would stay empty
+        if is_local_url(getattr(settings, "DRIVER_PRESENCE_REDIS_URL", None)):
+            raise CommandError(
+                "run_matching needs DRIVER_PRESENCE_REDIS_URL pointing at a redis shared with the web workers"
+            )
+
+        self.stdout.write(f"matching every {options['interval_ms']} ms")
+        try:
+            matching_engine.run_forever(interval_ms=options["interval_ms"])
+        except KeyboardInterrupt:
+            matching_engine.stop()
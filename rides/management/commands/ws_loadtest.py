@@ -0,0 +1,129 @@
+import asyncio
+import base64
+import os
+import resource
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Opens and holds idle driver offer WebSockets against a running ASGI "
+        "server, e.g. `uvicorn ride_sharing.asgi:application --ws websockets`"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument("--connections", type=int, default=20000)
+        parser.add_argument("--concurrency", type=int, default=500, help="parallel handshakes")
+        parser.add_argument("--hold", type=int, default=60, help="seconds to hold the connections")
+        parser.add_argument("--h3-index", default="8960145b487ffff")
+
+    def handle(self, *args, **options):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = options["connections"] + 1024
+        if soft < wanted:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, max(wanted, hard)))
+            except (ValueError, OSError):
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                self.stderr.write(f"open file limit is {hard}, expect failures past that")
+
+        asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        gate = asyncio.Semaphore(options["concurrency"])
+        handshakes = []
+        failures = 0
+        connections = []
+
+        async def connect():
+            nonlocal failures
+            async with gate:
+                started = time.perf_counter()
+                try:
+                    reader, writer = await self._handshake(options)
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    failures += 1
+                    return
+
+                handshakes.append(time.perf_counter() - started)
+                connections.append((writer, asyncio.create_task(self._idle(reader, writer))))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connect() for _ in range(options["connections"])))
+        elapsed = time.perf_counter() - started
+
+        handshakes.sort()
+        p50 = handshakes[len(handshakes) // 2] * 1000 if handshakes else 0
+        p99 = handshakes[int(len(handshakes) * 0.99)] * 1000 if handshakes else 0
+        self.stdout.write(
+            f"opened {len(connections)} / {options['connections']} in {elapsed:.1f}s "
+            f"({failures} failed), handshake p50 {p50:.1f} ms p99 {p99:.1f} ms"
+        )
+
+        deadline = time.monotonic() + options["hold"]
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(5, max(deadline - time.monotonic(), 0)))
+            alive = sum(1 for _, drain in connections if not drain.done())
+            self.stdout.write(f"  holding {alive} connections")
+
+        for writer, drain in connections:
+            drain.cancel()
+            writer.close()
+
+    async def _handshake(self, options):
+        reader, writer = await asyncio.open_connection(options["host"], options["port"])
+        key = base64.b64encode(os.urandom(16)).decode()
+
+        writer.write((
+            f"GET /ws/drivers/{uuid.uuid4()}/offers/?h3_index={options['h3_index']} HTTP/1.1\r\n"
+            f"Host: {options['host']}:{options['port']}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if b" 101 " not in status_line:
+            writer.close()
+            raise ConnectionError(status_line.decode(errors="replace").strip())
+
+        await reader.readuntil(b"\r\n\r\n")
+        return reader, writer
+
+    async def _idle(self, reader, writer):
+        """
+        Stays idle like a parked driver app: discards pushed offers and
+        answers server pings so keepalive does not close the socket
+        """
+        try:
+            while True:
+                head = await reader.readexactly(2)
+                opcode = head[0] & 0x0F
+                length = head[1] & 0x7F
+                if length == 126:
+                    length = int.from_bytes(await reader.readexactly(2), "big")
+                elif length == 127:
+                    length = int.from_bytes(await reader.readexactly(8), "big")
+
+                payload = await reader.readexactly(length)
+
+                if opcode == 0x9:
+                    writer.write(self._masked_frame(0xA, payload))
+                elif opcode == 0x8:
+                    return
+        except (OSError, asyncio.IncompleteReadError):
+            return
+
+    @staticmethod
+    def _masked_frame(opcode, payload):
+        # control frames only, so the payload is always < 126 bytes
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        return bytes([0x80 | opcode, 0x80 | len(payload)]) + mask + masked
@@ -0,0 +1,329 @@
+import logging
+import threading
+import time
+
+import h3
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, UUIDField, Value, When
+from django.utils import timezone
+
+from drivers.models import Driver, VehicleDriverAssignment
+from drivers.presence import driver_presence
+from ride_sharing import metrics
+from ride_sharing.lookups import ride_statuses
+from rides.eta import center_distance_m, eta_service
+from rides.events import ride_event, ride_events
+from rides.models import Ride, RideDetailsForRiders
+from rides.signals import ride_closed
+from rides.spatial_index import open_ride_index
+
+logger = logging.getLogger(__name__)
+
+
+def local_ij(cells, origin):
+    """
+    Local IJ coordinates of `cells` around `origin` as an (n, 2) float array.
+    Cells that cannot be unfolded (too far, across a pentagon) get NaN.
+    """
+    coords = np.full((len(cells), 2), np.nan)
+    for row, cell in enumerate(cells):
+        try:
+            coords[row] = h3.cell_to_local_ij(origin, cell)
+        except h3.H3BaseException:
+            pass
+    return coords
+
+
+def candidate_pairs(ride_cells, driver_cells, max_rings):
+    """
+    (rows, cols) of every ride/driver pair within `max_rings` of each other.
+    Only these pairs are worth pricing, which keeps the problem sparse.
+    """
+    drivers_by_cell = {}
+    for col, cell in enumerate(driver_cells):
+        drivers_by_cell.setdefault(cell, []).append(col)
+
+    rows, cols = [], []
+    for row, cell in enumerate(ride_cells):
+        for near in h3.grid_disk(cell, max_rings):
+            hits = drivers_by_cell.get(near)
+            if hits:
+                rows.extend([row] * len(hits))
+                cols.extend(hits)
+
+    return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
+
+
+def grid_distances(ride_cells, driver_cells, rows, cols):
+    """
+    H3 grid distance for each (rows[k], cols[k]) pair, vectorized over local
+    IJ coordinates. Pairs that cannot be unfolded fall back to grid_distance.
+    """
+    origin = ride_cells[0]
+    ride_ij = local_ij(ride_cells, origin)
+    driver_ij = local_ij(driver_cells, origin)
+
+    di = ride_ij[rows, 0] - driver_ij[cols, 0]
+    dj = ride_ij[rows, 1] - driver_ij[cols, 1]
+    distance = np.maximum(np.maximum(np.abs(di), np.abs(dj)), np.abs(di - dj))
+
+    for k in np.flatnonzero(np.isnan(distance)):
+        try:
+            distance[k] = h3.grid_distance(ride_cells[rows[k]], driver_cells[cols[k]])
+        except h3.H3BaseException:
+            distance[k] = np.inf
+
+    return distance
+
+
+def eta_costs(region_code, ride_cells, driver_cells, rows, cols):
+    """
+    Pickup ETA in seconds from each candidate driver's cell to the ride's
+    cell. Regions without an ETA table fall back to grid distance at the
+    default speed.
+    """
+    seconds = eta_service.pairs(region_code, driver_cells, ride_cells, cols, rows)
+    if seconds is None:
+        step_seconds = center_distance_m(h3.get_resolution(ride_cells[0])) / (eta_service.default_speed_kmh / 3.6)
+        seconds = grid_distances(ride_cells, driver_cells, rows, cols) * step_seconds
+    return np.nan_to_num(seconds, nan=np.inf)
+
+
+def min_cost_matching(rows, cols, costs, n_rows, n_cols, max_cost):
+    """
+    Min-cost matching of rides (rows) to drivers (cols) over the sparse
+    candidate pairs. Leaving a ride unmatched costs max_cost + 1, so pairs
+    above max_cost are never used. Returns (rows, cols) of the matched pairs.
+
+    The problem is squared up so a full matching always exists and solved
+    with scipy's sparse LAPJV (shortest augmenting path, Hungarian family):
+    persons are rides plus one stand-in per driver, objects are drivers plus
+    one "unmatched" slot per ride. A driver's stand-in takes the driver back,
+    or the unmatched slot of any ride that could have used that driver.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    feasible = costs <= max_cost
+    rows, cols, costs = rows[feasible], cols[feasible], costs[feasible]
+
+    if rows.size == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    size = n_rows + n_cols
+    ride_range = np.arange(n_rows)
+    driver_range = np.arange(n_cols)
+
+    person = np.concatenate([rows, ride_range, n_rows + cols, n_rows + driver_range])
+    target = np.concatenate([cols, n_cols + ride_range, n_cols + rows, driver_range])
+    weight = np.concatenate([
+        costs,
+        np.full(n_rows, float(max_cost + 1)),
+        np.zeros(rows.size),
+        np.zeros(n_cols),
+    ])
+
+    # every full matching has exactly `size` edges, so shifting all weights
+    # by one keeps the optimum and stops zero-cost edges being dropped
+    graph = csr_matrix((weight + 1, (person, target)), shape=(size, size))
+    _, matched_to = min_weight_full_bipartite_matching(graph)
+
+    matched = np.flatnonzero(matched_to[:n_rows] < n_cols)
+    return matched, matched_to[matched]
+
+
+class MatchingEngine:
+    """
+    Batches open rides and idle drivers per region every tick and assigns
+    them with a global min-cost matching instead of first-come accepts.
+    """
+
+    def __init__(self, index=None, presence=None, max_pickup_rings=3, cost_fn=None, max_cost=None):
+        # both define __len__, so an empty one is falsy
+        self.index = open_ride_index if index is None else index
+        self.presence = driver_presence if presence is None else presence
+        self.max_pickup_rings = max_pickup_rings
+        self.cost_fn = cost_fn or (lambda region_code, *pairs: grid_distances(*pairs))
+        # in the cost_fn's units; the default cost is grid distance in rings
+        self.max_cost = max_pickup_rings if max_cost is None else max_cost
+        self._stop = threading.Event()
+        self._counters = {"ticks": 0, "matched": 0, "conflicts": 0, "last_tick_ms": 0.0}
+
+    def open_rides_by_region(self):
+        by_region = {}
+        for ride in self.index.snapshot():
+            by_region.setdefault(ride.region_code, []).append(ride)
+        return by_region
+
+    def candidate_drivers(self, rides, taken):
+        cells = set()
+        for ride in rides:
+            cells.update(h3.grid_disk(ride.cell, self.max_pickup_rings))
+
+        drivers = {}
+        for cell, members in self.presence.drivers_in_cells(cells).items():
+            for driver_id in members:
+                if driver_id not in taken:
+                    drivers[driver_id] = cell
+        return drivers
+
+    def plan(self):
+        """
+        Returns [(region_code, [(OpenRide, driver_id)])] without writing
+        """
+        plans = []
+        taken = set()
+
+        for region_code, rides in self.open_rides_by_region().items():
+            drivers = self.candidate_drivers(rides, taken)
+            if not drivers:
+                continue
+
+            driver_ids = list(drivers)
+            ride_cells = [ride.cell for ride in rides]
+            driver_cells = [drivers[d] for d in driver_ids]
+
+            rows, cols = candidate_pairs(ride_cells, driver_cells, self.max_pickup_rings)
+            costs = self.cost_fn(region_code, ride_cells, driver_cells, rows, cols)
+            rows, cols = min_cost_matching(
+                rows, cols, costs, len(rides), len(driver_ids), self.max_cost
+            )
+
+            pairs = [(rides[r], driver_ids[c]) for r, c in zip(rows, cols)]
+            taken.update(driver_id for _, driver_id in pairs)
+            plans.append((region_code, pairs))
+
+        return plans
+
+    def commit(self, pairs):
+        """
+        Writes one batch of assignments in a single transaction. Rides that
+        were accepted or cancelled meanwhile are skipped, and so are drivers
+        who already have an active ride (presence may not have caught up
+        with an accept_ride). Returns the committed [(ride_id, driver_id)].
+        """
+        if not pairs:
+            return []
+
+        driver_for_ride = {ride.ride_id: driver_id for ride, driver_id in pairs}
+        driver_ids = set(driver_for_ride.values())
+        booked_status = ride_statuses.get("BOOKED")
+        assigned_status = ride_statuses.get("DRIVER_ASSIGNED")
+        active_statuses = [assigned_status, ride_statuses.get("RIDE_STARTED")]
+        now = timezone.now()
+
+        with transaction.atomic():
+            # in id order so concurrent batches cannot deadlock on each other
+            list(
+                Driver.objects.select_for_update()
+                .filter(driver_id__in=driver_ids)
+                .order_by("driver_id")
+                .values_list("driver_id", flat=True)
+            )
+            on_ride = {
+                str(driver_id) for driver_id in
+                RideDetailsForRiders.objects.filter(
+                    ride__driver_id__in=driver_ids,
+                    ride_status__in=active_statuses
+                ).values_list("ride__driver_id", flat=True)
+            }
+            driver_for_ride = {
+                ride_id: driver_id for ride_id, driver_id in driver_for_ride.items()
+                if driver_id not in on_ride
+            }
+
+            ride_ids = list(
+                RideDetailsForRiders.objects
+                .select_for_update(skip_locked=True)
+                .filter(ride_id__in=list(driver_for_ride), ride_status=booked_status)
+                .values_list("ride_id", flat=True)
+            ) if driver_for_ride else []
+            if ride_ids:
+                self._assign(ride_ids, driver_for_ride, assigned_status, now)
+
+            # presence keeps every driver taken here out of the buckets until their ride ends
+            busy = on_ride | {driver_for_ride[r] for r in ride_ids}
+
+            def publish():
+                for r in ride_ids:
+                    ride_closed.send(sender=RideDetailsForRiders, ride_id=r)
+                for driver_id in busy:
+                    self.presence.mark_busy(driver_id)
+
+            transaction.on_commit(publish)
+
+        self._counters["conflicts"] += len(pairs) - len(ride_ids)
+        return [(r, driver_for_ride[r]) for r in ride_ids]
+
+    def _assign(self, ride_ids, driver_for_ride, assigned_status, now):
+        RideDetailsForRiders.objects.filter(ride_id__in=ride_ids).update(
+            ride_status=assigned_status
+        )
+
+        vehicles = dict(
+            VehicleDriverAssignment.objects.filter(
+                driver_id__in=[driver_for_ride[r] for r in ride_ids],
+                start_time__lte=now,
+                end_time__gte=now
+            ).values_list("driver_id", "vehicle_id")
+        )
+        vehicles = {str(driver_id): vehicle_id for driver_id, vehicle_id in vehicles.items()}
+
+        Ride.objects.filter(ride_id__in=ride_ids).update(
+            driver_id=Case(
+                *[When(ride_id=r, then=Value(driver_for_ride[r])) for r in ride_ids],
+                output_field=UUIDField()
+            ),
+            vehicle_id=Case(
+                *[When(ride_id=r, then=Value(vehicles.get(driver_for_ride[r]))) for r in ride_ids],
+                output_field=UUIDField()
+            ),
+            updated_at=now
+        )
+
+        ride_events.publish(*[
+            ride_event(r, "DRIVER_ASSIGNED", driver_id=driver_for_ride[r]) for r in ride_ids
+        ])
+
+    def tick(self):
+        started = time.perf_counter()
+        committed = []
+
+        for region_code, pairs in self.plan():
+            try:
+                committed.extend(self.commit(pairs))
+            except Exception:
+                logger.exception("matching batch failed for region %s", region_code)
+
+        self._counters["ticks"] += 1
+        self._counters["matched"] += len(committed)
+        self._counters["last_tick_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return committed
+
+    def run_forever(self, interval_ms=500):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.tick()
+            self._stop.wait(max(interval_ms / 1000 - (time.monotonic() - started), 0))
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return dict(self._counters)
+
+
+if getattr(settings, "MATCHING_COST", "grid") == "eta":
+    matching_engine = MatchingEngine(
+        max_pickup_rings=getattr(settings, "MATCHING_MAX_PICKUP_RINGS", 3),
+        cost_fn=eta_costs,
+        max_cost=getattr(settings, "MATCHING_MAX_PICKUP_SECONDS", 600),
+    )
+else:
+    matching_engine = MatchingEngine(
+        max_pickup_rings=getattr(settings, "MATCHING_MAX_PICKUP_RINGS", 3),
+    )
+
+metrics.register("matching", matching_engine.stats)
@@ -1,5 +1,6 @@
 import uuid
 from django.db import models
+from django.utils import timezone
 from drivers.models import Driver, Vehicle
 from authentication.models import User, Tenant, TenantUser
 
@@ -166,7 +167,7 @@ class EventLog(models.Model):
     ride_status = models.ForeignKey(RideStatusLookup, on_delete=models.DO_NOTHING, null=True, blank=True, db_column="ride_status_id")
     latitude = models.TextField(null=True, blank=True)
     longitude = models.TextField(null=True, blank=True)
-    event_time = models.DateTimeField(auto_now_add=True)
+    event_time = models.DateTimeField(default=timezone.now)
 
     class Meta:
         db_table = "event_log"
@@ -235,4 +236,22 @@ class DriverRideRejection(models.Model):
         db_table = "driver_ride_rejections"
         managed = True
 
-    
\ No newline at end of file
+    
+
+class RideTrajectory(models.Model):
+    ride = models.OneToOneField(Ride, on_delete=models.DO_NOTHING, primary_key=True, db_column="ride_id", related_name="trajectory")
+    polyline = models.TextField()
+    time_offsets = models.TextField()
+    raw_points = models.IntegerField()
+    kept_points = models.IntegerField()
+    tolerance_m = models.FloatField()
+    started_at = models.DateTimeField(null=True, blank=True)
+    ended_at = models.DateTimeField(null=True, blank=True)
+    compacted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "ride_trajectories"
+        managed = False     # rides/sql/ride_trajectories.sql
+
+    def __str__(self):
+        return f"RideTrajectory {self.ride_id}"
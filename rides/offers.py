@@ -0,0 +1,254 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import h3
+from django.conf import settings
+from django.dispatch import receiver
+
+from ride_sharing import metrics
+from ride_sharing.local_redis import get_redis_client, is_local_url
+from rides.signals import ride_booked, ride_closed
+from rides.spatial_index import open_ride_index, ride_key, to_h3_cell
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "ride_offers"
+
+
+class Subscription:
+    def __init__(self, driver_id, deliver, k_ring):
+        self.driver_id = driver_id
+        self.deliver = deliver
+        self.k_ring = k_ring
+        self.cell = None
+        self.cells = frozenset()
+
+
+class OfferBroker:
+    """
+    Pub/sub for ride offers. Each driver connection subscribes to the cells
+    of its H3 neighbourhood; a booked ride is pushed to every subscriber of
+    its pickup cell and withdrawn again when it closes.
+
+    With a `channel` client (a redis shared by every worker) offers and
+    withdrawals are published to CHANNEL and fanned out by a listener in
+    each process holding driver connections, so a ride booked or closed
+    in one worker reaches drivers connected to another. Without one they
+    fan out in-process only.
+
+    Offered rides are remembered for `offer_ttl` seconds so a withdrawal
+    reaches the same drivers; a ride whose close is never seen is
+    forgotten after that.
+    """
+
+    def __init__(self, resolution=9, channel=None, offer_ttl=3600):
+        self.resolution = resolution
+        self.channel = channel
+        self.offer_ttl = offer_ttl
+        self._lock = threading.Lock()
+        self._by_cell = {}              # cell -> set(Subscription)
+        self._offered = OrderedDict()   # ride_id -> (pickup cell, offered at), oldest first
+        self._subscriptions = 0
+        self._listener = None
+        self._stop = threading.Event()
+        self._counters = {"published": 0, "withdrawn": 0, "delivered": 0, "expired": 0, "relay_errors": 0}
+
+    def subscribe(self, driver_id, cell, deliver, k_ring=1):
+        """
+        `deliver` is called with each message and must be thread-safe
+        """
+        subscription = Subscription(driver_id, deliver, k_ring)
+        self.move(subscription, cell)
+        if self.channel is not None:
+            self._ensure_listening()
+
+        with self._lock:
+            self._subscriptions += 1
+        return subscription
+
+    def move(self, subscription, cell):
+        cell = to_h3_cell(cell, self.resolution)
+        if cell is None or cell == subscription.cell:
+            return
+
+        cells = frozenset(h3.grid_disk(cell, subscription.k_ring))
+
+        with self._lock:
+            for old in subscription.cells - cells:
+                self._remove(old, subscription)
+            for new in cells - subscription.cells:
+                self._by_cell.setdefault(new, set()).add(subscription)
+
+            subscription.cell = cell
+            subscription.cells = cells
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for cell in subscription.cells:
+                self._remove(cell, subscription)
+            subscription.cells = frozenset()
+            self._subscriptions -= 1
+
+    def _remove(self, cell, subscription):
+        subscribers = self._by_cell.get(cell)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._by_cell[cell]
+
+    def _fan_out(self, cell, message):
+        with self._lock:
+            subscribers = list(self._by_cell.get(cell, ()))
+
+        for subscription in subscribers:
+            subscription.deliver(message)
+
+        self._counters["delivered"] += len(subscribers)
+
+    def track(self, ride):
+        """
+        Remembers an offer's cell so its withdrawal reaches the same drivers
+        """
+        self._remember(ride.ride_id, ride.cell)
+
+    def _remember(self, ride_id, cell, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            self._offered[ride_id] = (cell, now)
+            self._offered.move_to_end(ride_id)
+
+            while self._offered:
+                _, offered_at = next(iter(self._offered.values()))
+                if now - offered_at < self.offer_ttl:
+                    break
+                self._offered.popitem(last=False)
+                self._counters["expired"] += 1
+
+    def publish_offer(self, ride):
+        """
+        Pushes an OpenRide to drivers around its pickup cell
+        """
+        self._counters["published"] += 1
+        message = offer_message(ride)
+        if self.channel is not None:
+            self._relay({"cell": ride.cell, "offer": message})
+        else:
+            self._offer(ride.ride_id, ride.cell, message)
+
+    def withdraw(self, ride_id):
+        if self.channel is not None:
+            self._relay({"withdraw": str(ride_id)})
+        else:
+            self._withdraw(ride_id)
+
+    def _offer(self, ride_id, cell, message):
+        self._remember(ride_id, cell)
+        self._fan_out(cell, message)
+
+    def _withdraw(self, ride_id):
+        with self._lock:
+            offered = self._offered.pop(ride_id, None)
+
+        if offered is None:
+            return
+
+        self._counters["withdrawn"] += 1
+        self._fan_out(offered[0], {"type": "offer_withdrawn", "ride_id": str(ride_id)})
+
+    # ---------------- channel ----------------
+
+    def _relay(self, payload):
+        try:
+            self.channel.publish(CHANNEL, json.dumps(payload))
+        except Exception:
+            # an offer missed here is still listed on connect and by /rides/available/
+            self._counters["relay_errors"] += 1
+            logger.exception("could not publish ride offer")
+
+    def _dispatch(self, payload):
+        if "withdraw" in payload:
+            self._withdraw(ride_key(payload["withdraw"]))
+        else:
+            offer = payload["offer"]
+            self._offer(ride_key(offer["ride_id"]), payload["cell"], offer)
+
+    def _ensure_listening(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._stop.clear()
+                self._listener = threading.Thread(target=self._listen, name="ride-offer-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while not self._stop.is_set():
+            pubsub = None
+            try:
+                pubsub = self.channel.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                while not self._stop.is_set():
+                    message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self._dispatch(json.loads(message["data"]))
+            except Exception:
+                self._counters["relay_errors"] += 1
+                logger.exception("ride offer listener failed, resubscribing")
+                self._stop.wait(1.0)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    def stop(self):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.join(timeout=5)
+
+    def stats(self):
+        with self._lock:
+            report = {
+                "subscriptions": self._subscriptions,
+                "subscribed_cells": len(self._by_cell),
+                "open_offers": len(self._offered),
+            }
+        report.update(self._counters)
+        return report
+
+
+def offer_message(ride):
+    return {
+        "type": "offer",
+        "ride_id": str(ride.ride_id),
+        "from_location": ride.from_location,
+        "to_location": ride.to_location,
+        "region": ride.region_name,
+        "created_at": ride.created_at.isoformat() if ride.created_at else None,
+    }
+
+
+_offers_url = getattr(settings, "RIDE_OFFERS_REDIS_URL", None)
+
+offer_broker = OfferBroker(
+    resolution=open_ride_index.resolution,
+    channel=None if is_local_url(_offers_url) else get_redis_client(_offers_url),
+    offer_ttl=getattr(settings, "RIDE_OFFER_TTL_SECONDS", 3600),
+)
+
+metrics.register("ride_offers", offer_broker.stats)
+
+
+@receiver(ride_booked)
+def publish_booked_ride(sender, details, **kwargs):
+    ride = open_ride_index.ride_from_details(details)
+    if ride is not None:
+        offer_broker.publish_offer(ride)
+
+
+@receiver(ride_closed)
+def withdraw_closed_ride(sender, ride_id, **kwargs):
+    offer_broker.withdraw(ride_key(ride_id))
@@ -0,0 +1,100 @@
+import math
+import struct
+import uuid
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from rides.location_ingest import LocationPoint, parse_speed
+
+
+LOCATION_FRAME_MEDIA_TYPE = "application/vnd.ride-sharing.location-frame"
+
+# One fixed-width little-endian frame per point (64 bytes):
+#   ride_id 16s, driver_id 16s, latitude f64, longitude f64,
+#   heading f32 (NaN = unknown), h3_index u64, speed f32 (NaN = unknown)
+LOCATION_FRAME = struct.Struct("<16s16sddfQf")
+
+
+def encode_location_frames(points):
+    """
+    Packs LocationPoints (or dicts with the same keys) into frames
+    """
+    buffer = bytearray(LOCATION_FRAME.size * len(points))
+
+    for offset, point in zip(range(0, len(buffer), LOCATION_FRAME.size), points):
+        if isinstance(point, dict):
+            point = LocationPoint(**{field: point.get(field) for field in LocationPoint._fields})
+
+        LOCATION_FRAME.pack_into(
+            buffer, offset,
+            uuid.UUID(str(point.ride_id)).bytes,
+            uuid.UUID(str(point.driver_id)).bytes,
+            float(point.latitude),
+            float(point.longitude),
+            math.nan if point.heading_towards is None else float(point.heading_towards),
+            int(point.h3_index, 16),
+            math.nan if point.speed is None else float(point.speed),
+        )
+
+    return bytes(buffer)
+
+
+def decode_location_frames(data):
+    """
+    Unpacks frames straight out of `data` (any buffer) into LocationPoints
+    without copying the body
+    """
+    view = memoryview(data)
+    if view.nbytes % LOCATION_FRAME.size:
+        raise ValueError(f"body is not a whole number of {LOCATION_FRAME.size}-byte frames")
+
+    # a batch usually repeats the same few rides, drivers and cells
+    uuids = {}
+    cells = {}
+
+    points = []
+    for ride, driver, latitude, longitude, heading, h3_index, speed in LOCATION_FRAME.iter_unpack(view):
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError("latitude/longitude out of range")
+        if math.isinf(heading):
+            raise ValueError("heading must be a finite number")
+
+        ride_id = uuids.get(ride)
+        if ride_id is None:
+            ride_id = uuids[ride] = uuid.UUID(bytes=ride)
+        driver_id = uuids.get(driver)
+        if driver_id is None:
+            driver_id = uuids[driver] = uuid.UUID(bytes=driver)
+        cell = cells.get(h3_index)
+        if cell is None:
+            cell = cells[h3_index] = f"{h3_index:x}"
+
+        points.append(LocationPoint(
+            ride_id,
+            driver_id,
+            latitude,
+            longitude,
+            None if heading != heading else f"{heading:g}",
+            cell,
+            None if speed != speed else parse_speed(f"{speed:.4f}"),
+        ))
+
+    return points
+
+
+class LocationFrameParser(BaseParser):
+    """
+    Parses a body of binary location frames into a list of LocationPoints.
+    Clients opt in with Content-Type: application/vnd.ride-sharing.location-frame;
+    JSON bodies keep going through the default parsers.
+    """
+    media_type = LOCATION_FRAME_MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        body = stream.read() if stream is not None else b""
+
+        try:
+            return decode_location_frames(body)
+        except (ValueError, struct.error) as error:
+            raise ParseError(f"Malformed location frames - {error}")
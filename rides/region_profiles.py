@@ -0,0 +1,133 @@
+import threading
+import time
+from decimal import Decimal
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from ride_sharing import metrics
+from ride_sharing.local_redis import get_redis_client
+from rides.models import Country, Region, State
+
+
+VERSION_KEY = "region_profiles:version"
+
+
+class RegionProfile(NamedTuple):
+    region: Region                     # with country and state loaded
+    currency_code: str
+    currency_symbol: str
+    minor_unit: str
+    timezone: str
+    tax_model: str
+    tax_percent: Optional[Decimal]     # state tax when set, else the country default
+    is_surge_enabled: bool
+    is_service_active: bool
+    version: int
+
+    @property
+    def region_code(self):
+        return self.region.region_code
+
+
+class RegionProfileCache:
+    """
+    What booking and pricing need to know about a region (its country's
+    currency, timezone and tax, the state tax, the surge and service
+    flags) loaded once per region with one query.
+
+    Every Region, Country or State save bumps a version counter in a
+    redis-compatible client. Each read compares it with the version the
+    worker's profiles were loaded under and drops them all when it moved,
+    so an edit made through any worker sharing the client is seen on the
+    next read. Profiles are also dropped once they are `max_age` seconds
+    old, which bounds how long an edit goes unseen by other workers when
+    the counter is per-process or the edit bypassed the ORM.
+    """
+
+    def __init__(self, client, max_age=300):
+        self.client = client
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._version = None
+        self._loaded_at = 0.0
+        self._counters = {"hits": 0, "loads": 0, "invalidations": 0, "expirations": 0}
+
+        for model in (Region, Country, State):
+            post_save.connect(self._on_change, sender=model, weak=False)
+            post_delete.connect(self._on_change, sender=model, weak=False)
+
+    def _on_change(self, sender, **kwargs):
+        self.bump()
+
+    def bump(self):
+        self.client.incr(VERSION_KEY)
+
+    def current_version(self):
+        return int(self.client.get(VERSION_KEY) or 0)
+
+    def _load(self, region_code, version):
+        region = Region.objects.select_related("country", "state").get(region_code=region_code)
+        country = region.country
+        state_tax = region.state.state_tax_percent if region.state_id else None
+
+        profile = RegionProfile(
+            region=region,
+            currency_code=country.currency_code,
+            currency_symbol=country.currency_symbol,
+            minor_unit=country.minor_unit,
+            timezone=country.default_timezone,
+            tax_model=country.tax_model,
+            tax_percent=state_tax if state_tax is not None else country.default_tax_percent,
+            is_surge_enabled=region.is_surge_enabled,
+            is_service_active=region.is_service_active,
+            version=version,
+        )
+        self._counters["loads"] += 1
+        return profile
+
+    def get(self, region_code):
+        """
+        The RegionProfile for `region_code`; raises Region.DoesNotExist
+        """
+        version = self.current_version()
+        key = str(region_code)
+
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self._counters["invalidations"] += 1
+                self._profiles = {}
+                self._version = version
+                self._loaded_at = time.monotonic()
+            elif time.monotonic() - self._loaded_at > self.max_age:
+                if self._profiles:
+                    self._counters["expirations"] += 1
+                self._profiles = {}
+                self._loaded_at = time.monotonic()
+            profile = self._profiles.get(key)
+
+        if profile is not None:
+            self._counters["hits"] += 1
+            return profile
+
+        profile = self._load(region_code, version)
+        with self._lock:
+            if self._version == version:
+                self._profiles[key] = profile
+        return profile
+
+    def stats(self):
+        report = {"regions": len(self._profiles), "version": self._version}
+        report.update(self._counters)
+        return report
+
+
+region_profiles = RegionProfileCache(
+    get_redis_client(getattr(settings, "REGION_PROFILE_REDIS_URL", None)),
+    max_age=getattr(settings, "REGION_PROFILE_MAX_AGE_SECONDS", 300),
+)
+
+metrics.register("region_profiles", region_profiles.stats)
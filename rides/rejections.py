@@ -0,0 +1,153 @@
+import time
+
+import h3
+from django.conf import settings
+from django.dispatch import receiver
+
+from ride_sharing import metrics
+from ride_sharing.local_redis import get_redis_client, is_local_url
+from ride_sharing.lookups import ride_statuses
+from rides.models import DriverRideRejection
+from rides.signals import ride_closed
+from rides.spatial_index import open_ride_index, ride_key
+
+
+DRIVER_KEY = "rejected:driver:{}"     # zset  ride_id -> expires_at
+RIDE_KEY = "rejected:ride:{}"         # set   driver ids that rejected the ride
+LOADED_KEY = "rejected:loaded:{}"     # marker: driver's open rejections loaded
+
+
+class RejectedRideCache:
+    """
+    Rides each driver has rejected, kept only while the ride is open. A
+    rejected ride stays hidden from the driver for as long as it is open,
+    however long ago they rejected it.
+
+    Entries are dropped as soon as the ride closes, so a driver's set
+    stays as small as the rides currently around them, however long their
+    rejection history is. The first lookup for a driver loads their
+    rejections of still-open rides from driver_ride_rejections, and the
+    set is reloaded that way every half `ttl_seconds`, before any entry
+    expires, so the TTL only bounds how long a ride whose close was
+    missed lingers in redis.
+
+    The cache only stands in for the database when its client is shared
+    by every worker. With a per-process client (`shared=False`) a
+    rejection recorded by another worker would never be seen, so every
+    lookup reads driver_ride_rejections instead. Discovery narrows that
+    read to the open rides it could return (see `rejected_keys`), so it
+    stays one indexed lookup however long the driver's history is; set
+    REJECTED_RIDES_REDIS_URL to take it off the poll path entirely.
+    """
+
+    def __init__(self, client, ttl_seconds=1800, shared=True):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.shared = shared
+        self._counters = {"adds": 0, "lookups": 0, "warms": 0, "closed": 0, "db_lookups": 0}
+
+    def add(self, driver_id, ride_id, now=None):
+        driver_id, ride_id = str(driver_id), str(ride_id)
+        now = time.time() if now is None else now
+
+        self.client.zadd(DRIVER_KEY.format(driver_id), {ride_id: now + self.ttl_seconds})
+        self.client.expire(DRIVER_KEY.format(driver_id), self.ttl_seconds)
+        self.client.sadd(RIDE_KEY.format(ride_id), driver_id)
+        self.client.expire(RIDE_KEY.format(ride_id), self.ttl_seconds)
+        self._counters["adds"] += 1
+
+    def mark_loaded(self, driver_id):
+        # reloaded well before the entries it loaded expire
+        self.client.set(LOADED_KEY.format(driver_id), 1, ex=max(1, self.ttl_seconds // 2))
+
+    def _open_rejections(self, driver_id, candidates=None):
+        """
+        ride_ids of the driver's rejections whose ride is still BOOKED, or
+        of the ones among `candidates` (open ride ids)
+        """
+        rejections = DriverRideRejection.objects.filter(driver_id=driver_id)
+        if candidates is not None:
+            rejections = rejections.filter(ride_id__in=candidates)
+        else:
+            rejections = rejections.filter(ride__ridedetailsforriders__ride_status=ride_statuses.get("BOOKED"))
+        return rejections.values_list("ride_id", flat=True).distinct()
+
+    def _warm(self, driver_id, now):
+        for ride_id in self._open_rejections(driver_id):
+            self.add(driver_id, ride_id, now=now)
+
+        self.mark_loaded(driver_id)
+        self._counters["warms"] += 1
+
+    def rejected_by(self, driver_id, now=None, candidates=None):
+        """
+        The still-open ride ids (as str) `driver_id` has rejected. Without
+        a shared client only `candidates` (open ride ids) are checked when
+        given.
+        """
+        driver_id = str(driver_id)
+        now = time.time() if now is None else now
+
+        if not self.shared:
+            if candidates is not None and not candidates:
+                return set()
+            self._counters["db_lookups"] += 1
+            return {str(ride_id) for ride_id in self._open_rejections(driver_id, candidates)}
+
+        if not self.client.exists(LOADED_KEY.format(driver_id)):
+            self._warm(driver_id, now)
+
+        key = DRIVER_KEY.format(driver_id)
+        self.client.zremrangebyscore(key, "-inf", now)
+        self._counters["lookups"] += 1
+        return set(self.client.zrangebyscore(key, now, "+inf"))
+
+    def rejected_keys(self, driver_id, cell=None, max_k=None):
+        """
+        rejected_by() as ride keys, comparable with OpenRide.ride_id. With
+        `cell` and `max_k` the database lookup only checks the open rides
+        within `max_k` rings of `cell`, the ones discovery can return.
+        """
+        candidates = None
+        if not self.shared and cell is not None:
+            candidates = [ride.ride_id for ride in open_ride_index.rides_in_cells(h3.grid_disk(cell, max_k))]
+        return {ride_key(ride_id) for ride_id in self.rejected_by(driver_id, candidates=candidates)}
+
+    def exclude_rejected(self, driver_id, rides):
+        """
+        Filters OpenRides down to the ones `driver_id` has not rejected
+        """
+        rejected = self.rejected_keys(driver_id)
+        if not rejected:
+            return list(rides)
+        return [ride for ride in rides if ride.ride_id not in rejected]
+
+    def discard_ride(self, ride_id):
+        ride_id = str(ride_id)
+        drivers = self.client.smembers(RIDE_KEY.format(ride_id))
+
+        for driver_id in drivers:
+            self.client.zrem(DRIVER_KEY.format(driver_id), ride_id)
+        self.client.delete(RIDE_KEY.format(ride_id))
+
+        if drivers:
+            self._counters["closed"] += 1
+
+    def stats(self):
+        return dict(self._counters)
+
+
+_rejected_rides_url = getattr(settings, "REJECTED_RIDES_REDIS_URL", None)
+
+rejected_rides = RejectedRideCache(
+    get_redis_client(_rejected_rides_url),
+    ttl_seconds=getattr(settings, "REJECTED_RIDES_TTL_SECONDS", 1800),
+    shared=not is_local_url(_rejected_rides_url),
+)
+
+metrics.register("rejected_rides", rejected_rides.stats)
+
+
+@receiver(ride_closed)
+def forget_closed_ride(sender, ride_id, **kwargs):
+    rejected_rides.discard_ride(ride_id)
@@ -1,63 +1,118 @@
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from authentication.models import User
 from rides.models import Ride, RideDetailsForRiders, RideStatusLookup, EventLog, Region, RideLocationLog, Driver, DriverRideRejection, RideCancellationLog
+from rides.signals import ride_booked
+from ride_sharing.lookups import ride_statuses
+from rides.eta import eta_service
+from rides.events import ride_event, ride_events
+from rides.geofence import geofences
+from rides.region_profiles import region_profiles
+from rides.state_machine import transition
 import uuid
 import secrets
 
 
+def violated_constraint(error):
+    """
+    Name of the constraint an IntegrityError broke, as reported by the
+    database driver ("" when it does not say)
+    """
+    diag = getattr(error.__cause__, "diag", None)
+    return getattr(diag, "constraint_name", None) or ""
+
+
 def generate_otp():
     return secrets.randbelow(900000) + 100000
 
 
 class BookRideSerializer(serializers.Serializer):
     user_id = serializers.UUIDField()
-    region_code = serializers.UUIDField()
+    region_code = serializers.UUIDField(required=False)
     from_location = serializers.IntegerField()
     to_location = serializers.IntegerField()
 
+    def validate(self, data):
+        """
+        Resolves the pickup cell against the region geofences: a missing
+        region_code is filled in from it, and a region_code whose area
+        does not contain the pickup is rejected
+        """
+        pickup_region = geofences.region_for_cell(data["from_location"])
+        region_code = data.get("region_code")
+
+        if region_code is None:
+            if pickup_region is None:
+                raise serializers.ValidationError({"from_location": "Pickup is outside every service area"})
+            data["region_code"] = uuid.UUID(pickup_region)
+        elif pickup_region != str(region_code) and (pickup_region is not None or geofences.covers(region_code)):
+            raise serializers.ValidationError({"from_location": "Pickup is outside the region"})
+
+        try:
+            profile = region_profiles.get(data["region_code"])
+        except Region.DoesNotExist:
+            raise serializers.ValidationError({"region_code": "Unknown region"})
+        if not profile.is_service_active:
+            raise serializers.ValidationError({"region_code": "Region is not in service"})
+
+        data["region_profile"] = profile
+        return data
+
     def create(self, validated_data):
-        user = User.objects.get(user_id=validated_data["user_id"])
-        region = Region.objects.get(region_code=validated_data["region_code"])
-        booked_status = RideStatusLookup.objects.get(ride_status="BOOKED")
+        """
+        Region, country and status come from worker caches and the rider
+        is referenced by id, so booking itself only inserts; an unknown
+        user_id fails the rider foreign key instead of costing a lookup
+        """
+        profile = validated_data["region_profile"]
+        booked_status = ride_statuses.get("BOOKED")
         otp = secrets.randbelow(900000) + 100000
 
-        ride = Ride.objects.create(
-            ride_id=uuid.uuid4(),
-            region=region,
-            currency_code=region.country.currency_code,
-            timezone=region.country.default_timezone
-        )
-
-        RideDetailsForRiders.objects.create(
-            ride=ride,
-            rider=user,
-            otp=otp,
-            from_location=validated_data["from_location"],
-            to_location=validated_data["to_location"],
-            ride_status=booked_status
-        )
-
-        EventLog.objects.create(
-            ride=ride,
-            ride_status=booked_status
+        try:
+            with transaction.atomic():
+                ride = Ride.objects.create(
+                    ride_id=uuid.uuid4(),
+                    region=profile.region,
+                    currency_code=profile.currency_code,
+                    timezone=profile.timezone,
+                    ride_eta_seconds=eta_service.eta_seconds(
+                        profile.region_code,
+                        validated_data["from_location"],
+                        validated_data["to_location"]
+                    )
+                )
+
+                details = RideDetailsForRiders.objects.create(
+                    ride=ride,
+                    rider_id=validated_data["user_id"],
+                    otp=otp,
+                    from_location=validated_data["from_location"],
+                    to_location=validated_data["to_location"],
+                    ride_status=booked_status
+                )
+                ride_events.publish(ride_event(ride.ride_id, "BOOKED"))
+        except IntegrityError as error:
+            # only the rider foreign key means a bad user_id; anything else is ours
+            if RideDetailsForRiders._meta.get_field("rider").column in violated_constraint(error):
+                raise serializers.ValidationError({"user_id": "Unknown user"})
+            raise
+
+        transaction.on_commit(
+            lambda: ride_booked.send(sender=RideDetailsForRiders, details=details)
         )
 
         return ride, otp
 
 
-class AvailableRideSerializer(serializers.ModelSerializer):
-    ride_id = serializers.UUIDField(source="ride.ride_id")
-    region = serializers.CharField(source="ride.region.region_name")
-
-    class Meta:
-        model = RideDetailsForRiders
-        fields = [
-            "ride_id",
-            "from_location",
-            "to_location",
-            "region",
-            "created_at"
-        ]
+class AvailableRideSerializer(serializers.Serializer):
+    """
+    Serializes OpenRide entries from the open ride index
+    """
+    ride_id = serializers.UUIDField()
+    from_location = serializers.CharField()
+    to_location = serializers.CharField()
+    region = serializers.CharField(source="region_name")
+    created_at = serializers.DateTimeField()
 
 
 class RideLocationLogSerializer(serializers.ModelSerializer):
@@ -102,9 +157,14 @@ class RideCancellationSerializer(serializers.Serializer):
         if role_name == "user":
             user_id = validated_data.pop("user_id")
             cancelled_by = User.objects.get(pk=user_id)
-            ride_detail = RideDetailsForRiders.objects.get(ride_id=ride_id, rider=User.objects.get(user_id=user_id))
-            ride_detail.ride_status = RideStatusLookup.objects.get(ride_status_id=7)
-            ride_detail.save()
+            RideDetailsForRiders.objects.get(ride_id=ride_id, rider=cancelled_by)
+
+            # the state machine checks the ride may still be cancelled, publishes
+            # the event and frees the driver
+            if not transition(ride_id, "CANCELLED"):
+                raise serializers.ValidationError(
+                    {"ride_id": "Ride cannot be cancelled from its current status"}
+                )
         else:
             driver_id = validated_data.pop("driver_id")
             cancelled_by_driver = Driver.objects.get(pk=driver_id)
@@ -139,6 +199,23 @@ class RejectRideSerializer(serializers.Serializer):
 
 
 class RideDetailsForRidersSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RideDetailsForRiders
+        fields = '__all__'
+
+
+class RideHistorySerializer(serializers.ModelSerializer):
+    """
+    RideDetailsForRidersSerializer plus the joined ride, region and status
+    fields, for querysets from rides.history
+    """
+    status_name = serializers.CharField(source="ride_status.ride_status", default=None)
+    region_name = serializers.CharField(source="ride.region.region_name")
+    currency_code = serializers.CharField(source="ride.currency_code")
+    driver = serializers.UUIDField(source="ride.driver_id", allow_null=True)
+    started_at = serializers.DateTimeField(source="ride.started_at")
+    ended_at = serializers.DateTimeField(source="ride.ended_at")
+
     class Meta:
         model = RideDetailsForRiders
         fields = '__all__'
\ No newline at end of file
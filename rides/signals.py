@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent once a ride is open for drivers (status BOOKED).
+# kwargs: details -> RideDetailsForRiders instance
+ride_booked = Signal()
+
+# Sent once a ride leaves BOOKED (accepted, cancelled, moved on ...).
+# kwargs: ride_id
+ride_closed = Signal()
@@ -0,0 +1,336 @@
+import logging
+import threading
+import time
+import uuid
+from typing import NamedTuple
+from datetime import datetime
+
+import h3
+from django.conf import settings
+from django.db import connection
+from django.dispatch import receiver
+
+from ride_sharing import metrics
+from ride_sharing.lookups import ride_statuses
+from drivers.presence import grid_ring
+from rides.models import RideDetailsForRiders
+from rides.signals import ride_booked, ride_closed
+
+logger = logging.getLogger(__name__)
+
+
+def to_h3_cell(value, resolution=None):
+    """
+    Normalises an H3 value (int, decimal string or hex string) to a hex cell,
+    optionally coarsened to `resolution`. Returns None for invalid input.
+    """
+    if value is None or value == "":
+        return None
+
+    if isinstance(value, int) or str(value).isdigit():
+        cell = h3.int_to_str(int(value))
+    else:
+        cell = str(value)
+
+    if not h3.is_valid_cell(cell):
+        return None
+
+    if resolution is not None and h3.get_resolution(cell) > resolution:
+        cell = h3.cell_to_parent(cell, resolution)
+
+    return cell
+
+
+def ride_key(ride_id):
+    return ride_id if isinstance(ride_id, uuid.UUID) else uuid.UUID(str(ride_id))
+
+
+class OpenRide(NamedTuple):
+    ride_id: object
+    cell: str
+    from_location: str
+    to_location: str
+    region_code: object
+    region_name: str
+    created_at: datetime
+
+
+class OpenRideIndex:
+    """
+    Process-level index of BOOKED rides keyed by H3 cell.
+
+    Kept current by the ride_booked / ride_closed signals and fully resynced
+    from the database every `refresh_seconds`, so rides booked through other
+    workers show up after about one refresh interval. Only the first lookup
+    in a worker loads the index itself; resyncs run on a background thread,
+    started by the first lookup that finds the index stale, so requests
+    never wait on the full scan.
+    """
+
+    def __init__(self, resolution=9, refresh_seconds=5):
+        self.resolution = resolution
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        self._cells = {}    # cell -> {ride_id: OpenRide}
+        self._rides = {}    # ride_id -> OpenRide
+        self._loaded_at = None
+        self._reloading = False
+        self._opened_during_reload = {}
+        self._closed_during_reload = set()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {"reloads": 0, "failed_reloads": 0, "last_reload_ms": 0.0}
+
+    def add(self, ride):
+        with self._lock:
+            self._discard(ride.ride_id)
+            self._rides[ride.ride_id] = ride
+            self._cells.setdefault(ride.cell, {})[ride.ride_id] = ride
+
+            if self._reloading:
+                self._opened_during_reload[ride.ride_id] = ride
+                self._closed_during_reload.discard(ride.ride_id)
+
+    def add_details(self, details):
+        ride = self.ride_from_details(details)
+        if ride is not None:
+            self.add(ride)
+
+    def ride_from_details(self, details):
+        """
+        Builds the OpenRide for a RideDetailsForRiders row, or None when its
+        pickup is not a valid H3 cell
+        """
+        return self._from_details(
+            details.ride_id,
+            details.from_location,
+            details.to_location,
+            details.ride.region_id,
+            details.ride.region.region_name,
+            details.created_at,
+        )
+
+    def discard(self, ride_id):
+        ride_id = ride_key(ride_id)
+        with self._lock:
+            self._discard(ride_id)
+
+            if self._reloading:
+                self._opened_during_reload.pop(ride_id, None)
+                self._closed_during_reload.add(ride_id)
+
+    def _discard(self, ride_id):
+        ride = self._rides.pop(ride_id, None)
+        if ride is None:
+            return
+
+        bucket = self._cells.get(ride.cell)
+        if bucket is not None:
+            bucket.pop(ride_id, None)
+            if not bucket:
+                del self._cells[ride.cell]
+
+    def get(self, ride_id):
+        self._ensure_fresh()
+        return self._rides.get(ride_key(ride_id))
+
+    def rides_in_cells(self, cells):
+        """
+        Returns open rides whose pickup cell is in `cells`, oldest first
+        """
+        self._ensure_fresh()
+
+        with self._lock:
+            found = []
+            for cell in cells:
+                bucket = self._cells.get(cell)
+                if bucket:
+                    found.extend(bucket.values())
+
+        found.sort(key=lambda ride: ride.created_at)
+        return found
+
+    def nearest_rides(self, cell, min_results=20, max_k=3, exclude=(), limit=None):
+        """
+        Searches outward from `cell` one ring at a time and stops at the
+        first ring that brings the total to `min_results`, or at `max_k`.
+        Returns at most `limit` (default `min_results`) [(OpenRide, ring)]
+        nearest ring first, oldest first within a ring; rides in `exclude`
+        are skipped and not counted.
+        """
+        if limit is None:
+            limit = min_results
+
+        cell = to_h3_cell(cell, self.resolution)
+        if cell is None:
+            return []
+
+        self._ensure_fresh()
+
+        found = []
+        for k in range(max_k + 1):
+            ring_rides = []
+            with self._lock:
+                for ring_cell in grid_ring(cell, k):
+                    bucket = self._cells.get(ring_cell)
+                    if bucket:
+                        ring_rides.extend(
+                            ride for ride_id, ride in bucket.items() if ride_id not in exclude
+                        )
+
+            ring_rides.sort(key=lambda ride: ride.created_at)
+            found.extend((ride, k) for ride in ring_rides)
+
+            if len(found) >= min_results:
+                break
+
+        # the last ring searched can hold far more rides than were asked for
+        return found[:limit]
+
+    def cell_counts(self):
+        """
+        {cell: number of open rides picking up there}
+        """
+        self._ensure_fresh()
+
+        with self._lock:
+            return {cell: len(bucket) for cell, bucket in self._cells.items()}
+
+    def snapshot(self):
+        """
+        Returns every open ride
+        """
+        self._ensure_fresh()
+
+        with self._lock:
+            return list(self._rides.values())
+
+    def __len__(self):
+        return len(self._rides)
+
+    def _ensure_fresh(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None:
+            # nothing to serve from yet
+            self.reload()
+        elif time.monotonic() - loaded_at >= self.refresh_seconds:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="open-ride-index", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.reload()
+            except Exception:
+                self._counters["failed_reloads"] += 1
+                logger.exception("open ride index reload failed")
+            finally:
+                # idle for most of the interval; don't hold a connection meanwhile
+                connection.close()
+            if self._stop.wait(self.refresh_seconds):
+                return
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        loaded_at = self._loaded_at
+        report = {
+            "rides": len(self),
+            "age_seconds": round(time.monotonic() - loaded_at, 1) if loaded_at is not None else None,
+        }
+        report.update(self._counters)
+        return report
+
+    def reload(self):
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+            self._opened_during_reload = {}
+            self._closed_during_reload = set()
+
+        started = time.perf_counter()
+        try:
+            rows = (
+                RideDetailsForRiders.objects
+                .filter(ride_status=ride_statuses.get("BOOKED"))
+                .values_list(
+                    "ride_id",
+                    "from_location",
+                    "to_location",
+                    "ride__region_id",
+                    "ride__region__region_name",
+                    "created_at",
+                )
+            )
+
+            rides = {}
+            for row in rows.iterator(chunk_size=2000):
+                ride = self._from_details(*row)
+                if ride is not None:
+                    rides[ride.ride_id] = ride
+        except Exception:
+            with self._lock:
+                self._reloading = False
+            raise
+
+        with self._lock:
+            rides.update(self._opened_during_reload)
+            for ride_id in self._closed_during_reload:
+                rides.pop(ride_id, None)
+
+            cells = {}
+            for ride in rides.values():
+                cells.setdefault(ride.cell, {})[ride.ride_id] = ride
+
+            self._rides = rides
+            self._cells = cells
+            self._loaded_at = time.monotonic()
+            self._reloading = False
+            self._counters["reloads"] += 1
+            self._counters["last_reload_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def _from_details(self, ride_id, from_location, to_location, region_code, region_name, created_at):
+        cell = to_h3_cell(from_location, self.resolution)
+        if cell is None:
+            return None
+
+        return OpenRide(
+            ride_id=ride_key(ride_id),
+            cell=cell,
+            from_location=from_location,
+            to_location=to_location,
+            region_code=region_code,
+            region_name=region_name,
+            created_at=created_at,
+        )
+
+
+open_ride_index = OpenRideIndex(
+    resolution=getattr(settings, "OPEN_RIDE_INDEX_RESOLUTION", 9),
+    refresh_seconds=getattr(settings, "OPEN_RIDE_INDEX_REFRESH_SECONDS", 5),
+)
+
+metrics.register("open_ride_index", open_ride_index.stats)
+
+
+@receiver(ride_booked)
+def index_booked_ride(sender, details, **kwargs):
+    open_ride_index.add_details(details)
+
+
+@receiver(ride_closed)
+def unindex_closed_ride(sender, ride_id, **kwargs):
+    open_ride_index.discard(ride_id)
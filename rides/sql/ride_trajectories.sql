@@ -0,0 +1,14 @@
+-- Compacted ride traces written by `manage.py compact_trajectories` (rides.models.RideTrajectory).
+-- Run once against the application database before the first compaction.
+
+CREATE TABLE IF NOT EXISTS ride_trajectories (
+    ride_id uuid PRIMARY KEY REFERENCES rides (ride_id) DEFERRABLE INITIALLY DEFERRED,
+    polyline text NOT NULL,
+    time_offsets text NOT NULL,
+    raw_points integer NOT NULL,
+    kept_points integer NOT NULL,
+    tolerance_m double precision NOT NULL,
+    started_at timestamp with time zone NULL,
+    ended_at timestamp with time zone NULL,
+    compacted_at timestamp with time zone NOT NULL
+);
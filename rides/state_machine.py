@@ -0,0 +1,295 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from drivers.models import VehicleDriverAssignment
+from drivers.presence import driver_presence
+from ride_sharing.lookups import ride_statuses
+from rides.events import ride_event, ride_events
+from rides.models import EventLog, Ride, RideDetailsForRiders
+from rides.signals import ride_booked, ride_closed
+
+
+# status -> statuses it may move to
+DEFAULT_TRANSITIONS = {
+    "BOOKED": ["DRIVER_ASSIGNED", "CANCELLED"],
+    "DRIVER_ASSIGNED": ["BOOKED", "RIDE_STARTED", "CANCELLED"],
+    "RIDE_STARTED": ["COMPLETED"],
+}
+
+# statuses that end the assigned driver's ride, so they can be matched again
+RELEASES_DRIVER = ("BOOKED", "COMPLETED", "CANCELLED")
+
+NOT_FOUND = "not_found"
+ALREADY_ACCEPTED = "already_accepted"
+OTP_VERIFIED = "otp_verified"
+INVALID_OTP = "invalid_otp"
+CONFLICT = "conflict"
+
+
+def allowed_sources(to_status):
+    """
+    Status ids a ride may be in to move to `to_status`
+    """
+    transitions = getattr(settings, "RIDE_STATUS_TRANSITIONS", DEFAULT_TRANSITIONS)
+    sources = []
+    for source, targets in transitions.items():
+        if to_status in targets:
+            try:
+                sources.append(ride_statuses.get(source).pk)
+            except ride_statuses.model.DoesNotExist:
+                continue
+    return sources
+
+
+def _column(model, field):
+    return connection.ops.quote_name(model._meta.get_field(field).column)
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+@lru_cache(maxsize=None)
+def _transition_sql(assign_driver, check_otp, reopen=False):
+    """
+    One statement that moves the ride's details row only if it is still in
+    an expected status and, only if that UPDATE hit a row, assigns the
+    driver (or, when the ride is reopened, clears the driver, the vehicle
+    and the OTP verification) and logs the event in event_log. Returns
+    the number of rows moved with the details row and the
+    ride's driver as they were when the statement started, so a loser can
+    tell why, and a winner which driver it released, without another
+    round trip.
+    """
+    details, ride_col, status_col = (
+        _table(RideDetailsForRiders),
+        _column(RideDetailsForRiders, "ride"),
+        _column(RideDetailsForRiders, "ride_status"),
+    )
+    verified_col = _column(RideDetailsForRiders, "verification_status")
+
+    set_verified = f", {verified_col} = TRUE" if check_otp else f", {verified_col} = FALSE" if reopen else ""
+    otp_check = (
+        f" AND {_column(RideDetailsForRiders, 'otp')} = %(otp)s AND NOT {verified_col}"
+        if check_otp else ""
+    )
+
+    assign = ""
+    if assign_driver:
+        assign = f""",
+        assigned AS (
+            UPDATE {_table(Ride)}
+            SET {_column(Ride, "driver")} = %(driver_id)s,
+                {_column(Ride, "vehicle")} = (
+                    SELECT {_column(VehicleDriverAssignment, "vehicle")}
+                    FROM {_table(VehicleDriverAssignment)}
+                    WHERE {_column(VehicleDriverAssignment, "driver")} = %(driver_id)s
+                      AND {_column(VehicleDriverAssignment, "start_time")} <= %(now)s
+                      AND {_column(VehicleDriverAssignment, "end_time")} >= %(now)s
+                    LIMIT 1
+                ),
+                {_column(Ride, "updated_at")} = %(now)s
+            WHERE {_column(Ride, "ride_id")} IN (SELECT {ride_col} FROM moved)
+        )"""
+    elif reopen:
+        assign = f""",
+        released AS (
+            UPDATE {_table(Ride)}
+            SET {_column(Ride, "driver")} = NULL,
+                {_column(Ride, "vehicle")} = NULL,
+                {_column(Ride, "updated_at")} = %(now)s
+            WHERE {_column(Ride, "ride_id")} IN (SELECT {ride_col} FROM moved)
+        )"""
+
+    event_columns = ", ".join(
+        _column(EventLog, field)
+        for field in ("event_id", "ride", "ride_status", "latitude", "longitude", "event_time")
+    )
+
+    return f"""
+        WITH moved AS (
+            UPDATE {details}
+            SET {status_col} = %(to_status)s{set_verified}
+            WHERE {ride_col} = %(ride_id)s
+              AND {status_col} = ANY(%(expected)s){otp_check}
+            RETURNING {ride_col}
+        ){assign},
+        logged AS (
+            INSERT INTO {_table(EventLog)} ({event_columns})
+            SELECT %(event_id)s, {ride_col}, %(to_status)s, %(latitude)s, %(longitude)s, %(now)s
+            FROM moved
+        )
+        SELECT (SELECT count(*) FROM moved), {status_col}, {verified_col},
+               {_column(RideDetailsForRiders, "otp")},
+               (SELECT {_column(Ride, "driver")} FROM {_table(Ride)}
+                WHERE {_column(Ride, "ride_id")} = %(ride_id)s)
+        FROM {details}
+        WHERE {ride_col} = %(ride_id)s
+        LIMIT 1
+    """
+
+
+def _transition_orm(params, assign_driver, check_otp, reopen=False):
+    """
+    The same compare-and-set as _transition_sql in separate statements,
+    for databases without writable CTEs. Returns (moved, the ride's
+    driver before the move).
+    """
+    with transaction.atomic():
+        previous_driver = (
+            Ride.objects.filter(ride_id=params["ride_id"]).values_list("driver_id", flat=True).first()
+        )
+        updates = {"ride_status_id": params["to_status"]}
+        rows = RideDetailsForRiders.objects.filter(
+            ride_id=params["ride_id"],
+            ride_status_id__in=params["expected"]
+        )
+        if check_otp:
+            rows = rows.filter(otp=params["otp"], verification_status=False)
+            updates["verification_status"] = True
+        elif reopen:
+            updates["verification_status"] = False
+
+        moved = rows.update(**updates)
+        if not moved:
+            return 0, previous_driver
+
+        if assign_driver:
+            vehicle_id = VehicleDriverAssignment.objects.filter(
+                driver_id=params["driver_id"],
+                start_time__lte=params["now"],
+                end_time__gte=params["now"]
+            ).values_list("vehicle_id", flat=True).first()
+
+            Ride.objects.filter(ride_id=params["ride_id"]).update(
+                driver_id=params["driver_id"],
+                vehicle_id=vehicle_id,
+                updated_at=params["now"]
+            )
+        elif reopen:
+            Ride.objects.filter(ride_id=params["ride_id"]).update(
+                driver_id=None,
+                vehicle_id=None,
+                updated_at=params["now"]
+            )
+        return moved, previous_driver
+
+
+def _apply(ride_id, to_status, expected, driver_id, otp, latitude, longitude):
+    """
+    Runs the compare-and-set. Returns (moved, details) where details is
+    {"ride_status_id", "verification_status", "otp"} for a ride that was
+    not moved, or None if the ride does not exist.
+    """
+    target = ride_statuses.get(to_status)
+    if expected is None:
+        expected_ids = allowed_sources(to_status)
+    else:
+        expected_ids = [ride_statuses.get(name).pk for name in expected]
+
+    event = ride_event(ride_id, to_status, driver_id, latitude, longitude)
+    params = {
+        "ride_id": ride_id,
+        "to_status": target.pk,
+        "expected": expected_ids,
+        "driver_id": driver_id,
+        "otp": None if otp is None else int(otp),
+        "now": event.event_time,
+        "event_id": event.event_id,
+        "latitude": event.latitude,
+        "longitude": event.longitude,
+    }
+    assign_driver = driver_id is not None
+    check_otp = otp is not None
+    # back to BOOKED: the ride must be acceptable again by any driver
+    reopen = not assign_driver and target.ride_status == "BOOKED"
+
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(_transition_sql(assign_driver, check_otp, reopen), params)
+            row = cursor.fetchone()
+
+        if row is None:
+            return False, None
+        moved = row[0] > 0
+        details = dict(zip(("ride_status_id", "verification_status", "otp"), row[1:4]))
+        previous_driver = row[4]
+        if moved:
+            ride_events.publish(event, logged=True)
+    else:
+        with transaction.atomic():
+            moved, previous_driver = (
+                _transition_orm(params, assign_driver, check_otp, reopen) if expected_ids else (0, None)
+            )
+            moved = bool(moved)
+            if moved:
+                ride_events.publish(event)
+        details = None if moved else (
+            RideDetailsForRiders.objects
+            .filter(ride_id=ride_id)
+            .values("ride_status_id", "verification_status", "otp")
+            .first()
+        )
+        if not moved and details is None:
+            return False, None
+
+    if moved:
+        if target.ride_status == "BOOKED":
+            transaction.on_commit(lambda: ride_booked.send(
+                sender=RideDetailsForRiders,
+                details=RideDetailsForRiders.objects.select_related("ride__region").get(ride_id=ride_id)
+            ))
+        else:
+            transaction.on_commit(
+                lambda: ride_closed.send(sender=RideDetailsForRiders, ride_id=ride_id)
+            )
+
+        if driver_id is not None:
+            transaction.on_commit(lambda: driver_presence.mark_busy(driver_id))
+        elif previous_driver is not None and target.ride_status in RELEASES_DRIVER:
+            transaction.on_commit(lambda: driver_presence.mark_free(previous_driver))
+
+    return moved, details
+
+
+def transition(ride_id, to_status, expected=None, driver_id=None, otp=None, latitude=None, longitude=None):
+    """
+    Moves a ride to `to_status` (a status name) if it is currently in one
+    of the `expected` status names, or in any status allowed to move
+    there. With `driver_id` the ride is assigned to that driver and their
+    current vehicle; with `otp` the rider's OTP must match and not be
+    verified yet. Moving back to BOOKED unassigns the driver and vehicle
+    and clears the OTP verification in the same statement.
+
+    No row is locked and nothing is read first: the conditional UPDATE
+    either wins or matches nothing, and the same statement inserts the
+    event_log row for the move; subscribers get the event once it
+    commits. Returns True if this call moved the ride, False if it was not
+    in an expected status (or the OTP check failed).
+    """
+    moved, _ = _apply(ride_id, to_status, expected, driver_id, otp, latitude, longitude)
+    return moved
+
+
+def accept_ride(ride_id, driver_id, otp):
+    """
+    BOOKED -> DRIVER_ASSIGNED for the driver holding the rider's OTP.
+    Returns None when this driver got the ride, otherwise why not
+    (NOT_FOUND, ALREADY_ACCEPTED, OTP_VERIFIED, INVALID_OTP or CONFLICT).
+    """
+    moved, details = _apply(ride_id, "DRIVER_ASSIGNED", ["BOOKED"], driver_id, otp, None, None)
+    if moved:
+        return None
+
+    if details is None:
+        return NOT_FOUND
+    if details["ride_status_id"] != ride_statuses.get("BOOKED").pk:
+        return ALREADY_ACCEPTED
+    if details["verification_status"]:
+        return OTP_VERIFIED
+    if details["otp"] != int(otp):
+        return INVALID_OTP
+    # lost a race the statement's snapshot could not see yet
+    return CONFLICT
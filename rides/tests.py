@@ -1,3 +1,1026 @@
-from django.test import TestCase
+import json
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import h3
+import numpy as np
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from drivers.presence import DriverPresenceRegistry, driver_presence
+from ride_sharing.idempotency import REPLAYED_HEADER, IdempotencyStore, idempotent
+from ride_sharing.local_redis import LocalRedis, get_redis_client
+from ride_sharing.lookups import LookupCache, ride_statuses
+from ride_sharing.test_utils import CENTER, cell_int, make_driver, make_lookups, make_region, make_ride, make_user
+from rides.consumers import DriverOfferConsumer
+from rides.eta import EtaService
+from rides.geofence import GeofenceIndex
+from rides.region_profiles import RegionProfileCache
+from rides.events import RideEventBus, ride_event
+from rides.location_buffer import LocationWriteBuffer
+from rides.location_ingest import (
+    MAX_SPEED, LocationPoint, parse_location_batch, parse_point, write_location_points,
+)
+from rides.matching import MatchingEngine, min_cost_matching
+from rides.models import (
+    DriverRideRejection, EventLog, Region, Ride, RideDetailsForRiders, RideLocationLog, RideStatusLookup, RideTrajectory,
+)
+from rides.offers import CHANNEL, OfferBroker
+from rides.parsers import decode_location_frames, encode_location_frames
+from rides.rejections import RejectedRideCache
+from rides.spatial_index import OpenRide, OpenRideIndex
+from rides import state_machine
+from rides.state_machine import accept_ride, transition
+from rides.trajectory import (
+    compact_rides, completed_ride_ids, decode_polyline, decode_time_offsets, encode_polyline, encode_time_offsets,
+    simplify,
+)
+
+
+class OpenRideIndexTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.region = make_region()
+        self.index = OpenRideIndex(resolution=9, refresh_seconds=3600)
+
+    def test_reload_reads_only_booked_rides(self):
+        _, booked = make_ride(self.region)
+        make_ride(self.region, status="COMPLETED")
+
+        self.index.reload()
+
+        self.assertEqual([ride.ride_id for ride in self.index.snapshot()], [booked.ride_id])
+        self.assertEqual(self.index.cell_counts(), {CENTER: 1})
+
+    def test_booked_and_closed_rides_update_the_index(self):
+        self.index.reload()
+        _, details = make_ride(self.region)
+
+        self.index.add_details(details)
+        self.assertIsNotNone(self.index.get(details.ride_id))
+
+        self.index.discard(str(details.ride_id))
+        self.assertIsNone(self.index.get(details.ride_id))
+        self.assertEqual(self.index.cell_counts(), {})
+
+    def test_rides_in_cells_oldest_first(self):
+        _, first = make_ride(self.region)
+        _, second = make_ride(self.region)
+        self.index.reload()
+
+        found = self.index.rides_in_cells([CENTER])
+        self.assertEqual([ride.ride_id for ride in found], [first.ride_id, second.ride_id])
+
+    def test_nearest_rides_stop_at_the_first_full_ring_and_are_capped(self):
+        far = h3.grid_ring(CENTER, 2)[0]
+        _, near = make_ride(self.region, pickup=h3.grid_ring(CENTER, 1)[0])
+        crowd = [make_ride(self.region, pickup=far)[1] for _ in range(5)]
+        make_ride(self.region, pickup=h3.grid_ring(CENTER, 3)[0])
+        self.index.reload()
+
+        found = self.index.nearest_rides(CENTER, min_results=3, max_k=3)
+
+        self.assertEqual(
+            [(ride.ride_id, ring) for ride, ring in found],
+            [(near.ride_id, 1), (crowd[0].ride_id, 2), (crowd[1].ride_id, 2)],
+        )
+
+    def test_nearest_rides_skip_excluded(self):
+        _, rejected = make_ride(self.region)
+        _, other = make_ride(self.region)
+        self.index.reload()
+
+        found = self.index.nearest_rides(CENTER, min_results=5, max_k=0, exclude={rejected.ride_id})
+
+        self.assertEqual([ride.ride_id for ride, _ in found], [other.ride_id])
+
+    def test_stale_lookups_resync_in_the_background(self):
+        self.index.reload()
+        self.index._loaded_at -= 3600
+        reloaded = threading.Event()
+
+        with mock.patch.object(self.index, "reload", side_effect=reloaded.set):
+            with self.assertNumQueries(0):
+                self.assertEqual(self.index.rides_in_cells([CENTER]), [])
+            self.assertTrue(reloaded.wait(5))
+        self.index.stop()
+        self.assertFalse(self.index._thread.is_alive())
+
+
+class MinCostMatchingTests(SimpleTestCase):
+    def match(self, pairs, n_rows, n_cols, max_cost):
+        rows, cols, costs = (np.array(column) for column in zip(*pairs))
+        matched_rows, matched_cols = min_cost_matching(rows, cols, costs, n_rows, n_cols, max_cost)
+        return sorted(zip(matched_rows.tolist(), matched_cols.tolist()))
+
+    def test_matching_is_global_not_greedy(self):
+        # greedy would give ride 0 its nearest driver and leave ride 1 with nobody
+        pairs = [(0, 0, 1.0), (0, 1, 2.0), (1, 0, 1.0)]
+        self.assertEqual(self.match(pairs, 2, 2, max_cost=3), [(0, 1), (1, 0)])
+
+    def test_pairs_above_max_cost_are_never_used(self):
+        pairs = [(0, 0, 0.0), (1, 1, 4.0)]
+        self.assertEqual(self.match(pairs, 2, 2, max_cost=3), [(0, 0)])
+        self.assertEqual(self.match([(0, 0, 4.0)], 1, 1, max_cost=3), [])
+
+
+class MatchingCommitTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.region = make_region()
+        self.index = OpenRideIndex(resolution=9, refresh_seconds=3600)
+        self.presence = DriverPresenceRegistry(LocalRedis())
+        self.engine = MatchingEngine(index=self.index, presence=self.presence)
+
+    def open_ride(self):
+        _, details = make_ride(self.region)
+        self.index.reload()
+        return self.index.get(details.ride_id)
+
+    def status(self, ride_id):
+        return RideDetailsForRiders.objects.get(ride_id=ride_id).ride_status.ride_status
+
+    def test_commit_assigns_and_marks_driver_busy(self):
+        driver = make_driver()
+        ride = self.open_ride()
+        self.presence.heartbeat(str(driver.driver_id), CENTER)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            committed = self.engine.commit([(ride, str(driver.driver_id))])
+
+        self.assertEqual(committed, [(ride.ride_id, str(driver.driver_id))])
+        self.assertEqual(self.status(ride.ride_id), "DRIVER_ASSIGNED")
+        self.assertEqual(Ride.objects.get(ride_id=ride.ride_id).driver_id, driver.driver_id)
+        self.assertIsNone(self.presence.heartbeat(str(driver.driver_id), CENTER))
+        self.assertEqual(self.presence.drivers_in_cells([CENTER]), {})
+
+    def test_commit_skips_driver_with_active_ride(self):
+        driver = make_driver()
+        make_ride(self.region, status="RIDE_STARTED", driver=driver)
+        ride = self.open_ride()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            committed = self.engine.commit([(ride, str(driver.driver_id))])
+
+        self.assertEqual(committed, [])
+        self.assertEqual(self.status(ride.ride_id), "BOOKED")
+        self.assertEqual(self.engine.stats()["conflicts"], 1)
+        self.assertTrue(self.presence.is_busy(str(driver.driver_id)))
+
+    def test_ride_end_frees_driver(self):
+        driver = make_driver()
+        ride, _ = make_ride(self.region, status="RIDE_STARTED", driver=driver)
+        driver_presence.mark_busy(driver.driver_id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(transition(ride.ride_id, "COMPLETED"))
+
+        self.assertFalse(driver_presence.is_busy(driver.driver_id))
+
+    def test_plan_pairs_rides_with_drivers_in_pickup_range(self):
+        near, far = h3.grid_ring(CENTER, 2)[0], h3.grid_ring(CENTER, 6)[0]
+        _, here = make_ride(self.region)
+        _, there = make_ride(self.region, pickup=near)
+        self.index.reload()
+        drivers = {name: str(make_driver().driver_id) for name in ("center", "near", "far")}
+        self.presence.heartbeat(drivers["center"], CENTER)
+        self.presence.heartbeat(drivers["near"], near)
+        self.presence.heartbeat(drivers["far"], far)
+
+        (region_code, pairs), = self.engine.plan()
+
+        self.assertEqual(region_code, self.region.region_code)
+        self.assertEqual(
+            sorted((ride.ride_id, driver_id) for ride, driver_id in pairs),
+            sorted([(here.ride_id, drivers["center"]), (there.ride_id, drivers["near"])]),
+        )
+
+    @override_settings(DRIVER_PRESENCE_REDIS_URL=None)
+    def test_run_matching_needs_shared_presence(self):
+        with self.assertRaises(CommandError):
+            call_command("run_matching")
+
+
+def open_ride(cell=CENTER):
+    return OpenRide(uuid.uuid4(), cell, str(h3.str_to_int(cell)), str(h3.str_to_int(cell)), 1, "Bengaluru", None)
+
+
+class OfferBrokerTests(SimpleTestCase):
+    def subscribe(self, broker, cell=CENTER):
+        received = queue.Queue()
+        broker.subscribe("driver", cell, received.put)
+        return received
+
+    def test_offer_and_withdrawal_reach_the_pickup_neighbourhood(self):
+        broker = OfferBroker(resolution=9)
+        near = self.subscribe(broker, h3.grid_ring(CENTER, 1)[0])
+        far = self.subscribe(broker, h3.grid_ring(CENTER, 3)[0])
+        ride = open_ride()
+
+        broker.publish_offer(ride)
+        broker.withdraw(ride.ride_id)
+
+        self.assertEqual(near.get_nowait()["type"], "offer")
+        self.assertEqual(near.get_nowait(), {"type": "offer_withdrawn", "ride_id": str(ride.ride_id)})
+        self.assertTrue(far.empty())
+
+    def test_offers_never_closed_expire(self):
+        broker = OfferBroker(resolution=9, offer_ttl=60)
+
+        with mock.patch("rides.offers.time.monotonic", return_value=1000):
+            broker.publish_offer(open_ride())
+        with mock.patch("rides.offers.time.monotonic", return_value=1061):
+            broker.publish_offer(open_ride())
+
+        self.assertEqual(broker.stats()["open_offers"], 1)
+        self.assertEqual(broker.stats()["expired"], 1)
+
+    def test_channel_carries_offers_between_workers(self):
+        client = LocalRedis()
+        booking_worker = OfferBroker(resolution=9, channel=client)
+        socket_worker = OfferBroker(resolution=9, channel=client)
+        self.addCleanup(socket_worker.stop)
+        received = self.subscribe(socket_worker)
+
+        deadline = time.monotonic() + 5
+        while not client._channels.get(CHANNEL) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        ride = open_ride()
+        booking_worker.publish_offer(ride)
+        booking_worker.withdraw(ride.ride_id)
+
+        self.assertEqual(received.get(timeout=5)["ride_id"], str(ride.ride_id))
+        self.assertEqual(received.get(timeout=5)["type"], "offer_withdrawn")
+        self.assertEqual(booking_worker.stats()["delivered"], 0)
+
+
+class DriverOfferConsumerTests(SimpleTestCase):
+    def setUp(self):
+        self.broker = OfferBroker(resolution=9)
+        self.index = mock.Mock()
+        self.index.rides_in_cells.return_value = []
+
+    def connect(self, query):
+        scope = {"type": "websocket", "path": f"/ws/drivers/{uuid.uuid4()}/offers/", "query_string": query.encode()}
+        return ApplicationCommunicator(DriverOfferConsumer(self.broker, self.index), scope)
+
+    async def receive_json(self, communicator):
+        return json.loads((await communicator.receive_output(timeout=5))["text"])
+
+    async def test_connections_without_a_cell_are_closed(self):
+        communicator = self.connect("k=1")
+        await communicator.send_input({"type": "websocket.connect"})
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4400})
+
+    async def test_drivers_get_waiting_and_new_offers_around_them(self):
+        waiting = open_ride()
+        self.index.rides_in_cells.return_value = [waiting]
+        communicator = self.connect(f"h3_index={CENTER}&k=1")
+        await communicator.send_input({"type": "websocket.connect"})
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.accept"})
+        self.assertEqual((await self.receive_json(communicator))["ride_id"], str(waiting.ride_id))
+
+        booked = open_ride(h3.grid_ring(CENTER, 1)[0])
+        self.broker.publish_offer(booked)
+        self.assertEqual((await self.receive_json(communicator))["ride_id"], str(booked.ride_id))
+
+        # moving away offers what waits around the new cell and stops offers from the old one
+        elsewhere = h3.grid_ring(CENTER, 5)[0]
+        waiting_there = open_ride(elsewhere)
+        self.index.rides_in_cells.return_value = [waiting_there]
+        await communicator.send_input({
+            "type": "websocket.receive", "text": json.dumps({"type": "location", "h3_index": elsewhere}),
+        })
+        self.assertEqual((await self.receive_json(communicator))["ride_id"], str(waiting_there.ride_id))
+
+        self.broker.publish_offer(open_ride())
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(timeout=5)
+        self.assertEqual(self.broker.stats()["subscriptions"], 0)
+        self.assertEqual(self.broker.stats()["subscribed_cells"], 0)
+
+
+def ping(**fields):
+    point = {
+        "ride_id": str(uuid.uuid4()), "driver_id": str(uuid.uuid4()),
+        "latitude": 12.9716, "longitude": 77.5946, "h3_index": CENTER, "speed": "12.5",
+    }
+    point.update(fields)
+    return point
+
+
+class LocationParsingTests(SimpleTestCase):
+    def test_speed_is_rounded_to_the_column(self):
+        self.assertEqual(parse_point(ping(speed="12.34567")).speed, Decimal("12.3457"))
+        self.assertIsNone(parse_point(ping(speed=None)).speed)
+
+    def test_speed_outside_the_column_is_rejected(self):
+        for speed in ("inf", "-Infinity", "NaN", "-1", str(MAX_SPEED + 1), 1e300):
+            with self.subTest(speed=speed), self.assertRaisesMessage(ValueError, "speed"):
+                parse_point(ping(speed=speed))
+
+    def test_batch_reports_bad_points_by_position(self):
+        with self.assertRaises(ValidationError) as raised:
+            parse_location_batch({
+                "ride_id": str(uuid.uuid4()),
+                "points": [ping(), ping(speed="inf"), ping(latitude=91)],
+            })
+
+        errors = raised.exception.detail["points"]
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertIn("speed", errors[1])
+
+
+class LocationBatchEndpointTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.driver = make_driver()
+        self.ride, _ = make_ride(make_region(), status="RIDE_STARTED", driver=self.driver)
+
+    def post(self, points):
+        body = {"ride_id": str(self.ride.ride_id), "driver_id": str(self.driver.driver_id), "points": points}
+        return self.client.post("/rides/location/batch/", body, content_type="application/json")
+
+    def point(self, **fields):
+        # points take the batch's ride and driver unless they set their own
+        point = ping()
+        del point["ride_id"], point["driver_id"]
+        return {**point, **fields}
+
+    def test_known_points_are_written_and_unknown_rides_counted(self):
+        response = self.post([self.point(speed="10"), self.point(speed="20"), self.point(ride_id=str(uuid.uuid4()))])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {"logged": 2, "rejected": 1})
+        self.assertEqual(
+            list(RideLocationLog.objects.filter(ride=self.ride).order_by("log_id").values_list("speed", flat=True)),
+            [Decimal("10"), Decimal("20")],
+        )
+
+    @override_settings(LOCATION_BATCH_MAX_POINTS=2)
+    def test_oversized_and_invalid_batches_write_nothing(self):
+        self.assertEqual(self.post([self.point()] * 3).status_code, 400)
+        self.assertEqual(self.post([self.point(), self.point(latitude=91)]).status_code, 400)
+        self.assertFalse(RideLocationLog.objects.exists())
+
+
+class LocationFrameTests(SimpleTestCase):
+    def test_frames_round_trip(self):
+        point = parse_point(ping(heading_towards="90", speed="12.5"))
+
+        decoded, = decode_location_frames(encode_location_frames([point]))
+
+        self.assertEqual(decoded, point._replace(heading_towards="90"))
+
+    def test_non_finite_values_are_rejected(self):
+        for fields in ({"speed": float("inf")}, {"speed": 1e30}, {"heading_towards": float("inf")}):
+            body = encode_location_frames([{**ping(speed=None), **fields}])
+            with self.subTest(fields=fields), self.assertRaises(ValueError):
+                decode_location_frames(body)
+
+
+class LocationBufferTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.driver = make_driver()
+        self.ride, _ = make_ride(make_region(), status="RIDE_STARTED", driver=self.driver)
+        self.buffer = LocationWriteBuffer(flush_points=10, max_attempts=2)
+        self.addCleanup(self.buffer.stop, flush=False)
+        # the buffer's thread owns its connection; here it is the test's, inside a transaction
+        for target in ("rides.location_buffer.close_old_connections", "rides.location_buffer.driver_locations"):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def point(self, h3_index=CENTER):
+        return LocationPoint(self.ride.ride_id, self.driver.driver_id, 12.97, 77.59, None, h3_index, None)
+
+    def test_poison_point_is_dead_lettered_and_the_rest_written(self):
+        poison = self.point(h3_index="x" * 21)      # longer than the column
+        self.buffer.offer([self.point(), self.point(), poison, self.point()])
+
+        with self.assertLogs("rides.location_buffer", "WARNING"):
+            self.assertEqual(self.buffer.flush(), 3)
+
+        self.assertEqual(RideLocationLog.objects.count(), 3)
+        self.assertEqual(self.buffer.stats()["dead_lettered"], 1)
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_failed_batch_is_retried_after_newer_points_then_dropped(self):
+        self.buffer.offer([self.point()])
+        with mock.patch.object(self.buffer, "_write", side_effect=OperationalError("down")), \
+                self.assertLogs("rides.location_buffer"):
+            self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.buffer.stats()["retrying"], 1)
+
+        self.buffer.offer([self.point(), self.point()])
+        write = self.buffer._write
+        calls = []
+
+        def fail_retries(batch):
+            calls.append(len(batch))
+            if len(batch) == 1:
+                raise OperationalError("still failing")
+            return write(batch)
+
+        with mock.patch.object(self.buffer, "_write", side_effect=fail_retries), \
+                self.assertLogs("rides.location_buffer"):
+            self.assertEqual(self.buffer.flush(), 2)
+
+        self.assertEqual(calls, [2, 1])
+        self.assertEqual(self.buffer.stats()["retrying"], 0)
+        self.assertEqual(self.buffer.stats()["dead_lettered"], 1)
+
+
+class TrajectoryEncodingTests(SimpleTestCase):
+    def test_simplify_drops_jitter_and_keeps_turns(self):
+        # east along a street with ~1 m of GPS jitter, then a turn north
+        east = [(12.97 + (i % 2) * 0.00001, 77.59 + i * 0.001) for i in range(10)]
+        north = [(12.97 + i * 0.001, 77.599) for i in range(1, 10)]
+
+        kept = simplify(np.array(east + north), tolerance_m=5.0)
+
+        self.assertEqual(kept.tolist(), [0, 9, 18])
+
+    def test_polylines_and_time_offsets_round_trip(self):
+        coords = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+        self.assertEqual(encode_polyline(coords), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(decode_polyline(encode_polyline(coords)).round(5).tolist(), [list(c) for c in coords])
+        self.assertEqual(decode_time_offsets(encode_time_offsets([0, 4, 9, 9, 30])).tolist(), [0, 4, 9, 9, 30])
+
+
+class TrajectoryTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.driver = make_driver()
+        self.ride, _ = make_ride(make_region(), status="COMPLETED", driver=self.driver)
+        # a zigzag, so any reordering changes the polyline
+        self.coords = [(round(12.97 + i * 0.001, 5), round(77.59 + (i % 2) * 0.001, 5)) for i in range(20)]
+
+    def write_trace(self):
+        write_location_points([
+            LocationPoint(self.ride.ride_id, self.driver.driver_id, lat, lng, None, CENTER, None)
+            for lat, lng in self.coords
+        ])
+
+    def test_points_of_one_flush_keep_their_order(self):
+        self.write_trace()
+        self.assertEqual(completed_ride_ids(), [self.ride.ride_id])
+        logged = RideLocationLog.objects.order_by("updated_at", "log_id").values_list("latitude", flat=True)
+        self.assertEqual([float(lat) for lat in logged], [lat for lat, _ in self.coords])
+
+        report = compact_rides([self.ride.ride_id], tolerance_m=0.0)
+
+        trajectory = RideTrajectory.objects.get(ride_id=self.ride.ride_id)
+        self.assertEqual(decode_polyline(trajectory.polyline).round(5).tolist(), [list(c) for c in self.coords])
+        self.assertEqual(report["rides"], 1)
+        self.assertFalse(RideLocationLog.objects.filter(ride_id=self.ride.ride_id).exists())
+
+    def test_ride_compacted_meanwhile_keeps_its_raw_rows(self):
+        self.write_trace()
+        RideTrajectory.objects.create(
+            ride=self.ride, polyline="", time_offsets="", raw_points=0, kept_points=0, tolerance_m=5.0
+        )
+
+        report = compact_rides([self.ride.ride_id])
+
+        self.assertEqual(report["rides"], 0)
+        self.assertEqual(RideLocationLog.objects.filter(ride_id=self.ride.ride_id).count(), len(self.coords))
+        self.assertEqual(RideTrajectory.objects.get(ride_id=self.ride.ride_id).raw_points, 0)
+
+    def test_schema_script_creates_the_table_the_model_uses(self):
+        script = Path(settings.BASE_DIR) / "rides" / "sql" / "ride_trajectories.sql"
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE ride_trajectories")
+            cursor.execute(script.read_text())
+
+        self.write_trace()
+        compact_rides([self.ride.ride_id])
+        self.assertEqual(RideTrajectory.objects.get(ride_id=self.ride.ride_id).raw_points, len(self.coords))
+
+    def test_compaction_refuses_to_run_without_the_table(self):
+        with mock.patch.object(connection.introspection, "table_names", return_value=[]):
+            with self.assertRaisesMessage(CommandError, "ride_trajectories.sql"):
+                call_command("compact_trajectories")
+
+
+class LookupCacheTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.cache = LookupCache(RideStatusLookup, "ride_status")
+
+    def test_rows_are_served_without_queries_once_loaded(self):
+        booked = self.cache.get("BOOKED")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get("BOOKED"), booked)
+            self.assertEqual(self.cache.by_id(booked.pk), booked)
+
+    def test_saves_and_missing_names_reload(self):
+        self.cache.get("BOOKED")
+
+        RideStatusLookup.objects.create(ride_status="EXPIRED")
+        self.assertEqual(self.cache.get("EXPIRED").ride_status, "EXPIRED")
+
+        with self.assertRaises(RideStatusLookup.DoesNotExist):
+            self.cache.get("NO_SUCH_STATUS")
+
+
+class RejectedRideCacheTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.driver = make_driver()
+        self.ride, _ = make_ride(make_region())
+
+    def test_per_process_cache_reads_rejections_from_the_database(self):
+        # recorded by another worker: this process never called add()
+        DriverRideRejection.objects.create(ride=self.ride, driver=self.driver)
+        cache = RejectedRideCache(LocalRedis(), shared=False)
+
+        self.assertEqual(cache.rejected_keys(self.driver.driver_id), {self.ride.ride_id})
+        self.assertEqual(cache.stats()["db_lookups"], 1)
+
+    def test_shared_cache_forgets_closed_rides(self):
+        cache = RejectedRideCache(LocalRedis())
+        cache.mark_loaded(self.driver.driver_id)
+        cache.add(self.driver.driver_id, self.ride.ride_id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.rejected_keys(self.driver.driver_id), {self.ride.ride_id})
+
+        cache.discard_ride(self.ride.ride_id)
+        self.assertEqual(cache.rejected_keys(self.driver.driver_id), set())
+
+    def test_old_rejections_of_open_rides_stay_excluded(self):
+        rejection = DriverRideRejection.objects.create(ride=self.ride, driver=self.driver)
+        DriverRideRejection.objects.filter(pk=rejection.pk).update(rejected_at=timezone.now() - timedelta(days=2))
+        closed, _ = make_ride(self.ride.region, status="COMPLETED")
+        DriverRideRejection.objects.create(ride=closed, driver=self.driver)
+
+        for cache in (RejectedRideCache(LocalRedis(), shared=False), RejectedRideCache(LocalRedis(), ttl_seconds=60)):
+            self.assertEqual(cache.rejected_keys(self.driver.driver_id), {self.ride.ride_id})
+
+    def test_database_lookups_only_check_the_rides_discovery_can_return(self):
+        DriverRideRejection.objects.create(ride=self.ride, driver=self.driver)
+        cache = RejectedRideCache(LocalRedis(), shared=False)
+
+        self.assertEqual(cache.rejected_keys(self.driver.driver_id, CENTER, 1), {self.ride.ride_id})
+        far = h3.grid_ring(CENTER, 5)[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.rejected_keys(self.driver.driver_id, far, 1), set())
+
+    def test_shared_cache_reloads_before_its_entries_expire(self):
+        cache = RejectedRideCache(LocalRedis(), ttl_seconds=60)
+        DriverRideRejection.objects.create(ride=self.ride, driver=self.driver)
+        cache.rejected_keys(self.driver.driver_id)
+
+        later = time.time() + 59
+        with mock.patch("ride_sharing.local_redis.time.time", return_value=later):
+            self.assertEqual(cache.rejected_by(self.driver.driver_id, now=later), {str(self.ride.ride_id)})
+        self.assertEqual(cache.stats()["warms"], 2)
+
+
+class EtaServiceTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.service = EtaService(directory.name, resolutions=(9, 8), check_interval=0, max_cells=200)
+        self.city = list(h3.grid_disk(CENTER, 3))
+        self.neighbour = h3.grid_ring(CENTER, 1)[0]
+
+    def test_rebuilt_table_is_picked_up_and_the_old_build_deleted(self):
+        self.service.save("blr", 9, {cell: 10.0 for cell in self.city})
+        slow = self.service.eta_seconds("blr", CENTER, self.neighbour)
+        old_files = set(self.service.directory.iterdir())
+
+        self.service.save("blr", 9, {cell: 40.0 for cell in self.city})
+
+        self.assertAlmostEqual(self.service.eta_seconds("blr", CENTER, self.neighbour), slow / 4, delta=1)
+        self.assertEqual(len(set(self.service.directory.iterdir())), len(old_files))
+        self.assertFalse(old_files & set(self.service.directory.glob("*.npy")))
+
+    def test_oversized_build_keeps_the_previous_table(self):
+        self.service.save("blr", 9, {cell: 10.0 for cell in self.city})
+
+        with self.assertRaisesMessage(ValueError, "cell limit"):
+            self.service.save("blr", 9, {cell: 10.0 for cell in h3.grid_disk(CENTER, 10)})
+
+        self.assertEqual(self.service.table("blr").resolution, 9)
+
+    def test_removed_resolution_falls_back_to_a_coarser_table(self):
+        self.service.save("blr", 9, {cell: 10.0 for cell in self.city})
+        self.service.save("blr", 8, {h3.cell_to_parent(CENTER, 8): 10.0})
+
+        self.service.remove("blr", 9)
+
+        self.assertEqual(self.service.table("blr").resolution, 8)
+        self.assertIsNotNone(self.service.eta_seconds("blr", CENTER, self.neighbour))
+
+
+class EtaBuildCommandTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.driver = make_driver()
+        self.ride, _ = make_ride(make_region(), status="COMPLETED", driver=self.driver)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.service = EtaService(directory.name, resolutions=(9,))
+        patcher = mock.patch("rides.management.commands.build_eta_matrix.eta_service", self.service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def drive(self, reported):
+        """
+        30 pings 10 s apart heading north at 36 km/h, each reporting `reported`
+        """
+        start = timezone.now() - timedelta(hours=1)
+        lat, lng = h3.cell_to_latlng(CENTER)
+        write_location_points([
+            LocationPoint(
+                self.ride.ride_id, self.driver.driver_id, lat + i * 0.0009, lng, None,
+                h3.latlng_to_cell(lat + i * 0.0009, lng, 9), Decimal(reported),
+            )
+            for i in range(30)
+        ])
+        logged = RideLocationLog.objects.order_by("updated_at", "log_id").values_list("log_id", flat=True)
+        for i, log_id in enumerate(logged):
+            RideLocationLog.objects.filter(log_id=log_id).update(updated_at=start + timedelta(seconds=10 * i))
+
+    def build(self, unit):
+        out = StringIO()
+        call_command("build_eta_matrix", "--resolution", "9", "--speed-unit", unit, stdout=out)
+        return out.getvalue()
+
+    def test_speeds_are_converted_from_the_configured_unit(self):
+        self.drive("10")
+
+        self.assertIn("r9:", self.build("m/s"))
+        self.assertEqual(self.service.table(str(self.ride.region_id)).resolution, 9)
+
+    def test_regions_whose_pings_disagree_with_the_unit_are_skipped(self):
+        self.drive("10")
+
+        self.assertIn("check LOCATION_SPEED_UNIT", self.build("km/h"))
+        self.assertIsNone(self.service.table(str(self.ride.region_id)))
+
+
+class IdempotencyTests(SimpleTestCase):
+    def setUp(self):
+        store = IdempotencyStore(LocalRedis(), shared=False)
+        calls = self.calls = []
+
+        class BookView(APIView):
+            authentication_classes = []
+            permission_classes = []
+
+            @idempotent("tests.book", owner_field="user_id", store=store)
+            def post(self, request):
+                calls.append(request.data["user_id"])
+                return Response({"booking": len(calls)}, status=201)
+
+        self.view = BookView.as_view()
+
+    def post(self, user_id, key="key-1"):
+        request = APIRequestFactory().post(
+            "/book/", {"user_id": user_id}, format="json", HTTP_IDEMPOTENCY_KEY=key
+        )
+        return self.view(request)
+
+    def test_retries_replay_the_first_response(self):
+        first, retry = self.post("rider-a"), self.post("rider-a")
+
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry[REPLAYED_HEADER], "true")
+        self.assertEqual(self.calls, ["rider-a"])
+
+    def test_keys_are_scoped_per_caller(self):
+        self.post("rider-a")
+        other = self.post("rider-b")
+
+        self.assertEqual(other.data, {"booking": 2})
+        self.assertFalse(other.has_header(REPLAYED_HEADER))
+        self.assertEqual(self.calls, ["rider-a", "rider-b"])
+
+
+class LocalRedisTests(SimpleTestCase):
+    def test_expired_keys_are_swept_by_writes_without_being_read(self):
+        client = LocalRedis()
+        with mock.patch("ride_sharing.local_redis.time.time", return_value=1000):
+            client.set("stored-response", "{}", ex=60)
+            client.set("counter", 1)
+        with mock.patch("ride_sharing.local_redis.time.time", return_value=1061):
+            client.set("other", "{}", ex=60)
+
+        self.assertEqual(sorted(client._data), ["counter", "other"])
+
+    def test_local_clients_are_shared_per_url_and_key_limit(self):
+        unbounded = get_redis_client("local://tests")
+
+        self.assertIs(get_redis_client("local://tests"), unbounded)
+        self.assertIsNot(get_redis_client("local://tests", max_keys=10), unbounded)
+        self.assertEqual(get_redis_client("local://tests", max_keys=10).max_keys, 10)
+        self.assertIsNone(unbounded.max_keys)
+
+
+class GeofenceIndexTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        lat, lng = h3.cell_to_latlng(CENTER)
+        self.region = make_region(geo_boundary=[
+            [lat - 0.05, lng - 0.05], [lat - 0.05, lng + 0.05], [lat + 0.05, lng + 0.05], [lat + 0.05, lng - 0.05],
+        ])
+        self.cache_dir = tempfile.mkdtemp()
+        self.client = LocalRedis()
+        self.index = GeofenceIndex(self.cache_dir, self.client)
+
+    def test_saves_in_another_worker_rebuild_the_index(self):
+        other_worker = GeofenceIndex(self.cache_dir, self.client)
+        self.assertEqual(self.index.region_for_cell(CENTER), str(self.region.region_code))
+
+        Region.objects.filter(pk=self.region.pk).update(is_service_active=False)
+        self.assertEqual(self.index.region_for_cell(CENTER), str(self.region.region_code))
+
+        other_worker.bump()
+        self.assertIsNone(self.index.region_for_cell(CENTER))
+        self.assertEqual(self.index.stats()["invalidations"], 1)
+
+    def test_index_is_rebuilt_after_max_age(self):
+        index = GeofenceIndex(self.cache_dir, LocalRedis(), max_age=0)
+        self.assertEqual(index.region_for_cell(CENTER), str(self.region.region_code))
+
+        Region.objects.filter(pk=self.region.pk).update(is_service_active=False)
+        time.sleep(0.01)
+        self.assertIsNone(index.region_for_cell(CENTER))
+
+
+class RegionProfileCacheTests(TestCase):
+    def setUp(self):
+        self.region = make_region()
+
+    def test_version_bumps_reload_profiles(self):
+        client = LocalRedis()
+        cache, other_worker = RegionProfileCache(client), RegionProfileCache(client)
+        self.assertTrue(cache.get(self.region.region_code).is_service_active)
+
+        Region.objects.filter(pk=self.region.pk).update(is_service_active=False)
+        self.assertTrue(cache.get(self.region.region_code).is_service_active)
+
+        other_worker.bump()
+        self.assertFalse(cache.get(self.region.region_code).is_service_active)
+
+    def test_profiles_expire_after_max_age(self):
+        cache = RegionProfileCache(LocalRedis(), max_age=0)
+        cache.get(self.region.region_code)
+
+        Region.objects.filter(pk=self.region.pk).update(is_service_active=False)
+        time.sleep(0.01)
+        self.assertFalse(cache.get(self.region.region_code).is_service_active)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+
+class BookRideTests(TransactionTestCase):
+    # foreign keys in the test database are deferred, so violations only surface on a real commit
+    def setUp(self):
+        make_lookups()
+        self.region = make_region()
+
+    def book(self, user_id):
+        return self.client.post(
+            "/rides/book/",
+            {"user_id": str(user_id), "region_code": str(self.region.region_code),
+             "from_location": cell_int(), "to_location": cell_int()},
+            content_type="application/json",
+        )
+
+    def test_booking_logs_the_event_with_the_ride(self):
+        response = self.book(make_user().user_id)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(EventLog.objects.filter(ride_id=response.json()["ride_id"]).exists())
+
+    def test_unknown_rider_is_a_validation_error(self):
+        response = self.book(uuid.uuid4())
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"user_id": "Unknown user"})
+
+    def test_other_integrity_errors_are_not_blamed_on_the_rider(self):
+        orphan_event = lambda ride_id, status: ride_event(uuid.uuid4(), status)
+
+        with mock.patch("rides.serializers.ride_event", orphan_event):
+            with self.assertRaises(IntegrityError):
+                self.book(make_user().user_id)
+
+
+class RideEventBusTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.ride, _ = make_ride(make_region())
+        self.bus = RideEventBus(max_events=2, flush_interval=60)
+        self.received = []
+        self.bus.subscribe("test", self.received.extend)
+
+    def tearDown(self):
+        self.bus.stop(flush=False)
+
+    def test_events_are_logged_in_the_publishing_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.bus.publish(ride_event(self.ride.ride_id, "CANCELLED"))
+                self.assertTrue(EventLog.objects.filter(ride_id=self.ride.ride_id).exists())
+                raise RuntimeError
+        self.assertFalse(EventLog.objects.filter(ride_id=self.ride.ride_id).exists())
+
+        event = ride_event(self.ride.ride_id, "CANCELLED")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bus.publish(event)
+        self.bus.flush()
+
+        self.assertTrue(EventLog.objects.filter(event_id=event.event_id).exists())
+        self.assertEqual(self.received, [event])
+
+    def test_a_full_queue_drops_delivery_without_io(self):
+        events = [ride_event(self.ride.ride_id, "CANCELLED") for _ in range(3)]
+
+        with self.assertNumQueries(0):
+            self.bus.offer(events)
+        self.bus.flush()
+
+        self.assertEqual(self.received, [])
+        self.assertEqual(self.bus.stats()["overflow"], 3)
+
+    def test_failing_subscribers_get_the_events_again(self):
+        failures = []
+
+        def flaky(events):
+            if not failures:
+                failures.append(events)
+                raise RuntimeError("unavailable")
+            self.received.extend(events)
+
+        self.bus.subscribe("test", flaky)
+        event = ride_event(self.ride.ride_id, "CANCELLED")
+        self.bus.offer([event])
+        self.bus.flush()
+        self.bus.flush()
+
+        self.assertEqual(self.received, [event])
+        self.assertEqual(self.bus.stats()["subscriber_errors"], 1)
+
+    def test_transitions_log_their_event_in_the_same_statement(self):
+        self.assertTrue(transition(self.ride.ride_id, "CANCELLED"))
+        self.assertTrue(
+            EventLog.objects.filter(ride_id=self.ride.ride_id, ride_status=ride_statuses.get("CANCELLED")).exists()
+        )
+
+
+class RideHistoryTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        region = make_region()
+        self.rider = make_user()
+        self.details = [make_ride(region, rider=self.rider)[1] for _ in range(5)]
+        # equal timestamps: the id alone has to keep pages apart
+        RideDetailsForRiders.objects.filter(rider=self.rider).update(created_at=self.details[0].created_at)
+        make_ride(region)
+
+    def url(self, **params):
+        query = "&".join(f"{key}={value}" for key, value in params.items())
+        return f"/rides/list_previous_rides/{self.rider.user_id}?{query}"
+
+    def test_pages_cover_the_history_once_newest_first(self):
+        seen, cursor = [], None
+        while True:
+            response = self.client.get(self.url(limit=2, **({"cursor": cursor} if cursor else {})))
+            self.assertEqual(response.status_code, 200)
+            seen += [row["ride_detail_id"] for row in response.json()["results"]]
+            cursor = response.json()["next_cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, sorted((d.ride_detail_id for d in self.details), reverse=True))
+
+    def test_pages_take_one_query(self):
+        with self.assertNumQueries(1):
+            self.client.get(self.url(limit=2))
+
+    def test_bad_cursor_and_limit_are_rejected(self):
+        self.assertEqual(self.client.get(self.url(cursor="not-a-cursor")).status_code, 400)
+        self.assertEqual(self.client.get(self.url(limit="many")).status_code, 400)
+
+    def test_ndjson_export_streams_every_ride(self):
+        with self.settings(RIDE_HISTORY_EXPORT_CHUNK=2):
+            response = self.client.get(self.url(export="ndjson"))
+            lines = b"".join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(
+            [json.loads(line)["ride_detail_id"] for line in lines],
+            sorted((d.ride_detail_id for d in self.details), reverse=True)
+        )
+
+
+class StateMachineTests(TestCase):
+    def setUp(self):
+        make_lookups()
+        self.region = make_region()
+        self.ride, self.details = make_ride(self.region)
+
+    def details_row(self):
+        return RideDetailsForRiders.objects.select_related("ride", "ride_status").get(ride_id=self.ride.ride_id)
+
+    def test_accept_checks_the_otp_and_status(self):
+        first, second = make_driver(), make_driver()
+
+        self.assertEqual(accept_ride(self.ride.ride_id, second.driver_id, 111111), state_machine.INVALID_OTP)
+        self.assertIsNone(accept_ride(self.ride.ride_id, first.driver_id, self.details.otp))
+        self.assertEqual(
+            accept_ride(self.ride.ride_id, second.driver_id, self.details.otp), state_machine.ALREADY_ACCEPTED
+        )
+        self.assertEqual(accept_ride(uuid.uuid4(), second.driver_id, self.details.otp), state_machine.NOT_FOUND)
+
+        row = self.details_row()
+        self.assertEqual(row.ride_status.ride_status, "DRIVER_ASSIGNED")
+        self.assertTrue(row.verification_status)
+        self.assertEqual(row.ride.driver_id, first.driver_id)
+
+    def test_reopened_ride_can_be_accepted_again(self):
+        first, second = make_driver(), make_driver()
+        accept_ride(self.ride.ride_id, first.driver_id, self.details.otp)
+
+        self.assertTrue(transition(self.ride.ride_id, "BOOKED"))
+        row = self.details_row()
+        self.assertFalse(row.verification_status)
+        self.assertIsNone(row.ride.driver_id)
+        self.assertIsNone(row.ride.vehicle_id)
+
+        self.assertIsNone(accept_ride(self.ride.ride_id, second.driver_id, self.details.otp))
+        self.assertEqual(self.details_row().ride.driver_id, second.driver_id)
+
+    def test_rider_cancels_through_the_state_machine(self):
+        rider_id = str(self.details.rider_id)
+        response = self.client.post(
+            "/rides/cancel/", {"ride_id": str(self.ride.ride_id), "role_name": "user", "user_id": rider_id},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.details_row().ride_status.ride_status, "CANCELLED")
+
+        response = self.client.post(
+            "/rides/cancel/", {"ride_id": str(self.ride.ride_id), "role_name": "user", "user_id": rider_id},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class AcceptRaceTests(TransactionTestCase):
+    def test_exactly_one_concurrent_accept_wins(self):
+        make_lookups()
+        ride, details = make_ride(make_region())
+        drivers = [make_driver() for _ in range(8)]
+        results = {}
+        start = threading.Barrier(len(drivers))
+
+        def accept(driver):
+            start.wait()
+            try:
+                results[driver.driver_id] = accept_ride(ride.ride_id, driver.driver_id, details.otp)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept, args=(driver,)) for driver in drivers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        winners = [driver_id for driver_id, result in results.items() if result is None]
+        self.assertEqual(len(winners), 1)
+        self.assertEqual(Ride.objects.get(ride_id=ride.ride_id).driver_id, winners[0])
+        self.assertTrue(all(
+            result in (state_machine.ALREADY_ACCEPTED, state_machine.CONFLICT)
+            for result in results.values() if result is not None
+        ))
@@ -0,0 +1,255 @@
+from functools import reduce
+from itertools import groupby
+from operator import or_
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from rides.models import Ride, RideLocationLog, RideTrajectory
+
+EARTH_RADIUS_M = 6371008.8
+
+# rough on-disk sizes used for the storage report (tuple header, uuids,
+# timestamps, numeric); text columns are counted by their length
+_LOG_ROW_FIXED_BYTES = 24 + 16 * 3 + 8 + 8
+_TRAJECTORY_ROW_FIXED_BYTES = 24 + 16 + 4 * 2 + 8 * 4
+
+
+def project(coords):
+    """
+    (n, 2) lat/lng degrees to local equirectangular metres around the
+    first point, accurate enough for city-scale traces
+    """
+    lat0 = np.radians(coords[0, 0])
+    radians = np.radians(coords)
+    return np.column_stack((
+        (radians[:, 1] - radians[0, 1]) * np.cos(lat0) * EARTH_RADIUS_M,
+        (radians[:, 0] - radians[0, 0]) * EARTH_RADIUS_M,
+    ))
+
+
+def _segment_distances(points, start, end):
+    """
+    Distance of every point to the segment start-end
+    """
+    segment = end - start
+    length_sq = float(segment @ segment)
+    offsets = points - start
+
+    if length_sq == 0.0:
+        return np.hypot(offsets[:, 0], offsets[:, 1])
+
+    t = np.clip(offsets @ segment / length_sq, 0.0, 1.0)
+    nearest = start + t[:, None] * segment
+    return np.hypot(points[:, 0] - nearest[:, 0], points[:, 1] - nearest[:, 1])
+
+
+def simplify(coords, tolerance_m):
+    """
+    Douglas-Peucker over an (n, 2) lat/lng array. Each split measures all
+    the points of its span in one numpy pass. Returns the indices kept,
+    always including both ends.
+    """
+    count = len(coords)
+    if count <= 2:
+        return np.arange(count)
+
+    points = project(coords)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    spans = [(0, count - 1)]
+    while spans:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+
+        distances = _segment_distances(points[first + 1:last], points[first], points[last])
+        farthest = int(np.argmax(distances))
+
+        if distances[farthest] > tolerance_m:
+            split = first + 1 + farthest
+            keep[split] = True
+            spans.append((first, split))
+            spans.append((split, last))
+
+    return np.flatnonzero(keep)
+
+
+def _encode_ints(values):
+    """
+    Google polyline varint encoding of a 1-d integer array
+    """
+    zigzag = np.where(values < 0, ~(values << 1), values << 1).tolist()
+
+    chars = []
+    for value in zigzag:
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return "".join(chars)
+
+
+def _decode_ints(text):
+    values = []
+    value = shift = 0
+    for char in text:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    return np.array(values, dtype=np.int64)
+
+
+def encode_polyline(coords, precision=5):
+    """
+    Delta-encodes an (n, 2) lat/lng array in the Google polyline format
+    """
+    scaled = np.round(np.asarray(coords, dtype=np.float64) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    return _encode_ints(deltas.ravel())
+
+
+def decode_polyline(text, precision=5):
+    return np.cumsum(_decode_ints(text).reshape(-1, 2), axis=0) / 10 ** precision
+
+
+def encode_time_offsets(seconds):
+    """
+    Delta-encodes whole seconds since the first point
+    """
+    seconds = np.asarray(seconds, dtype=np.int64)
+    return _encode_ints(np.diff(seconds, prepend=np.int64(0)))
+
+
+def decode_time_offsets(text):
+    return np.cumsum(_decode_ints(text))
+
+
+def completed_ride_ids(limit=None):
+    """
+    Rides that are over (ended, or in a final status) and still have raw
+    location rows but no trajectory yet
+    """
+    final_statuses = getattr(settings, "TRAJECTORY_FINAL_STATUSES", ("COMPLETED", "CANCELLED"))
+
+    completed = Ride.objects.filter(
+        Q(ended_at__isnull=False)
+        | Q(ridedetailsforriders__ride_status__ride_status__in=final_statuses),
+        trajectory__isnull=True,
+    ).values("ride_id")
+
+    ride_ids = (
+        RideLocationLog.objects
+        .filter(ride_id__in=completed)
+        .values_list("ride_id", flat=True)
+        .distinct()
+        .order_by("ride_id")
+    )
+    if limit is not None:
+        ride_ids = ride_ids[:limit]
+    return list(ride_ids)
+
+
+def _build_trajectory(ride_id, rows, tolerance_m):
+    coords = []
+    times = []
+    for _, latitude, longitude, timestamp in rows:
+        try:
+            coords.append((float(latitude), float(longitude)))
+        except (TypeError, ValueError):
+            continue
+        times.append(timestamp)
+
+    if not coords:
+        return None
+
+    coords = np.array(coords)
+    kept = simplify(coords, tolerance_m)
+    started_at = times[0]
+    offsets = [round((times[i] - started_at).total_seconds()) for i in kept]
+
+    return RideTrajectory(
+        ride_id=ride_id,
+        polyline=encode_polyline(coords[kept]),
+        time_offsets=encode_time_offsets(offsets),
+        raw_points=len(coords),
+        kept_points=len(kept),
+        tolerance_m=tolerance_m,
+        started_at=started_at,
+        ended_at=times[-1],
+    )
+
+
+def compact_rides(ride_ids, tolerance_m=5.0, prune=True):
+    """
+    Simplifies the raw trace of each ride into a RideTrajectory and, with
+    `prune`, deletes the raw rows it replaced. Returns counters for the
+    storage report.
+
+    Points are ordered by updated_at, then by log id: one ingest flush
+    stamps all its rows with the same updated_at and mints time-ordered
+    log ids in arrival order. Rides that gained a trajectory meanwhile
+    (another compactor) are skipped and keep their raw rows.
+    """
+    report = {"rides": 0, "raw_points": 0, "kept_points": 0, "raw_bytes": 0, "stored_bytes": 0}
+    if not ride_ids:
+        return report
+
+    rows = (
+        RideLocationLog.objects
+        .filter(ride_id__in=ride_ids)
+        .order_by("ride_id", "updated_at", "log_id")
+        .values_list("ride_id", "latitude", "longitude", "updated_at", "heading_towards", "h3_index")
+    )
+
+    trajectories = []
+    last_seen = {}      # ride_id -> newest raw row read
+    for ride_id, ride_rows in groupby(rows.iterator(chunk_size=5000), key=lambda row: row[0]):
+        ride_rows = list(ride_rows)
+        report["raw_bytes"] += sum(
+            _LOG_ROW_FIXED_BYTES + sum(len(value or "") for value in (row[1], row[2], row[4], row[5]))
+            for row in ride_rows
+        )
+        last_seen[ride_id] = ride_rows[-1][3]
+
+        trajectory = _build_trajectory(ride_id, [row[:4] for row in ride_rows], tolerance_m)
+        if trajectory is not None:
+            trajectories.append(trajectory)
+
+    with transaction.atomic():
+        # lock the rides so a concurrent compactor cannot insert between the check and the insert
+        list(
+            Ride.objects.select_for_update()
+            .filter(ride_id__in=[t.ride_id for t in trajectories])
+            .order_by("ride_id")
+            .values_list("ride_id", flat=True)
+        )
+        existing = set(
+            RideTrajectory.objects
+            .filter(ride_id__in=[t.ride_id for t in trajectories])
+            .values_list("ride_id", flat=True)
+        )
+        trajectories = [t for t in trajectories if t.ride_id not in existing]
+        RideTrajectory.objects.bulk_create(trajectories)
+
+        if prune and trajectories:
+            # rows that arrived after the read are newer than the ride's last one and stay
+            RideLocationLog.objects.filter(reduce(or_, (
+                Q(ride_id=t.ride_id, updated_at__lte=last_seen[t.ride_id]) for t in trajectories
+            ))).delete()
+
+    for trajectory in trajectories:
+        report["rides"] += 1
+        report["raw_points"] += trajectory.raw_points
+        report["kept_points"] += trajectory.kept_points
+        report["stored_bytes"] += (
+            _TRAJECTORY_ROW_FIXED_BYTES + len(trajectory.polyline) + len(trajectory.time_offsets)
+        )
+
+    return report
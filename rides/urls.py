@@ -5,6 +5,7 @@ from .views import (
     AcceptRideView,
     UpdateRideStatusView,
     RideLocationLogView,
+    RideLocationBatchView,
     CancelRideView, 
     RejectRideView,
     ListPreviousRidesView,
@@ -16,6 +17,7 @@ urlpatterns = [
     path("accept/", AcceptRideView.as_view()),
     path("status/", UpdateRideStatusView.as_view()),
     path("location/", RideLocationLogView.as_view()),
+    path("location/batch/", RideLocationBatchView.as_view()),
     path("reject/", RejectRideView.as_view()),
     path("cancel/", CancelRideView.as_view()),
     path("list_previous_rides/<uuid:user_id>", ListPreviousRidesView.as_view()),
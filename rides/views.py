@@ -1,52 +1,61 @@
+from django.conf import settings
 from django.db import transaction
+from django.http import StreamingHttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.settings import api_settings
 from rides.serializers import *
 from drivers.models import Driver, VehicleDriverAssignment
+from drivers.locations import driver_locations
 from rides.models import RideCancellationLog
 from rides.serializers import RideCancellationSerializer, RejectRideSerializer
 from django.utils import timezone
 import h3
-from rides.models import RideDetailsForRiders, RideStatusLookup
+from rides.models import RideDetailsForRiders
+from ride_sharing.lookups import ride_statuses
+from ride_sharing.idempotency import idempotent
+from rides.history import InvalidCursor, history_page, iter_history_ndjson
+from rides.location_buffer import location_buffer
+from rides.location_ingest import drop_unknown_references, parse_location_batch, parse_point, write_location_points
+from rides.parsers import LocationFrameParser
+from rides.rejections import rejected_rides
+from rides import state_machine
+from rides.state_machine import accept_ride, transition
+from rides.spatial_index import open_ride_index, to_h3_cell
 import json
 
-def get_nearby_rides_for_driver(driver, k_ring=3, target_res=9):
+def get_nearby_rides_for_driver(driver, min_candidates=None, max_k=None, target_res=9):
     """
-    Returns nearby BOOKED rides for a driver using H3 proximity,
-    excluding rides already rejected by the driver
+    Returns nearby BOOKED rides for a driver using H3 proximity, nearest
+    ring first, excluding rides already rejected by the driver.
+    Rings are searched outward until `min_candidates` rides are found or
+    `max_k` is reached, so dense areas stop early and sparse areas widen.
+    Candidates come from the in-memory open ride index and rejections from
+    the per-driver rejected-ride cache, not the database; the driver's
+    position comes from driver_locations before the drivers row.
     """
-
-    if not driver.current_h3_index:
-        return RideDetailsForRiders.objects.none()
-
-    # driver_h3_index = h3.int_to_str(driver.current_h3_index)
-    driver_h3_index = h3.cell_to_parent(driver.current_h3_index, target_res)
-    nearby_cells = list(h3.grid_disk(driver_h3_index, k_ring))
-
-    booked_status = RideStatusLookup.objects.get(
-        ride_status="BOOKED"
-    )
-
-    rejected_rides = DriverRideRejection.objects.filter(
-        driver=driver
-    ).values_list("ride_id", flat=True)
-
-    rides = (
-        RideDetailsForRiders.objects
-        .filter(
-            ride_status=booked_status,
-            from_location__in=nearby_cells
-        )
-        .exclude(ride_id__in=rejected_rides)
-        .select_related("ride", "rider")
-        .order_by("created_at")
+    if min_candidates is None:
+        min_candidates = getattr(settings, "RIDE_DISCOVERY_MIN_CANDIDATES", 20)
+    if max_k is None:
+        max_k = getattr(settings, "RIDE_DISCOVERY_MAX_K", 3)
+
+    driver_h3_index = to_h3_cell(driver_locations.cell_of(driver), target_res)
+    if not driver_h3_index:
+        return []
+
+    found = open_ride_index.nearest_rides(
+        driver_h3_index,
+        min_results=min_candidates,
+        max_k=max_k,
+        exclude=rejected_rides.rejected_keys(driver.driver_id, driver_h3_index, max_k)
     )
 
-    return rides
+    return [ride for ride, _ in found]
 
 
 class BookRideView(APIView):
+    @idempotent("rides.book", owner_field="user_id")
     def post(self, request):
         serializer = BookRideSerializer(
             data=request.data,
@@ -81,10 +90,7 @@ class AvailableRidesForDriverView(APIView):
 
         driver = Driver.objects.get(driver_id=driver_id)
 
-        rides = get_nearby_rides_for_driver(
-            driver=driver,
-            k_ring=1  # tune this (1–3)
-        )
+        rides = get_nearby_rides_for_driver(driver=driver)
 
         serializer = AvailableRideSerializer(rides, many=True)
         return Response(serializer.data)
@@ -103,54 +109,36 @@ class AcceptRideView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        driver = Driver.objects.get(driver_id=driver_id)
-
-        with transaction.atomic():
-            details = RideDetailsForRiders.objects.select_for_update().get(
-                ride_id=ride_id
+        if not Driver.objects.filter(driver_id=driver_id).exists():
+            return Response(
+                {"error": "Driver not found"},
+                status=status.HTTP_404_NOT_FOUND
             )
 
-            if details.ride_status.ride_status != "BOOKED":
-                return Response(
-                    {"error": "Ride already accepted"},
-                    status=status.HTTP_409_CONFLICT
-                )
+        rejected = accept_ride(ride_id, driver_id, otp)
 
-            if details.verification_status:
-                return Response(
-                    {"error": "OTP already verified"},
-                    status=status.HTTP_409_CONFLICT
-                )
-
-            if details.otp != int(otp):
-                return Response(
-                    {"error": "Invalid OTP"},
-                    status=status.HTTP_403_FORBIDDEN
-                )
-
-            details.verification_status = True
+        if rejected == state_machine.NOT_FOUND:
+            return Response(
+                {"error": "Ride not found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
 
-            accepted_status = RideStatusLookup.objects.get(
-                ride_status="DRIVER_ASSIGNED"
+        if rejected == state_machine.INVALID_OTP:
+            return Response(
+                {"error": "Invalid OTP"},
+                status=status.HTTP_403_FORBIDDEN
             )
-            details.ride_status = accepted_status
-            details.save()
-
-            now = timezone.now()
-            vehicle = VehicleDriverAssignment.objects.filter(
-                driver__driver_id=driver_id,
-                start_time__lte=now,
-                end_time__gte=now
-            ).first()
-
-            Ride.objects.filter(ride_id=ride_id).update(
-                driver=driver,
-                vehicle=vehicle
+
+        if rejected == state_machine.OTP_VERIFIED:
+            return Response(
+                {"error": "OTP already verified"},
+                status=status.HTTP_409_CONFLICT
             )
 
-            EventLog.objects.create(
-                ride_id=ride_id,
-                ride_status=accepted_status
+        if rejected is not None:
+            return Response(
+                {"error": "Ride already accepted"},
+                status=status.HTTP_409_CONFLICT
             )
 
         return Response(
@@ -170,33 +158,70 @@ class UpdateRideStatusView(APIView):
         lat = request.data.get("latitude")
         lng = request.data.get("longitude")
 
-        new_status = RideStatusLookup.objects.get(
-            ride_status=status_code
-        )
-
-        details = RideDetailsForRiders.objects.get(ride_id=ride_id)
-        details.ride_status = new_status
-        details.save()
+        try:
+            moved = transition(ride_id, status_code, latitude=lat, longitude=lng)
+        except RideStatusLookup.DoesNotExist:
+            return Response(
+                {"error": f"Unknown ride status {status_code}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        EventLog.objects.create(
-            ride_id=ride_id,
-            ride_status=new_status,
-            latitude=lat,
-            longitude=lng
-        )
+        if not moved:
+            return Response(
+                {"error": f"Ride cannot move to {status_code} from its current status"},
+                status=status.HTTP_409_CONFLICT
+            )
 
         return Response({"status": status_code})
 
 
 class RideLocationLogView(APIView):
+    """
+    Acknowledges a GPS ping as soon as it is queued; the write-behind
+    buffer persists it (and the driver's latest location) in batches
+    """
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [LocationFrameParser]
+
     def post(self, request):
-        print("request received", request.body)
-        serializer = RideLocationLogSerializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
+        if isinstance(request.data, list):
+            # binary frames, possibly several pings from the same device
+            points = parse_location_batch(request.data)
+        else:
+            try:
+                points = [parse_point(request.data)]
+            except ValueError as error:
+                return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not location_buffer.offer(points):
+            return Response(
+                {"error": "Location buffer full, retry later"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": "1"}
+            )
+
+        return Response({"logged": True}, status=status.HTTP_202_ACCEPTED)
+
 
-        serializer.save()
+class RideLocationBatchView(APIView):
+    """
+    Bulk GPS ingestion: many points (possibly across rides) per request,
+    validated without ModelSerializer and written in one COPY
+    """
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [LocationFrameParser]
+
+    def post(self, request):
+        points = parse_location_batch(request.data)
+        known, rejected = drop_unknown_references(points)
 
-        return Response({"logged": True})
+        logged = write_location_points(known)
+
+        return Response(
+            {
+                "logged": logged,
+                "rejected": len(rejected)
+            },
+            status=status.HTTP_201_CREATED
+        )
     
 
 class CancelRideView(APIView):
@@ -221,12 +246,47 @@ class RejectRideView(APIView):
         serializer.is_valid(raise_exception=True)
 
         rejection = serializer.save()
+        rejected_rides.add(rejection.driver_id, rejection.ride_id)
 
         return Response({"status": "REJECTED", "rejection_id": str(rejection.rejection_id)}, status=status.HTTP_201_CREATED)
 
 
 class ListPreviousRidesView(APIView):
+    """
+    A rider's rides, newest first, one keyset page at a time:
+    ?limit=<n>&cursor=<next_cursor from the previous page>.
+    ?export=ndjson streams the whole history as newline-delimited JSON.
+    """
+
     def get(self, request, user_id):
-        rides = RideDetailsForRiders.objects.filter(rider_id = user_id)
-        serializer = RideDetailsForRidersSerializer(rides, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
\ No newline at end of file
+        if request.query_params.get("export") == "ndjson":
+            response = StreamingHttpResponse(
+                iter_history_ndjson(
+                    user_id,
+                    RideHistorySerializer,
+                    chunk_size=getattr(settings, "RIDE_HISTORY_EXPORT_CHUNK", 1000)
+                ),
+                content_type="application/x-ndjson"
+            )
+            response["Content-Disposition"] = f'attachment; filename="rides-{user_id}.ndjson"'
+            return response
+
+        page_size = getattr(settings, "RIDE_HISTORY_PAGE_SIZE", 50)
+        try:
+            limit = int(request.query_params.get("limit", page_size))
+        except ValueError:
+            return Response({"error": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), getattr(settings, "RIDE_HISTORY_MAX_PAGE_SIZE", 200))
+
+        try:
+            rides, next_cursor = history_page(user_id, request.query_params.get("cursor"), limit)
+        except InvalidCursor as error:
+            return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {
+                "results": RideHistorySerializer(rides, many=True).data,
+                "next_cursor": next_cursor
+            },
+            status=status.HTTP_200_OK
+        )
\ No newline at end of file